@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Time reading the status of a transaction from solitude whose notes hold a
+large in-app pay request, with the notes decoded straight away and with them
+decoded when they are used, as SolitudeAPI.get_transaction does.
+
+Run it from the root of the project:
+
+    python bin/bench_notes.py --locales 40 --number 10000
+"""
+import json
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import manage  # noqa, sets up the Django environment.
+
+from lib.solitude.api import Transaction
+
+
+def pay_request(locales):
+    """An in-app pay request like the ones that end up in the notes."""
+    description = 'A very shiny sword that cuts through anything. ' * 5
+    return {
+        'iss': 'some-app-key',
+        'aud': 'marketplace.firefox.com',
+        'typ': 'mozilla/payments/pay/v1',
+        'request': {
+            'id': 'sword-of-ages',
+            'pricePoint': 10,
+            'name': 'Sword of Ages',
+            'description': description,
+            'postbackURL': 'https://app.example.com/postback',
+            'chargebackURL': 'https://app.example.com/chargeback',
+            'productData': 'my_product_id=1234&public_id=abcd',
+            'icons': dict((size, 'https://app.example.com/icon-%s.png' % size)
+                          for size in ('16', '32', '48', '64', '128', '512')),
+            'locales': dict(('l%02d' % n, {'name': 'Sword of Ages %d' % n,
+                                           'description': description})
+                            for n in range(locales)),
+        }
+    }
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--locales', type='int', default=40,
+                      help='Number of localizations in the pay request.')
+    parser.add_option('--number', type='int', default=10000,
+                      help='Number of transactions to read.')
+    options, args = parser.parse_args()
+
+    notes = json.dumps({'issuer_key': 'some-app-key',
+                        'pay_request': pay_request(options.locales)})
+    raw = {'uuid': 'webpay:some-uuid', 'status': 0, 'provider': 1,
+           'pay_url': 'https://bango/pay', 'notes': notes}
+
+    def eager():
+        transaction = dict(raw)
+        transaction['notes'] = json.loads(transaction['notes'])
+        return transaction['status']
+
+    def lazy():
+        return Transaction(raw)['status']
+
+    def lazy_notes():
+        return Transaction(raw)['notes']['pay_request']
+
+    print 'Notes are {0} bytes'.format(len(notes))
+    for name, func in (('decoded straight away', eager),
+                       ('decoded when used, status only', lazy),
+                       ('decoded when used, notes read', lazy_notes)):
+        took = timeit.timeit(func, number=options.number)
+        print '{0}: {1:.2f}us per transaction'.format(
+            name, took / options.number * 1000000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Time signing the notices for a transaction whose pay request has many
+locales and icons, with the whole notice encoded on every attempt and with
+it prepared once and only signed on each attempt, as tasks._sign_notice
+does.
+
+Run it from the root of the project:
+
+    python bin/bench_notices.py --locales 40 --icons 6 --attempts 6
+"""
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import manage  # noqa, sets up the Django environment.
+
+import jwt
+
+from webpay.base.utils import gmtime
+from webpay.pay import notices
+
+
+def pay_request(locales, icons):
+    """An in-app pay request like the ones that notices are sent for."""
+    description = 'A very shiny sword that cuts through anything. ' * 5
+    return {
+        'id': 'sword-of-ages',
+        'pricePoint': 10,
+        'name': 'Sword of Ages',
+        'description': description,
+        'postbackURL': 'https://app.example.com/postback',
+        'chargebackURL': 'https://app.example.com/chargeback',
+        'productData': 'my_product_id=1234&public_id=abcd',
+        'icons': dict((str(16 * 2 ** n),
+                       'https://app.example.com/icon-%s.png' % n)
+                      for n in range(icons)),
+        'locales': dict(('l%02d' % n, {'name': 'Sword of Ages %d' % n,
+                                       'description': description})
+                        for n in range(locales)),
+    }
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--locales', type='int', default=40,
+                      help='Number of localizations in the pay request.')
+    parser.add_option('--icons', type='int', default=6,
+                      help='Number of icons in the pay request.')
+    parser.add_option('--attempts', type='int', default=6,
+                      help='Attempts to deliver each notice.')
+    parser.add_option('--number', type='int', default=1000,
+                      help='Number of notices to send.')
+    options, args = parser.parse_args()
+
+    notice = {'iss': 'marketplace.firefox.com',
+              'aud': 'some-app-key',
+              'typ': 'mozilla/payments/pay/postback/v1',
+              'request': pay_request(options.locales, options.icons),
+              'response': {'transactionID': 'webpay:some-uuid',
+                           'price': {'amount': '0.99', 'currency': 'USD'}}}
+
+    def every_time():
+        for attempt in range(options.attempts):
+            issued_at = gmtime()
+            jwt.encode(dict(notice, iat=issued_at, exp=issued_at + 3600),
+                       'secret', algorithm='HS256')
+
+    def prepared_once():
+        prepared = notices.prepare('key', 'https://app.example.com/postback',
+                                   'some-app-key', notice)
+        for attempt in range(options.attempts):
+            notices.sign(prepared, 'secret')
+
+    size = len(jwt.encode(notice, 'secret', algorithm='HS256'))
+    print 'Notices are {0} bytes, {1} attempts each'.format(
+        size, options.attempts)
+    for name, func in (('encoded every attempt', every_time),
+                       ('prepared once, signed every attempt',
+                        prepared_once)):
+        took = timeit.timeit(func, number=options.number)
+        print '{0}: {1:.2f}us per notice'.format(
+            name, took / options.number * 1000000)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ HOME=/tmp
 # Every minute!
 * * * * * {{ cron }}
 
+# Every 5 minutes, deliver the notices left in the outbox.
+*/5 * * * * {{ django }} notice_outbox --drain
+
 # Every hour.
 42 * * * * {{ django }} cleanup
 
@@ -72,6 +72,15 @@ def install_cron(ctx):
                   (settings.CRON_NAME,  settings.CRON_NAME))
 
 
+@task
+def warm_caches(ctx):
+    """Fill the shared caches before the webheads take traffic."""
+    issuers = ''.join(' --issuer=%s' % issuer
+                      for issuer in getattr(settings, 'WARM_ISSUERS', ()))
+    with ctx.lcd(settings.SRC_DIR):
+        ctx.local('python2.6 manage.py warm_caches%s' % issuers)
+
+
 @task
 def checkin_changes(ctx):
     """Use the local, IT-written deploy script to check in changes."""
@@ -127,6 +136,7 @@ def update(ctx):
 def deploy(ctx):
     install_cron()
     checkin_changes()
+    warm_caches()
     deploy_app()
     update_celery()
 
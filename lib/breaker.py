@@ -0,0 +1,164 @@
+"""
+Circuit breakers for the upstream APIs.
+
+There is a breaker for each upstream and resource family, for example
+solitude.buyer or solitude.bango. After CIRCUIT_BREAKER_FAILURES calls in a
+row fail the breaker opens and calls fail straight away with CircuitOpen
+instead of waiting on the upstream. Once CIRCUIT_BREAKER_RESET seconds have
+passed a single probe call is let through; if it works the breaker closes
+again, otherwise it stays open for another CIRCUIT_BREAKER_RESET seconds.
+A probe that hasn't reported back after CIRCUIT_BREAKER_RESET seconds is
+taken to be lost and another one is let through.
+
+Breakers live in the process, each web or celery worker keeps its own.
+"""
+import re
+import threading
+import time
+import urlparse
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+
+from webpay.base import dev_messages as msg
+from webpay.base.logger import getLogger
+
+log = getLogger('lib.breaker')
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+
+# Numbers sent to the statsd gauge for each state.
+STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Path segments that don't say anything about the resource being used.
+IGNORED_SEGMENTS = re.compile(r'^(api|v\d+|generic)$')
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+class CircuitOpen(msg.DevMessage):
+    """
+    Raised instead of calling an upstream whose breaker is open.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        super(CircuitOpen, self).__init__(msg.UPSTREAM_UNAVAILABLE)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the calls to one upstream resource family.
+
+    :param name: the name of the breaker, e.g. solitude.buyer.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(settings.CIRCUIT_BREAKER_FAILURES)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warning('Circuit {0} is now {1}'.format(self.name, state))
+        self.state = state
+        statsd.gauge('upstream.{0}.breaker'.format(self.name),
+                     STATE_GAUGE[state])
+
+    def before(self):
+        """
+        Call before making a request, raises CircuitOpen if the request
+        should not be made.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            since = self.opened_at if self.state == OPEN else self.probed_at
+            if time.time() - since >= settings.CIRCUIT_BREAKER_RESET:
+                # Let this request through to see if the upstream is back.
+                self.probed_at = time.time()
+                self._set_state(HALF_OPEN)
+                return
+
+        statsd.incr('upstream.{0}.breaker.rejected'.format(self.name))
+        raise CircuitOpen(self.name)
+
+    def success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def release(self):
+        """
+        Call when a request ended without saying whether the upstream works,
+        so that a probe is tried again after CIRCUIT_BREAKER_RESET seconds.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.opened_at = time.time()
+                self._set_state(OPEN)
+
+    def failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= settings.CIRCUIT_BREAKER_FAILURES):
+                if self.state != OPEN:
+                    statsd.incr('upstream.{0}.breaker.opened'
+                                .format(self.name))
+                self.opened_at = time.time()
+                self._set_state(OPEN)
+
+
+def family(url):
+    """
+    Return the resource family of an upstream URL. That is the first part of
+    the path once prefixes like /api/v1/ and /generic/ are removed, so
+    /generic/buyer/1/ is buyer and /bango/billing/ is bango.
+    """
+    for segment in urlparse.urlparse(url).path.split('/'):
+        if segment and not IGNORED_SEGMENTS.match(segment):
+            return segment
+    return 'root'
+
+
+def get_breaker(upstream, url):
+    name = '{0}.{1}'.format(upstream, family(url))
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def breaker_states():
+    """
+    Return a dict of breaker name to state for every breaker in use.
+    """
+    with _lock:
+        return dict((name, breaker.state)
+                    for name, breaker in _breakers.items())
+
+
+def reset_breakers():
+    with _lock:
+        _breakers.clear()
@@ -0,0 +1,98 @@
+"""
+A small in-process LRU cache kept in front of the shared Django cache.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from django_statsd.clients import statsd
+
+
+class LRU(object):
+    """
+    A thread safe, size bounded mapping whose entries expire after a timeout.
+
+    Values are copied in and out so callers can't change what is cached.
+    """
+
+    def __init__(self, maxsize=1000, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert it to mark it as the most recently used.
+            self._data[key] = entry
+        return copy.deepcopy(value)
+
+    def set(self, key, value, timeout=None):
+        timeout = min(timeout or self.timeout, self.timeout)
+        entry = (time.time() + timeout, copy.deepcopy(value))
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = entry
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache(object):
+    """
+    Looks keys up in an in-process LRU first and then in the shared cache.
+
+    Hits and misses for each tier are sent to statsd as
+    ``cache.<name>.<tier>.<hit|miss>``.
+
+    :param name: the name used for the statsd keys.
+    :param maxsize: the most keys kept in the local tier.
+    :param timeout: the most seconds a key is kept in the local tier.
+    """
+
+    def __init__(self, name, maxsize=1000, timeout=60):
+        self.name = name
+        self.local = LRU(maxsize=maxsize, timeout=timeout)
+
+    def _count(self, tier, hit):
+        statsd.incr('cache.{0}.{1}.{2}'.format(self.name, tier,
+                                               'hit' if hit else 'miss'))
+
+    def get(self, key):
+        value = self.local.get(key)
+        self._count('local', value is not None)
+        if value is not None:
+            return value
+
+        value = cache.get(key)
+        self._count('shared', value is not None)
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value, timeout=None):
+        cache.set(key, value, timeout)
+        self.local.set(key, value, timeout)
+
+    def delete(self, key):
+        self.local.delete(key)
+        cache.delete(key)
@@ -0,0 +1,111 @@
+"""
+Helpers for sharing work between threads in the same process.
+"""
+import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from webpay.base.logger import get_context, set_context
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_worker = threading.local()
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into a single call.
+
+    The first thread to ask for a key runs the function. Any other thread
+    asking for the same key while that call is in flight waits for it and gets
+    the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kw):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = func(*args, **kw)
+        except BaseException:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Threads don't survive a fork, so each (celery) process needs its
+        # own pool.
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(settings.PARALLEL_POOL_SIZE)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def _run(func, context):
+    _worker.active = True
+    set_context(context)
+    try:
+        return func(), None
+    except BaseException:
+        return None, sys.exc_info()
+    finally:
+        set_context({})
+        _worker.active = False
+
+
+def run_parallel(*funcs):
+    """
+    Call each of the functions, at the same time when
+    PARALLEL_UPSTREAM_CALLS is enabled, and return a list of their results.
+
+    The functions share the request values kept by webpay.base.logger, such
+    as the transaction id. Once all of them have finished, the exception of
+    the first function that failed is raised.
+
+    Calls from within a function that is already running in parallel are
+    made one after another so that the pool can't be exhausted.
+    """
+    if (not settings.PARALLEL_UPSTREAM_CALLS or len(funcs) < 2
+            or getattr(_worker, 'active', False)):
+        return [func() for func in funcs]
+
+    context = get_context()
+    pending = [_get_pool().apply_async(_run, (func, context))
+               for func in funcs]
+    results = [p.get() for p in pending]
+    for result, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return [result for result, exc_info in results]
@@ -1,12 +1,14 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.decorators import method_decorator
 
-from cache_nuggets.lib import memoize
+from cache_nuggets.lib import memoize, memoize_key
 from requests.exceptions import ConnectionError
 
 from constants import COUNTRIES
-from ..utils import SlumberWrapper
+from .prices import PriceTable
+from ..utils import RetryPolicy, SlumberWrapper
 
 from lib.solitude.constants import PROVIDER_BANGO, PROVIDERS_INVERTED
 
@@ -16,6 +18,18 @@ log = getLogger('w.marketplace')
 
 NUMBER_ATTEMPTS = 5
 
+# Single price tiers are memoized under this prefix for PRICE_TIMEOUT seconds.
+PRICE_KEY = 'marketplace:api:get_price'
+PRICE_TIMEOUT = 60
+# Tiers memoized ahead of time by cache_prices are kept longer, so that they
+# are still there when a deploy starts taking traffic.
+PRICE_WARM_TIMEOUT = 60 * 60
+
+# https://bugzilla.mozilla.org/show_bug.cgi?id=1024065
+# Getting prices fails more often than it should, so it is retried.
+PRICE_RETRY = RetryPolicy(attempts=NUMBER_ATTEMPTS, backoff=0.05,
+                          max_backoff=1, budget=5, errors=(ConnectionError,))
+
 
 class UnknownPricePoint(Exception):
     pass
@@ -27,8 +41,8 @@ class ConnectionFailed(ConnectionError):
 
 class MarketplaceAPI(SlumberWrapper):
     errors = {}
+    name = 'marketplace'
 
-    @method_decorator(memoize('marketplace:api:get_price'))
     def get_price(self, point, provider=PROVIDERS_INVERTED[PROVIDER_BANGO]):
         """
         Get the price points from zamboni for a provider.
@@ -36,27 +50,26 @@ class MarketplaceAPI(SlumberWrapper):
         :param point: the name of the price tier.
         :param provider: the payment provider. Defaults to 'bango'.
         """
-        # https://bugzilla.mozilla.org/show_bug.cgi?id=1024065
-        # This seems to fail more often than it should, so we'll retry
-        # it a few times.
-        #
-        # This is a filthy terrible hack.
-        for x in range(1, NUMBER_ATTEMPTS + 1):
-            log.info('Attempting to get prices: attempt: {0}'.format(x))
-            try:
-                res = (self.api.webpay.prices()
-                       .get_object(provider=provider, pricePoint=point))
-                log.info('Successfully got prices')
-                return res
-            except ObjectDoesNotExist:
-                raise UnknownPricePoint(point)
-            except ConnectionError:
-                log.error('Failed to get prices, attempt: {0}'.format(x))
-
-        # Re-raise the connection error.
-        log.error('Failed to get prices after {0} attempts'
-                  .format(NUMBER_ATTEMPTS))
-        raise ConnectionFailed(point)
+        if settings.PRICE_TABLE_TIMEOUT:
+            tier = price_table.tier(point, provider)
+            if tier is not None:
+                return tier
+        return self._get_price(point, provider)
+
+    @method_decorator(memoize(PRICE_KEY, time=PRICE_TIMEOUT))
+    def _get_price(self, point, provider):
+        log.info('Getting prices for: {0}'.format(point))
+        try:
+            res = self.retry(lambda: self.api.webpay.prices()
+                             .get_object(provider=provider, pricePoint=point),
+                             PRICE_RETRY)
+        except ObjectDoesNotExist:
+            raise UnknownPricePoint(point)
+        except ConnectionError:
+            log.error('Failed to get prices for: {0}'.format(point))
+            raise ConnectionFailed(point)
+        log.info('Successfully got prices')
+        return res
 
     def get_price_country(self, point, provider, country):
         """
@@ -67,9 +80,14 @@ class MarketplaceAPI(SlumberWrapper):
         :param provider: the payment provider.
         :param country: the country MCC code.
         """
-        tier = self.get_price(point, provider)
         # This assumes you've already validated the MCC is correct.
         country_id = COUNTRIES[country]
+        if settings.PRICE_TABLE_TIMEOUT:
+            found = price_table.price(point, provider, country_id)
+            if found:
+                return found
+
+        tier = self.get_price(point, provider)
         for price in tier['prices']:
             if price.get('region', None) == country_id:
                 return price['amount'], price['currency']
@@ -78,8 +96,39 @@ class MarketplaceAPI(SlumberWrapper):
         raise UnknownPricePoint('Point: {p}, provider: {v}, country: {c}'.
                                 format(p=point, v=provider, c=country))
 
+    def get_prices(self, provider):
+        """
+        Get all the price tiers from zamboni for a provider.
+
+        :param provider: the payment provider.
+        """
+        tiers = []
+        offset = 0
+        while True:
+            res = self.retry(lambda: self.api.webpay.prices.get(
+                provider=provider, offset=offset), PRICE_RETRY)
+            tiers.extend(res['objects'])
+            offset += len(res['objects'])
+            if not res['meta'].get('next') or not res['objects']:
+                return tiers
+
+    def cache_prices(self, provider):
+        """
+        Get all the price tiers for a provider and memoize each of them the
+        way get_price does. Returns the number of tiers.
+
+        :param provider: the payment provider.
+        """
+        tiers = self.get_prices(provider)
+        for tier in tiers:
+            cache.set(memoize_key(PRICE_KEY, tier['pricePoint'], provider),
+                      tier, PRICE_WARM_TIMEOUT)
+        return len(tiers)
+
 
 if not settings.MARKETPLACE_URL:
     raise ValueError('MARKETPLACE_URL is required')
 
-client = MarketplaceAPI(settings.MARKETPLACE_URL, settings.MARKETPLACE_OAUTH)
+client = MarketplaceAPI(settings.MARKETPLACE_URL, settings.MARKETPLACE_OAUTH,
+                        settings.MARKETPLACE_POOL)
+price_table = PriceTable(client.get_prices)
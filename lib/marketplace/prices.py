@@ -0,0 +1,126 @@
+"""
+An in-process table of the price tiers of each payment provider.
+
+All the tiers of a provider are loaded from the marketplace in one go and
+indexed by (tier, provider, region) so a price can be found without going
+through the tier. Tables are always loaded in the background so the pay flow
+never waits on the marketplace for them: until a provider's table is loaded
+its prices aren't found here and the caller gets them one at a time instead.
+Once PRICE_TABLE_TIMEOUT seconds have passed the table is still used while a
+new copy is loaded. After a failed load the table isn't loaded again for
+RETRY_AFTER seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from django_statsd.clients import statsd
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.marketplace.prices')
+
+# Seconds to wait before loading the tiers of a provider again after a load
+# failed, so an outage doesn't start a load on every request.
+RETRY_AFTER = 30
+
+
+class _Table(object):
+
+    def __init__(self, provider, tiers):
+        self.loaded = time.time()
+        self.tiers = {}
+        self.index = {}
+        for tier in tiers:
+            point = str(tier['pricePoint'])
+            self.tiers[point] = tier
+            for price in tier['prices']:
+                self.index[(point, provider, price.get('region'))] = (
+                    price['amount'], price['currency'])
+
+    def stale(self):
+        return time.time() - self.loaded > settings.PRICE_TABLE_TIMEOUT
+
+
+class PriceTable(object):
+    """
+    :param fetch: a callable returning a list of all the price tiers of the
+                  provider it is given, e.g. MarketplaceAPI.get_prices.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._retry_at = {}
+
+    def load(self, provider):
+        """
+        Load the tiers of a provider now, replacing any it already has.
+        """
+        table = _Table(provider, self.fetch(provider))
+        self._tables[provider] = table
+        log.info('Loaded {0} price tiers for {1}'
+                 .format(len(table.tiers), provider))
+        return table
+
+    def _table(self, provider):
+        table = self._tables.get(provider)
+        if table is None:
+            statsd.incr('prices.table.miss')
+            self._refresh(provider)
+        elif table.stale():
+            statsd.incr('prices.table.stale')
+            self._refresh(provider)
+        else:
+            statsd.incr('prices.table.hit')
+        return table
+
+    def _refresh(self, provider):
+        with self._lock:
+            if (provider in self._refreshing or
+                    time.time() < self._retry_at.get(provider, 0)):
+                return
+            self._refreshing.add(provider)
+        thread = threading.Thread(target=self._reload, args=(provider,))
+        thread.daemon = True
+        thread.start()
+
+    def _reload(self, provider):
+        try:
+            self.load(provider)
+        except Exception, err:
+            # Keep using what we have, if anything, until the next try.
+            log.error('Failed to load prices for {0}: {1}'
+                      .format(provider, err))
+            statsd.incr('prices.table.failed')
+            self._retry_at[provider] = time.time() + RETRY_AFTER
+        finally:
+            with self._lock:
+                self._refreshing.discard(provider)
+
+    def tier(self, point, provider):
+        """
+        Return the tier with the given price point, or None if it isn't
+        known.
+        """
+        table = self._table(provider)
+        if table is None:
+            return None
+        return table.tiers.get(str(point))
+
+    def price(self, point, provider, region):
+        """
+        Return a tuple of (amount, currency) for the price point in the
+        region, or None if it isn't known.
+        """
+        table = self._table(provider)
+        if table is None:
+            return None
+        return table.index.get((str(point), provider, region))
+
+    def clear(self):
+        self._tables.clear()
+        self._retry_at.clear()
@@ -4,10 +4,12 @@ from django.test import TestCase
 
 import mock
 from curling.lib import HttpServerError
-from nose.tools import eq_, raises
+from nose.tools import eq_, ok_, raises
 from requests.exceptions import ConnectionError
 
-from lib.marketplace.api import client, NUMBER_ATTEMPTS, UnknownPricePoint
+from lib.marketplace.api import (client, NUMBER_ATTEMPTS, PRICE_WARM_TIMEOUT,
+                                 price_table, UnknownPricePoint)
+from lib.marketplace.prices import PriceTable
 from lib.solitude.constants import PROVIDER_BOKU
 
 
@@ -89,3 +91,144 @@ class SolitudeAPITest(TestCase):
         slumber.webpay.prices.side_effect = failure
         client.get_price(1)
         eq_(slumber.webpay.prices.call_count, 3)
+
+    def test_get_all_prices(self, slumber):
+        slumber.webpay.prices.get.side_effect = [
+            {'meta': {'next': '/next/'}, 'objects': [sample_price]},
+            {'meta': {'next': None}, 'objects': [sample_price]}]
+        eq_(client.get_prices('bango'), [sample_price, sample_price])
+        eq_(slumber.webpay.prices.get.call_args[1],
+            {'provider': 'bango', 'offset': 1})
+
+    def test_cache_prices(self, slumber):
+        slumber.webpay.prices.get.return_value = {
+            'meta': {'next': None}, 'objects': [sample_price]}
+        eq_(client.cache_prices('bango'), 1)
+        eq_(client.get_price(0), sample_price)
+        ok_(not slumber.webpay.prices.called)
+
+    def test_cache_prices_timeout(self, slumber):
+        slumber.webpay.prices.get.return_value = {
+            'meta': {'next': None}, 'objects': [sample_price]}
+        with mock.patch.object(cache, 'set') as cache_set:
+            client.cache_prices('bango')
+        # Warmed tiers outlast a deploy.
+        eq_(cache_set.call_args[0][2], PRICE_WARM_TIMEOUT)
+
+
+class SyncThread(object):
+    """Runs the target when it is started, like a thread that's quick."""
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@mock.patch('lib.marketplace.prices.statsd')
+class TestPriceTable(TestCase):
+
+    def setUp(self):
+        self.fetch = mock.Mock()
+        self.fetch.return_value = [sample_price]
+        self.table = PriceTable(self.fetch)
+        p = self.settings(PRICE_TABLE_TIMEOUT=60)
+        p.enable()
+        self.addCleanup(p.disable)
+        p = mock.patch('lib.marketplace.prices.threading.Thread', SyncThread)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_tier(self, statsd):
+        # The first call only starts loading the table.
+        eq_(self.table.tier(0, 'bango'), None)
+        eq_(self.table.tier(0, 'bango'), sample_price)
+        eq_(self.table.tier('0', 'bango'), sample_price)
+        eq_(self.table.tier(1, 'bango'), None)
+        self.fetch.assert_called_once_with('bango')
+
+    def test_price(self, statsd):
+        self.table.load('boku')
+        eq_(self.table.price(0, 'boku', 12), (u'3.00', u'MXN'))
+        eq_(self.table.price(0, 'boku', 99), None)
+
+    @mock.patch('lib.marketplace.prices.threading.Thread')
+    def test_cold_load_in_background(self, thread, statsd):
+        eq_(self.table.tier(0, 'bango'), None)
+        eq_(self.table.tier(0, 'bango'), None)
+        eq_(thread.call_count, 1)
+        ok_(not self.fetch.called)
+
+    @mock.patch('lib.marketplace.prices.time')
+    def test_failed_load(self, time_, statsd):
+        time_.time.return_value = 100
+        self.fetch.side_effect = ConnectionError
+        eq_(self.table.tier(0, 'bango'), None)
+        time_.time.return_value = 129
+        eq_(self.table.tier(0, 'bango'), None)
+        eq_(self.fetch.call_count, 1)
+        time_.time.return_value = 131
+        self.fetch.side_effect = None
+        self.table.tier(0, 'bango')
+        eq_(self.fetch.call_count, 2)
+        eq_(self.table.tier(0, 'bango'), sample_price)
+
+    @mock.patch('lib.marketplace.prices.threading.Thread')
+    @mock.patch('lib.marketplace.prices.time')
+    def test_stale(self, time_, thread, statsd):
+        time_.time.return_value = 100
+        self.table.load('bango')
+        time_.time.return_value = 161
+        # The stale tier is still used while the table is refreshed.
+        eq_(self.table.tier(0, 'bango'), sample_price)
+        eq_(self.table.tier(0, 'bango'), sample_price)
+        eq_(thread.call_count, 1)
+        thread.call_args[1]['target'](*thread.call_args[1]['args'])
+        eq_(self.fetch.call_count, 2)
+        eq_(self.table._refreshing, set())
+
+    @mock.patch('lib.marketplace.prices.threading.Thread')
+    @mock.patch('lib.marketplace.prices.time')
+    def test_failed_refresh(self, time_, thread, statsd):
+        time_.time.return_value = 100
+        self.table.load('bango')
+        time_.time.return_value = 161
+        self.table.tier(0, 'bango')
+        self.fetch.side_effect = ConnectionError
+        thread.call_args[1]['target'](*thread.call_args[1]['args'])
+        eq_(self.table.tier(0, 'bango'), sample_price)
+
+
+class TestPriceTableUsed(TestCase):
+
+    def setUp(self):
+        price_table.clear()
+        self.addCleanup(price_table.clear)
+        p = mock.patch.object(price_table, 'fetch')
+        self.fetch = p.start()
+        self.addCleanup(p.stop)
+        self.fetch.return_value = [sample_price]
+
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_get_price(self, slumber):
+        price_table.load('bango')
+        with self.settings(PRICE_TABLE_TIMEOUT=60):
+            eq_(client.get_price(0), sample_price)
+        ok_(not slumber.webpay.prices.called)
+
+    @mock.patch('lib.marketplace.prices.threading.Thread')
+    @mock.patch('lib.marketplace.api.client.api')
+    def test_get_price_cold(self, slumber, thread):
+        slumber.webpay.prices().get_object.return_value = sample_price
+        with self.settings(PRICE_TABLE_TIMEOUT=60):
+            eq_(client.get_price(0), sample_price)
+        ok_(thread.return_value.start.called)
+        ok_(not self.fetch.called)
+
+    def test_get_price_country(self):
+        price_table.load('boku')
+        with self.settings(PRICE_TABLE_TIMEOUT=60):
+            eq_(client.get_price_country(0, 'boku', '334'),
+                (u'3.00', u'MXN'))
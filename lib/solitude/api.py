@@ -1,5 +1,7 @@
+import hashlib
 import json
 import logging
+import threading
 import uuid
 import warnings
 
@@ -8,21 +10,75 @@ from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 
+from django_statsd.clients import statsd
 import mobile_codes
 from slumber.exceptions import HttpClientError
 
+from lib.caching import TieredCache
+from lib.concurrency import run_parallel, SingleFlight
 from lib.marketplace.constants import COUNTRIES
 from webpay.base import dev_messages as msg
 from webpay.base.helpers import absolutify
 
 from . import constants as solitude_const
 from .exceptions import ResourceNotModified
-from ..utils import SlumberWrapper
+from ..utils import RetryPolicy, SlumberWrapper
 
 
 log = logging.getLogger('w.solitude')
 client = None
 
+# Buyer etags, buyers and resource_pks are looked up in process before
+# going to the shared cache.
+buyer_cache = TieredCache('solitude.buyer', **settings.SOLITUDE_LOCAL_CACHE)
+
+# The resource_pk of a buyer never changes, so it is kept for a long time.
+BUYER_PK_KEY = 'buyer_pk:%s'
+BUYER_PK_TIMEOUT = 60 * 60 * 24 * 365
+
+# Transactions are polled while the user waits, so a dropped connection
+# shouldn't fail the payment.
+TRANSACTION_RETRY = RetryPolicy(attempts=3, backoff=0.1, budget=3)
+
+# Transactions are polled while the user waits. They are only kept in the
+# shared cache so that forget_transaction reaches every process.
+TRANSACTION_KEY = 'transaction:%s'
+
+# Resolved generic and provider products, see ProviderHelper.find_product.
+product_cache = TieredCache('solitude.product', maxsize=1000, timeout=60)
+
+# Concurrent get_buyer calls for the same buyer in this process share a
+# single request to solitude.
+_buyer_flight = SingleFlight()
+
+# Buyers already fetched during the current request, see BuyerMemoMiddleware.
+_local = threading.local()
+
+
+def start_buyer_memo():
+    """Remember buyers fetched by get_buyer until end_buyer_memo."""
+    _local.buyers = {}
+
+
+def end_buyer_memo():
+    _local.buyers = None
+
+
+def _buyer_memo():
+    return getattr(_local, 'buyers', None)
+
+
+def forget_buyer(uuid):
+    """Drop a buyer from the memo after it has been changed."""
+    memo = _buyer_memo()
+    if memo is not None:
+        memo.pop(uuid, None)
+
+
+def forget_transaction(uuid):
+    """Drop a transaction from the cache after its status has changed."""
+    cache.delete(TRANSACTION_KEY % uuid)
+
 
 class BuyerNotConfigured(Exception):
     """The buyer has not yet been configured for the payment."""
@@ -39,6 +95,7 @@ class SolitudeAPI(SlumberWrapper):
 
     :param url: URL of the solitude endpoint.
     """
+    name = 'solitude'
 
     def __init__(self, *args, **kw):
         super(SolitudeAPI, self).__init__(*args, **kw)
@@ -61,33 +118,54 @@ class SolitudeAPI(SlumberWrapper):
 
         obj = self.safe_run(self.slumber.generic.buyer.post, pin_data)
 
+        forget_buyer(uuid)
         if 'etag' in obj:
             etag = obj['etag']
-            cache.set('etag:%s' % uuid, etag)
-            cache.set('buyer:%s' % etag, obj)
+            buyer_cache.set('etag:%s' % uuid, etag)
+            buyer_cache.set('buyer:%s' % etag, obj)
+        if 'resource_pk' in obj:
+            buyer_cache.set(BUYER_PK_KEY % uuid, obj['resource_pk'],
+                            BUYER_PK_TIMEOUT)
         return obj
 
     def get_buyer(self, uuid, use_etags=True):
         """Retrieves a buyer by their uuid.
 
+        Within a request the buyer is only fetched once, and concurrent
+        lookups of the same buyer share one call to solitude.
+
         :param uuid: String to identify the buyer by.
         :rtype: dictionary
         """
+        memo = _buyer_memo()
+        if use_etags and memo is not None and uuid in memo:
+            return memo[uuid]
+
+        obj = _buyer_flight.do((uuid, use_etags), self._get_buyer,
+                               uuid, use_etags)
+        if memo is not None:
+            memo[uuid] = obj
+        return obj
+
+    def _get_buyer(self, uuid, use_etags):
         cache_key = 'etag:%s' % uuid
-        etag = cache.get(cache_key) if use_etags else None
+        etag = buyer_cache.get(cache_key) if use_etags else None
         headers = {'If-None-Match': etag} if etag else {}
         try:
             obj = self.safe_run(self.slumber.generic.buyer.get_object_or_404,
                                 headers=headers, uuid=uuid)
         except ResourceNotModified:
-            return (cache.get('buyer:%s' % etag)
+            return (buyer_cache.get('buyer:%s' % etag)
                     or self.get_buyer(uuid, use_etags=False))
         except ObjectDoesNotExist:
             obj = {}
         if 'etag' in obj:
             etag = obj['etag']
-            cache.set(cache_key, etag)
-            cache.set('buyer:%s' % etag, obj)
+            buyer_cache.set(cache_key, etag)
+            buyer_cache.set('buyer:%s' % etag, obj)
+        if 'resource_pk' in obj:
+            buyer_cache.set(BUYER_PK_KEY % uuid, obj['resource_pk'],
+                            BUYER_PK_TIMEOUT)
         return obj
 
     def update_buyer(self, uuid, etag='', **kwargs):
@@ -96,14 +174,40 @@ class SolitudeAPI(SlumberWrapper):
         :param uuid: String to identify the buyer by.
         :rtype: dictionary
         """
-        id_ = self.get_buyer(uuid).get('resource_pk')
-        res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
-                            kwargs,
-                            headers={'If-Match': etag})
+        id_ = buyer_cache.get(BUYER_PK_KEY % uuid)
+        if id_ is not None:
+            try:
+                res = self.safe_run(self._patch_buyer, id_, kwargs, etag)
+            except ObjectDoesNotExist:
+                log.warning('Cached resource_pk {0} for buyer {1} was not '
+                            'found, looking it up'.format(id_, uuid))
+                buyer_cache.delete(BUYER_PK_KEY % uuid)
+                forget_buyer(uuid)
+                id_ = None
+
+        if id_ is None:
+            id_ = self.get_buyer(uuid).get('resource_pk')
+            res = self.safe_run(self.slumber.generic.buyer(id=id_).patch,
+                                kwargs,
+                                headers={'If-Match': etag})
+        # The buyer has a new etag now.
+        buyer_cache.delete('etag:%s' % uuid)
+        forget_buyer(uuid)
         if 'errors' in res:
             return res
         return {}
 
+    def _patch_buyer(self, id_, data, etag):
+        # Raise ObjectDoesNotExist on a 404 so a stale resource_pk can be
+        # told apart from other client errors.
+        try:
+            return self.slumber.generic.buyer(id=id_).patch(
+                data, headers={'If-Match': etag})
+        except HttpClientError as e:
+            if e.response.status_code == 404:
+                raise ObjectDoesNotExist
+            raise
+
     def set_needs_pin_reset(self, uuid, value=True, etag=''):
         """Set flag for user to go through reset flow or not on next log in.
 
@@ -175,6 +279,7 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        forget_buyer(uuid)
         return res.get('confirmed', False)
 
     def reset_confirm_pin(self, uuid, pin):
@@ -187,6 +292,7 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.reset_confirm_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        forget_buyer(uuid)
         return res.get('confirmed', False)
 
     def verify_pin(self, uuid, pin):
@@ -199,15 +305,60 @@ class SolitudeAPI(SlumberWrapper):
 
         res = self.safe_run(self.slumber.generic.verify_pin.post,
                             {'uuid': uuid, 'pin': pin})
+        forget_buyer(uuid)
         return res
 
-    def get_transaction(self, uuid):
-        transaction = self.slumber.generic.transaction.get_object(uuid=uuid)
-        # Notes may contain some JSON, including the original pay request.
-        notes = transaction['notes']
-        if notes:
-            transaction['notes'] = json.loads(notes)
-        return transaction
+    def get_transaction(self, uuid, fresh=False):
+        """
+        Return a Transaction.
+
+        Ended transactions are cached for TRANSACTION_CACHE_TIMEOUT seconds
+        and others, which could change at any time, for
+        TRANSACTION_CACHE_PENDING_TIMEOUT seconds.
+
+        :param fresh: if True the transaction is always fetched from
+                      solitude, it is still cached afterwards.
+        """
+        key = TRANSACTION_KEY % uuid
+        if not fresh:
+            transaction = cache.get(key)
+            statsd.incr('cache.solitude.transaction.{0}'
+                        .format('miss' if transaction is None else 'hit'))
+            if transaction is not None:
+                return Transaction(transaction)
+
+        transaction = self.retry(
+            lambda: self.slumber.generic.transaction.get_object(uuid=uuid),
+            TRANSACTION_RETRY)
+
+        if transaction.get('status') in solitude_const.STATUS_ENDED:
+            timeout = settings.TRANSACTION_CACHE_TIMEOUT
+        else:
+            timeout = settings.TRANSACTION_CACHE_PENDING_TIMEOUT
+        if timeout:
+            # Cached with the notes still encoded, they are smaller that way.
+            cache.set(key, transaction, timeout)
+        return Transaction(transaction)
+
+
+class Transaction(dict):
+    """
+    A transaction from solitude.
+
+    Notes may contain some JSON, including the original pay request, which is
+    only decoded the first time the notes are used. Most callers just want
+    the status.
+    """
+
+    def __getitem__(self, key):
+        value = super(Transaction, self).__getitem__(key)
+        if key == 'notes' and value and isinstance(value, basestring):
+            value = json.loads(value)
+            self['notes'] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
 
 
 class ProviderHelper:
@@ -261,15 +412,71 @@ class ProviderHelper:
                           mcc=None, mnc=None):
         """
         Start a payment provider transaction to begin the purchase flow.
+
+        Returns a tuple of (transaction ID, payment start URL, generic
+        seller id, generic transaction). The generic transaction is None
+        when the provider doesn't return it.
+        """
+        # The buyer doesn't depend on the seller and product lookups so
+        # they can be made at the same time.
+        generic_buyer, products = run_parallel(
+            lambda: self.get_buyer(user_uuid),
+            lambda: self.find_product(generic_seller_uuid, product_id))
+        generic_seller, product, provider_product, found = products
+        generic_seller_id = generic_seller['resource_pk']
+        log.info('{pr}: starting transaction {tr}: generic seller: {sel}'
+                 .format(tr=transaction_uuid, sel=generic_seller_id,
+                         pr=self.provider.name))
+
+        if not found:
+            product, provider_product = self.create_product(
+                external_id=product_id, product_name=product_name,
+                generic_seller=generic_seller, generic_product=product,
+                provider_seller_uuid=provider_seller_uuid)
+
+        trans_token, pay_url, transaction = self.provider.create_transaction(
+            generic_buyer=generic_buyer,
+            generic_seller=generic_seller,
+            generic_product=product,
+            provider_product=provider_product,
+            provider_seller_uuid=provider_seller_uuid,
+            product_name=product_name,
+            transaction_uuid=transaction_uuid,
+            prices=prices,
+            user_uuid=user_uuid,
+            application_size=application_size,
+            source=source,
+            icon_url=icon_url,
+            mcc=mcc,
+            mnc=mnc,
+        )
+        log.info('{pr}: made provider trans {trans}'
+                 .format(trans=trans_token, pr=self.provider.name))
+
+        return trans_token, pay_url, generic_seller_id, transaction
+
+    def get_buyer(self, user_uuid):
+        """
+        Returns the generic buyer or raises BuyerNotConfigured.
         """
         try:
-            generic_buyer = self.slumber.generic.buyer.get_object_or_404(
+            return self.slumber.generic.buyer.get_object_or_404(
                 uuid=user_uuid)
         except ObjectDoesNotExist:
             raise BuyerNotConfigured(
                 '{pr}: Buyer with uuid {u} does not exist'
                 .format(u=user_uuid, pr=self.provider.name))
 
+    def find_product(self, generic_seller_uuid, product_id):
+        """
+        Looks up the generic seller, the generic product and the provider
+        product. Raises SellerNotConfigured if the seller doesn't exist.
+
+        Returns a tuple of (generic_seller, generic_product,
+        provider_product, found). When found is False the products still
+        have to be created, the generic product is None if it doesn't exist
+        either.
+        """
         try:
             generic_seller = self.slumber.generic.seller.get_object_or_404(
                 uuid=generic_seller_uuid)
@@ -277,19 +484,21 @@ class ProviderHelper:
             raise SellerNotConfigured(
                 '{pr}: Seller with uuid {u} does not exist'
                 .format(u=generic_seller_uuid, pr=self.provider.name))
-        generic_seller_id = generic_seller['resource_pk']
-        log.info('{pr}: starting transaction {tr}: generic seller: {sel}'
-                 .format(tr=transaction_uuid, sel=generic_seller_id,
-                         pr=self.provider.name))
         log.info('{pr}: get product for seller_uuid={uuid} external_id={ext}'
                  .format(pr=self.provider.name,
                          uuid=generic_seller_uuid, ext=product_id))
 
+        cached = self.cached_product(generic_seller_uuid, product_id)
+        if cached:
+            log.info('{pr}: using cached products {prod}'
+                     .format(pr=self.provider.name, prod=cached))
+            return (generic_seller,) + tuple(cached) + (True,)
+
         product = None
         try:
             product = self.slumber.generic.product.get_object_or_404(
                 external_id=product_id,
-                seller=generic_seller_id,
+                seller=generic_seller['resource_pk'],
             )
             log.info('{pr}: found generic product {prod}'
                      .format(pr=self.provider.name, prod=product))
@@ -298,31 +507,35 @@ class ProviderHelper:
             log.info('{pr}: found provider product {prod}'
                      .format(prod=provider_product, pr=self.provider.name))
         except ObjectDoesNotExist:
-            product, provider_product = self.create_product(
-                external_id=product_id, product_name=product_name,
-                generic_seller=generic_seller, generic_product=product,
-                provider_seller_uuid=provider_seller_uuid)
+            return generic_seller, product, None, False
 
-        trans_token, pay_url = self.provider.create_transaction(
-            generic_buyer=generic_buyer,
-            generic_seller=generic_seller,
-            generic_product=product,
-            provider_product=provider_product,
-            provider_seller_uuid=provider_seller_uuid,
-            product_name=product_name,
-            transaction_uuid=transaction_uuid,
-            prices=prices,
-            user_uuid=user_uuid,
-            application_size=application_size,
-            source=source,
-            icon_url=icon_url,
-            mcc=mcc,
-            mnc=mnc,
-        )
-        log.info('{pr}: made provider trans {trans}'
-                 .format(trans=trans_token, pr=self.provider.name))
+        if settings.PRODUCT_CACHE_TIMEOUT:
+            self.cache_product(generic_seller_uuid, product_id,
+                               product, provider_product)
+        return generic_seller, product, provider_product, True
+
+    def _product_key(self, generic_seller_uuid, external_id):
+        # External ids come from apps, so hash them into a safe cache key.
+        key = u'{0}:{1}:{2}'.format(self.provider.name, generic_seller_uuid,
+                                    external_id)
+        return 'product:%s' % hashlib.md5(key.encode('utf8')).hexdigest()
 
-        return trans_token, pay_url, generic_seller_id
+    def cached_product(self, generic_seller_uuid, external_id):
+        """
+        Returns the cached (generic_product, provider_product) of a seller's
+        product or None.
+        """
+        if not settings.PRODUCT_CACHE_TIMEOUT:
+            return None
+        return product_cache.get(
+            self._product_key(generic_seller_uuid, external_id))
+
+    def cache_product(self, generic_seller_uuid, external_id,
+                      generic_product, provider_product):
+        product_cache.set(
+            self._product_key(generic_seller_uuid, external_id),
+            (generic_product, provider_product),
+            settings.PRODUCT_CACHE_TIMEOUT)
 
     def create_product(self, external_id, product_name, generic_seller,
                        provider_seller_uuid, generic_product=None):
@@ -364,6 +577,9 @@ class ProviderHelper:
         log.info('{pr}: created provider product {prod}'
                  .format(prod=provider_product, pr=self.provider.name))
 
+        if settings.PRODUCT_CACHE_TIMEOUT:
+            self.cache_product(generic_seller['uuid'], external_id,
+                               generic_product, provider_product)
         return generic_product, provider_product
 
     def is_callback_token_valid(self, querystring):
@@ -411,6 +627,8 @@ class ProviderHelper:
                  'trans_id={trans}'.format(trans=trans_id,
                                            result=response['result']))
 
+        # Solitude has updated the transaction either way.
+        forget_transaction(trans_id)
         if response['result'] != 'OK':
             raise msg.DevMessage(msg.NOTICE_ERROR)
 
@@ -436,6 +654,7 @@ class ProviderHelper:
                       .format(pr=self.name, err=err))
             raise msg.DevMessage(msg.NOTICE_ERROR)
 
+        forget_transaction(transaction_uuid)
         return transaction_uuid
 
 
@@ -500,7 +719,10 @@ class PayProvider(object):
 
         Return the provider a tuple of:
 
-        (transaction ID, payment start URL)
+        (transaction ID, payment start URL, generic transaction)
+
+        The generic transaction is the resource returned by Solitude when it
+        was created, or None if the provider doesn't get it back.
         """
         raise NotImplementedError()
 
@@ -634,7 +856,7 @@ class ReferenceProvider(PayProvider):
         log.info('made solitude trans {trans}'.format(trans=trans))
 
         token = provider_trans['token']
-        return token, self._formatted_payment_url(token)
+        return token, self._formatted_payment_url(token), trans
 
     def get_seller(self, generic_seller, provider_seller_uuid):
         return (self.api.sellers
@@ -736,7 +958,8 @@ class BokuProvider(PayProvider):
         log.info('{pr}: made solitude trans {trans}'
                  .format(pr=self.name, trans=trans))
 
-        return provider_trans['transaction_id'], provider_trans['buy_url']
+        return (provider_trans['transaction_id'], provider_trans['buy_url'],
+                trans)
 
     def get_notification_data(self, request):
         return request.GET
@@ -856,7 +1079,8 @@ class BangoProvider(PayProvider):
                  'prices: {pr}'
                  .format(tr=transaction_uuid, bill=bill_id, pr=prices))
 
-        return bill_id, self._formatted_payment_url(bill_id)
+        # The generic transaction isn't part of the billing response.
+        return bill_id, self._formatted_payment_url(bill_id), None
 
     def transaction_from_notice(self, parsed_qs):
         raise NotImplementedError()
@@ -868,4 +1092,5 @@ if not settings.SOLITUDE_URL:
     client = None
 else:
     log.info('Using universal SolitudeAPI')
-    client = SolitudeAPI(settings.SOLITUDE_URL, settings.SOLITUDE_OAUTH)
+    client = SolitudeAPI(settings.SOLITUDE_URL, settings.SOLITUDE_OAUTH,
+                         settings.SOLITUDE_POOL)
@@ -1,17 +1,20 @@
 import json
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
 
 import mobile_codes
 import mock
-from nose.tools import eq_, raises
+from nose.tools import eq_, ok_, raises
 from slumber.exceptions import HttpClientError
 
-from lib.solitude.api import (BokuProvider, client,
-                              ProviderHelper, SellerNotConfigured)
+from lib.solitude.api import (BokuProvider, buyer_cache, client,
+                              end_buyer_memo, forget_transaction,
+                              product_cache, ProviderHelper,
+                              SellerNotConfigured, start_buyer_memo)
 from lib.solitude import constants
 from lib.solitude.exceptions import ResourceModified, ResourceNotModified
 from webpay.base import dev_messages as msg
@@ -30,6 +33,8 @@ class SolitudeAPITest(TestCase):
             'resource_pk': '5678',
             'etag': 'etag:test'
         }
+        cache.clear()
+        buyer_cache.local.clear()
 
     def create_error_response(self, status_code=400, content=None):
         if content is None:
@@ -299,6 +304,46 @@ class SolitudeAPITest(TestCase):
                                         'pin_was_locked_out': False},
                                        headers={'If-Match': ''})
 
+    def test_get_buyer_caches_pk(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        eq_(cache.get('buyer_pk:%s' % self.uuid), '5678')
+
+    def test_create_buyer_caches_pk(self, slumber):
+        slumber.generic.buyer.post.return_value = self.buyer_data
+        client.create_buyer(self.uuid, self.email)
+        eq_(cache.get('buyer_pk:%s' % self.uuid), '5678')
+
+    def test_update_buyer_cached_pk(self, slumber):
+        cache.set('buyer_pk:%s' % self.uuid, '5678')
+        buyer = self.setup_buyer(slumber)
+        eq_(client.change_pin(self.uuid, '1234'), {})
+        assert not slumber.generic.buyer.get_object_or_404.called
+        slumber.generic.buyer.assert_called_with(id='5678')
+        buyer.patch.assert_called_with({'pin': '1234', 'pin_confirmed': False},
+                                       headers={'If-Match': ''})
+
+    def test_update_buyer_stale_pk(self, slumber):
+        cache.set('buyer_pk:%s' % self.uuid, 'stale')
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        buyer = self.setup_buyer(slumber)
+        buyer.patch.side_effect = [
+            HttpClientError(response=self.create_error_response(
+                status_code=404, content={})),
+            {}]
+        eq_(client.change_pin(self.uuid, '1234'), {})
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 1)
+        slumber.generic.buyer.assert_called_with(id='5678')
+        eq_(cache.get('buyer_pk:%s' % self.uuid), '5678')
+
+    def test_update_buyer_forgets_etag(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        self.setup_buyer(slumber)
+        client.get_buyer(self.uuid)
+        client.change_pin(self.uuid, '1234')
+        eq_(buyer_cache.get('etag:%s' % self.uuid), None)
+        eq_(cache.get('etag:%s' % self.uuid), None)
+
     def test_set_needs_pin_reset(self, slumber):
         buyer = mock.Mock(return_value=self.buyer_data)
         buyer.patch.return_value = {}
@@ -352,6 +397,54 @@ class SolitudeAPITest(TestCase):
             client.set_needs_pin_reset(self.uuid, False, etag=wrong_etag)
 
 
+@mock.patch('lib.solitude.api.client.slumber')
+class TestBuyerMemo(TestCase):
+
+    def setUp(self):
+        self.uuid = 'memo:uuid'
+        self.buyer_data = {'uuid': self.uuid, 'resource_pk': '5678'}
+        start_buyer_memo()
+
+    def tearDown(self):
+        end_buyer_memo()
+
+    def test_memo(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 1)
+
+    def test_no_memo(self, slumber):
+        end_buyer_memo()
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 2)
+
+    def test_update_forgets(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        client.get_buyer(self.uuid)
+        client.change_pin(self.uuid, '1234')
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 2)
+
+    def test_verify_forgets(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        slumber.generic.verify_pin.post.return_value = {'valid': True}
+        client.get_buyer(self.uuid)
+        client.verify_pin(self.uuid, '1234')
+        client.get_buyer(self.uuid)
+        eq_(slumber.generic.buyer.get_object_or_404.call_count, 2)
+
+    def test_create_forgets(self, slumber):
+        slumber.generic.buyer.get_object_or_404.return_value = {}
+        slumber.generic.buyer.post.return_value = self.buyer_data
+        eq_(client.get_buyer(self.uuid), {})
+        client.create_buyer(self.uuid, 'buyer@buying.com')
+        slumber.generic.buyer.get_object_or_404.return_value = self.buyer_data
+        eq_(client.get_buyer(self.uuid), self.buyer_data)
+
+
 class TestBango(TestCase):
     uuid = 'some:pin'
     seller = {'bango': {'seller': 's', 'resource_uri': 'r',
@@ -410,7 +503,7 @@ class TestBango(TestCase):
             'billingConfigurationId': 'bill_id'}
         slumber.bango.product.get_object_or_404.side_effect = (
             ObjectDoesNotExist)
-        trans_id, pay_url, seller_uuid = self.start()
+        trans_id, pay_url, seller_uuid, trans = self.start()
         eq_(trans_id, 'bill_id')
 
     def test_with_bango_product(self):
@@ -420,8 +513,9 @@ class TestBango(TestCase):
             'billingConfigurationId': 'bill_id'}
         slumber.bango.product.get_object.return_value = {
             'resource_uri': 'foo'}
-        trans_id, pay_url, seller_uuid = self.start()
+        trans_id, pay_url, seller_uuid, trans = self.start()
         eq_(trans_id, 'bill_id')
+        eq_(trans, None)
 
     def test_pay_url(self):
         bill_id = '123'
@@ -433,7 +527,7 @@ class TestBango(TestCase):
         with self.settings(
             PAY_URLS={'bango': {'base': 'http://bango',
                                 'pay': '/pay?bcid={uid_pay}'}}):
-            trans_id, pay_url, seller_uuid = self.start()
+            trans_id, pay_url, seller_uuid, trans = self.start()
 
         eq_(pay_url, 'http://bango/pay?bcid={b}'.format(b=bill_id))
 
@@ -507,7 +601,7 @@ class TestReferenceProvider(ProviderTestCase):
             'resource_uri': self.buyer_uri,
         }
 
-        trans_id, pay_url, seller_id = self.configure(
+        trans_id, pay_url, seller_id, trans = self.configure(
             seller_uuid=self.seller_uuid, product_uuid=self.product_uuid)
 
         eq_(trans_id, 'zippy-trans-token')
@@ -535,6 +629,56 @@ class TestReferenceProvider(ProviderTestCase):
             'uuid': 'trans-xyz',
         })
 
+    def test_returns_transaction(self):
+        self.slumber.provider.reference.transactions.post.return_value = {
+            'token': 'zippy-trans-token',
+        }
+        self.slumber.generic.transaction.post.return_value = {
+            'resource_pk': 7,
+        }
+        trans = self.configure(seller_uuid=self.seller_uuid,
+                               product_uuid=self.product_uuid)[3]
+        eq_(trans, {'resource_pk': 7})
+
+    def test_cached_product(self):
+        cache.clear()
+        product_cache.local.clear()
+        self.slumber.provider.reference.transactions.post.return_value = {
+            'token': 'zippy-trans-token',
+        }
+        with self.settings(PRODUCT_CACHE_TIMEOUT=60):
+            for x in range(2):
+                self.configure(seller_uuid=self.seller_uuid,
+                               product_uuid=self.product_uuid)
+
+        eq_(self.slumber.generic.product.get_object_or_404.call_count, 1)
+        eq_(self.slumber.provider.reference.products
+                                 .get_object_or_404.call_count, 1)
+        eq_(self.slumber.generic.seller.get_object_or_404.call_count, 2)
+
+    def test_created_product_cached(self):
+        cache.clear()
+        product_cache.local.clear()
+        (self.slumber.generic.product.get_object_or_404
+                                     .side_effect) = ObjectDoesNotExist
+        self.slumber.generic.product.post.return_value = {
+            'external_id': self.product_uuid,
+            'resource_uri': self.product_uri,
+        }
+        self.slumber.provider.reference.products.post.return_value = {
+            'reference': {'uuid': 'new-product'},
+        }
+        self.slumber.provider.reference.transactions.post.return_value = {
+            'token': 'zippy-trans-token',
+        }
+        with self.settings(PRODUCT_CACHE_TIMEOUT=60):
+            for x in range(2):
+                self.configure(seller_uuid=self.seller_uuid,
+                               product_uuid=self.product_uuid)
+
+        eq_(self.slumber.generic.product.get_object_or_404.call_count, 1)
+        eq_(self.slumber.generic.product.post.call_count, 1)
+
     def test_with_new_prod(self):
         name = u'Ivan Krsti\u0107'
         new_product_uuid = 'new-product'
@@ -662,7 +806,7 @@ class TestBoku(ProviderTestCase):
             'transaction_id': boku_transaction_id,
         }
 
-        trans_id, pay_url, seller_uuid = self.configure(
+        trans_id, pay_url, seller_uuid, trans = self.configure(
             seller_uuid=self.seller_uuid, user_uuid=user_uuid,
             provider_seller_uuid=provider_seller_uuid)
 
@@ -706,7 +850,7 @@ class TestBoku(ProviderTestCase):
             'transaction_id': 'boku-trans-id',
         }
 
-        trans_id, pay_url, seller_uuid = self.configure(
+        trans_id, pay_url, seller_uuid, trans = self.configure(
             seller_uuid=seller_uuid, product_uuid=external_id)
 
         # Make sure the new in-app product was created.
@@ -747,6 +891,71 @@ class TransactionTest(TestCase):
         trans = client.get_transaction('x')
         eq_(trans['notes'], {'foo': 'bar'})
 
+    def test_notes_decoded_when_used(self, slumber):
+        slumber.generic.transaction.get_object.return_value = {
+            'notes': json.dumps({'foo': 'bar'}),
+            'status': constants.STATUS_PENDING
+        }
+        trans = client.get_transaction('x')
+        with mock.patch('lib.solitude.api.json') as json_:
+            eq_(trans['status'], constants.STATUS_PENDING)
+            ok_(not json_.loads.called)
+        eq_(trans.get('notes'), {'foo': 'bar'})
+        eq_(dict.get(trans, 'notes'), {'foo': 'bar'})
+
+    def test_empty_notes(self, slumber):
+        slumber.generic.transaction.get_object.return_value = {'notes': ''}
+        trans = client.get_transaction('x')
+        eq_(trans['notes'], '')
+        eq_(trans.get('missing', 1), 1)
+
+
+@mock.patch.object(settings, 'TRANSACTION_CACHE_TIMEOUT', 3600)
+@mock.patch.object(settings, 'TRANSACTION_CACHE_PENDING_TIMEOUT', 2)
+@mock.patch('lib.solitude.api.client.slumber')
+class TestTransactionCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, slumber, status, **kw):
+        get_object = slumber.generic.transaction.get_object
+        get_object.return_value = {'notes': json.dumps({'foo': 'bar'}),
+                                   'status': status}
+        return client.get_transaction('x', **kw)
+
+    def test_cached(self, slumber):
+        self.get(slumber, constants.STATUS_COMPLETED)
+        trans = self.get(slumber, constants.STATUS_COMPLETED)
+        eq_(trans['notes'], {'foo': 'bar'})
+        eq_(slumber.generic.transaction.get_object.call_count, 1)
+
+    def test_fresh(self, slumber):
+        self.get(slumber, constants.STATUS_COMPLETED)
+        self.get(slumber, constants.STATUS_COMPLETED, fresh=True)
+        eq_(slumber.generic.transaction.get_object.call_count, 2)
+
+    def test_forget(self, slumber):
+        self.get(slumber, constants.STATUS_PENDING)
+        forget_transaction('x')
+        self.get(slumber, constants.STATUS_PENDING)
+        eq_(slumber.generic.transaction.get_object.call_count, 2)
+
+    @mock.patch('lib.solitude.api.cache')
+    def test_timeouts(self, cache_, slumber):
+        cache_.get.return_value = None
+        self.get(slumber, constants.STATUS_PENDING)
+        eq_(cache_.set.call_args[0][2], 2)
+        for status in constants.STATUS_ENDED:
+            self.get(slumber, status)
+            eq_(cache_.set.call_args[0][2], 3600)
+
+    def test_disabled(self, slumber):
+        with self.settings(TRANSACTION_CACHE_PENDING_TIMEOUT=0):
+            self.get(slumber, constants.STATUS_PENDING)
+            self.get(slumber, constants.STATUS_PENDING)
+        eq_(slumber.generic.transaction.get_object.call_count, 2)
+
 
 @mock.patch.object(settings, 'PAYMENT_PROVIDER', 'bango')
 class TestProviderHelper(TestCase):
@@ -0,0 +1,559 @@
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+
+import mock
+from nose.tools import eq_, ok_, raises
+from requests.exceptions import Timeout
+
+from lib import breaker
+from lib.breaker import CircuitBreaker, CircuitOpen, family, get_breaker
+from lib.caching import LRU, TieredCache
+from lib.concurrency import run_parallel, SingleFlight
+from lib.transport import (DeadlineExceeded, DEFAULT_POOL, HTTPAdapter,
+                           KeepAliveAdapter, PooledAdapter, pooled_session,
+                           stats_path,
+                           StatsHTTPConnectionPool, StatsHTTPSConnectionPool)
+from lib.utils import RetryPolicy, SlumberWrapper
+from webpay.base import logger
+
+
+class TestPooledSession(TestCase):
+
+    def test_adapters(self):
+        session = pooled_session('solitude')
+        for prefix in ['http://', 'https://']:
+            adapter = session.adapters[prefix]
+            ok_(isinstance(adapter, PooledAdapter))
+            eq_(adapter.name, 'solitude')
+            eq_(adapter._pool_maxsize, DEFAULT_POOL['maxsize'])
+
+    def test_config(self):
+        session = pooled_session('marketplace', {'maxsize': 3,
+                                                 'idle_timeout': 5})
+        adapter = session.adapters['https://']
+        eq_(adapter._pool_maxsize, 3)
+        eq_(adapter._pool_connections, DEFAULT_POOL['connections'])
+        eq_(adapter.idle_timeout, 5)
+
+    def test_adapter_class(self):
+        session = pooled_session('postback', adapter_class=KeepAliveAdapter)
+        adapter = session.adapters['https://']
+        ok_(not isinstance(adapter, PooledAdapter))
+        eq_(adapter.name, 'postback')
+
+    def test_pool_classes(self):
+        manager = pooled_session('solitude').adapters['http://'].poolmanager
+        ok_(isinstance(manager.connection_from_url('http://f.com/'),
+                       StatsHTTPConnectionPool))
+        ok_(isinstance(manager.connection_from_url('https://f.com/'),
+                       StatsHTTPSConnectionPool))
+
+
+@mock.patch('lib.transport.statsd')
+class TestStatsPool(TestCase):
+
+    def setUp(self):
+        self.pool = StatsHTTPConnectionPool('f.com', stats_name='solitude',
+                                            maxsize=2, idle_timeout=10)
+
+    def incrs(self, statsd):
+        return [c[0][0] for c in statsd.incr.call_args_list]
+
+    def test_miss_then_hit(self, statsd):
+        conn = self.pool._get_conn()
+        self.pool._put_conn(conn)
+        eq_(self.pool._get_conn(), conn)
+        eq_(self.incrs(statsd), ['upstream.solitude.pool.miss',
+                                 'upstream.solitude.pool.hit'])
+        eq_(statsd.timing.call_args[0][0], 'upstream.solitude.pool.wait')
+
+    def test_in_use(self, statsd):
+        conn = self.pool._get_conn()
+        eq_(self.pool.in_use, 1)
+        self.pool._put_conn(conn)
+        eq_(self.pool.in_use, 0)
+        statsd.gauge.assert_called_with('upstream.solitude.pool.in_use', 0)
+
+    def test_evict_idle(self, statsd):
+        conn = self.pool._get_conn()
+        self.pool._put_conn(conn)
+        conn.idle_since = time.time() - 11
+        with mock.patch.object(conn, 'close') as close:
+            # It is closed and reconnects when it is used.
+            eq_(self.pool._get_conn(), conn)
+        ok_(close.called)
+        ok_('upstream.solitude.pool.evicted' in self.incrs(statsd))
+        eq_(self.pool.pool.qsize(), 1)
+
+    def test_evict_only_taken(self, statsd):
+        first = self.pool._get_conn()
+        second = self.pool._get_conn()
+        self.pool._put_conn(first)
+        self.pool._put_conn(second)
+        first.idle_since = time.time() - 11
+        with mock.patch.object(first, 'close') as close:
+            eq_(self.pool._get_conn(), second)
+            ok_(not close.called)
+            eq_(self.pool._get_conn(), first)
+            ok_(close.called)
+
+    def test_keep_recent(self, statsd):
+        conn = self.pool._get_conn()
+        self.pool._put_conn(conn)
+        eq_(self.pool._get_conn(), conn)
+        ok_('upstream.solitude.pool.evicted' not in self.incrs(statsd))
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.started.set()
+        self.release.wait(5)
+        return value
+
+    def test_result(self):
+        eq_(self.flight.do('k', lambda: 'v'), 'v')
+        eq_(self.flight._calls, {})
+
+    def test_coalesce(self):
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(self.flight.do('k', self.slow, 1)))
+        leader.start()
+        self.started.wait(5)
+        follower = threading.Thread(
+            target=lambda: results.append(self.flight.do('k', self.slow, 2)))
+        follower.start()
+        time.sleep(0.05)
+        self.release.set()
+        leader.join(5)
+        follower.join(5)
+        eq_(results, [1, 1])
+        eq_(self.calls, [1])
+
+    def test_different_keys(self):
+        self.release.set()
+        eq_(self.flight.do('a', self.slow, 1), 1)
+        eq_(self.flight.do('b', self.slow, 2), 2)
+        eq_(self.calls, [1, 2])
+
+    @raises(ValueError)
+    def test_error(self):
+        def fail():
+            raise ValueError
+        self.flight.do('k', fail)
+
+
+class TestLRU(TestCase):
+
+    def setUp(self):
+        self.lru = LRU(maxsize=2, timeout=10)
+
+    def test_get_set(self):
+        self.lru.set('a', 1)
+        eq_(self.lru.get('a'), 1)
+        eq_(self.lru.get('b'), None)
+
+    def test_evict_oldest(self):
+        self.lru.set('a', 1)
+        self.lru.set('b', 2)
+        self.lru.get('a')
+        self.lru.set('c', 3)
+        eq_(self.lru.get('b'), None)
+        eq_(self.lru.get('a'), 1)
+        eq_(len(self.lru), 2)
+
+    @mock.patch('lib.caching.time')
+    def test_expire(self, time_):
+        time_.time.return_value = 100
+        self.lru.set('a', 1, timeout=5)
+        time_.time.return_value = 106
+        eq_(self.lru.get('a'), None)
+
+    def test_copies(self):
+        value = {'a': 1}
+        self.lru.set('a', value)
+        value['a'] = 2
+        self.lru.get('a')['a'] = 3
+        eq_(self.lru.get('a'), {'a': 1})
+
+
+@mock.patch('lib.caching.statsd')
+class TestTieredCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cache = TieredCache('test')
+
+    def incrs(self, statsd):
+        return [c[0][0] for c in statsd.incr.call_args_list]
+
+    def test_local_hit(self, statsd):
+        self.cache.set('a', 1)
+        eq_(self.cache.get('a'), 1)
+        eq_(self.incrs(statsd), ['cache.test.local.hit'])
+
+    def test_shared_hit(self, statsd):
+        cache.set('a', 1)
+        eq_(self.cache.get('a'), 1)
+        eq_(self.cache.local.get('a'), 1)
+        eq_(self.incrs(statsd), ['cache.test.local.miss',
+                                 'cache.test.shared.hit'])
+
+    def test_miss(self, statsd):
+        eq_(self.cache.get('a'), None)
+        eq_(self.incrs(statsd), ['cache.test.local.miss',
+                                 'cache.test.shared.miss'])
+
+    def test_delete(self, statsd):
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+        eq_(self.cache.local.get('a'), None)
+        eq_(cache.get('a'), None)
+
+
+class TestRunParallel(TestCase):
+
+    def setUp(self):
+        logger._local.TRANSACTION_ID = 'trans:1'
+        self.addCleanup(logger.set_context, {})
+
+    def test_results(self):
+        eq_(run_parallel(lambda: 1, lambda: 2, lambda: 3), [1, 2, 3])
+
+    def test_threads(self):
+        threads = run_parallel(threading.current_thread,
+                               threading.current_thread)
+        ok_(threading.current_thread() not in threads)
+
+    def test_serial(self):
+        with self.settings(PARALLEL_UPSTREAM_CALLS=False):
+            eq_(run_parallel(threading.current_thread,
+                             threading.current_thread),
+                [threading.current_thread()] * 2)
+
+    def test_context(self):
+        eq_(run_parallel(logger.get_transaction_id,
+                         logger.get_transaction_id), ['trans:1'] * 2)
+
+    def test_nested(self):
+        def nested():
+            return run_parallel(threading.current_thread,
+                                threading.current_thread)
+        for outer in run_parallel(nested, nested):
+            eq_(outer[0], outer[1])
+
+    def test_first_error(self):
+        def fail(exc):
+            def inner():
+                raise exc
+            return inner
+        with self.assertRaises(KeyError):
+            run_parallel(lambda: 1, fail(KeyError), fail(ValueError))
+
+
+@mock.patch('lib.breaker.statsd')
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('solitude.buyer')
+        p = self.settings(CIRCUIT_BREAKER_FAILURES=2, CIRCUIT_BREAKER_RESET=30)
+        p.enable()
+        self.addCleanup(p.disable)
+
+    def open(self):
+        self.breaker.failure()
+        self.breaker.failure()
+
+    def test_opens(self, statsd):
+        self.breaker.failure()
+        eq_(self.breaker.state, breaker.CLOSED)
+        self.breaker.failure()
+        eq_(self.breaker.state, breaker.OPEN)
+        statsd.incr.assert_called_with(
+            'upstream.solitude.buyer.breaker.opened')
+        statsd.gauge.assert_called_with('upstream.solitude.buyer.breaker', 2)
+
+    def test_success_resets(self, statsd):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        eq_(self.breaker.state, breaker.CLOSED)
+
+    @raises(CircuitOpen)
+    def test_rejects(self, statsd):
+        self.open()
+        self.breaker.before()
+
+    @mock.patch('lib.breaker.time')
+    def test_probe(self, time_, statsd):
+        time_.time.return_value = 100
+        self.open()
+        time_.time.return_value = 131
+        self.breaker.before()
+        eq_(self.breaker.state, breaker.HALF_OPEN)
+        # Only one probe is let through at a time.
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+        self.breaker.success()
+        eq_(self.breaker.state, breaker.CLOSED)
+
+    @mock.patch('lib.breaker.time')
+    def test_probe_fails(self, time_, statsd):
+        time_.time.return_value = 100
+        self.open()
+        time_.time.return_value = 131
+        self.breaker.before()
+        self.breaker.failure()
+        eq_(self.breaker.state, breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+
+    @mock.patch('lib.breaker.time')
+    def test_probe_lost(self, time_, statsd):
+        time_.time.return_value = 100
+        self.open()
+        time_.time.return_value = 131
+        self.breaker.before()
+        # The probe never reports back.
+        time_.time.return_value = 160
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+        time_.time.return_value = 161
+        self.breaker.before()
+        eq_(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.success()
+        eq_(self.breaker.state, breaker.CLOSED)
+
+    def test_disabled(self, statsd):
+        with self.settings(CIRCUIT_BREAKER_FAILURES=0):
+            self.open()
+            self.breaker.before()
+        eq_(self.breaker.state, breaker.CLOSED)
+
+
+class TestBreakerFamily(TestCase):
+
+    def test_family(self):
+        eq_(family('http://sol/generic/buyer/1/'), 'buyer')
+        eq_(family('http://sol/bango/billing/'), 'bango')
+        eq_(family('http://mkt/api/v1/webpay/prices/'), 'webpay')
+        eq_(family('http://sol/'), 'root')
+
+    def test_get_breaker(self):
+        self.addCleanup(breaker.reset_breakers)
+        buyer = get_breaker('solitude', 'http://sol/generic/buyer/1/')
+        eq_(buyer.name, 'solitude.buyer')
+        ok_(get_breaker('solitude', 'http://sol/generic/buyer/') is buyer)
+        eq_(breaker.breaker_states(), {'solitude.buyer': breaker.CLOSED})
+
+
+@mock.patch.object(HTTPAdapter, 'send')
+class TestPooledAdapterBreaker(TestCase):
+
+    def setUp(self):
+        self.addCleanup(breaker.reset_breakers)
+        self.adapter = PooledAdapter('solitude')
+        self.request = mock.Mock(url='http://sol/generic/buyer/')
+        p = self.settings(CIRCUIT_BREAKER_FAILURES=1)
+        p.enable()
+        self.addCleanup(p.disable)
+
+    def state(self):
+        return get_breaker('solitude', self.request.url).state
+
+    def test_server_error(self, send):
+        send.return_value = mock.Mock(status_code=500)
+        self.adapter.send(self.request)
+        eq_(self.state(), breaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.adapter.send(self.request)
+        eq_(send.call_count, 1)
+
+    def test_connection_error(self, send):
+        send.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.adapter.send(self.request)
+        eq_(self.state(), breaker.OPEN)
+
+    def test_client_error(self, send):
+        send.return_value = mock.Mock(status_code=404)
+        self.adapter.send(self.request)
+        eq_(self.state(), breaker.CLOSED)
+
+
+class TestStatsPath(TestCase):
+
+    def test_paths(self):
+        eq_(stats_path('http://sol/generic/buyer/'), 'generic.buyer')
+        eq_(stats_path('http://sol/generic/buyer/12/?uuid=x'), 'generic.buyer')
+        eq_(stats_path('http://sol/bango/billing/'), 'bango.billing')
+        eq_(stats_path('http://mkt/api/v1/webpay/prices/'), 'webpay.prices')
+        eq_(stats_path('http://sol/'), 'root')
+
+
+@mock.patch('lib.transport.statsd')
+@mock.patch.object(HTTPAdapter, 'send')
+class TestPooledAdapterTiming(TestCase):
+
+    def setUp(self):
+        self.adapter = PooledAdapter('solitude')
+        self.request = mock.Mock(url='http://sol/generic/buyer/1/',
+                                 method='PATCH')
+
+    def test_status(self, send, statsd):
+        send.return_value = mock.Mock(status_code=201)
+        self.adapter.send(self.request)
+        eq_(statsd.timing.call_args[0][0],
+            'upstream.solitude.patch.generic.buyer.2xx')
+
+    def test_error(self, send, statsd):
+        send.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.adapter.send(self.request)
+        eq_(statsd.timing.call_args[0][0],
+            'upstream.solitude.patch.generic.buyer.error')
+
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(backoff=1, max_backoff=3)
+
+    def test_can_retry(self):
+        ok_(self.policy.can_retry('get'))
+        ok_(not self.policy.can_retry('POST'))
+        ok_(self.policy.can_retry('PATCH', {'If-Match': 'etag'}))
+
+    @mock.patch('lib.utils.random')
+    def test_delay(self, random):
+        random.uniform.side_effect = lambda low, high: high
+        eq_([self.policy.delay(r) for r in range(1, 5)], [1, 2, 3, 3])
+
+
+@mock.patch('lib.utils.statsd')
+@mock.patch('lib.utils.time')
+class TestRetry(TestCase):
+
+    def setUp(self):
+        self.wrapper = SlumberWrapper('http://sol/', {})
+        self.policy = RetryPolicy(attempts=3, backoff=0.1, errors=(KeyError,))
+        self.command = mock.Mock()
+
+    def test_success(self, time_, statsd):
+        time_.time.side_effect = time.time
+        self.command.side_effect = [KeyError, 'ok']
+        eq_(self.wrapper.retry(self.command, self.policy), 'ok')
+        eq_(time_.sleep.call_count, 1)
+        statsd.incr.assert_called_with('upstream.upstream.retry')
+
+    def test_exhausted(self, time_, statsd):
+        time_.time.side_effect = time.time
+        self.command.side_effect = KeyError
+        with self.assertRaises(KeyError):
+            self.wrapper.retry(self.command, self.policy)
+        eq_(self.command.call_count, 3)
+        statsd.incr.assert_called_with('upstream.upstream.retry.exhausted')
+
+    def test_other_errors(self, time_, statsd):
+        self.command.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.wrapper.retry(self.command, self.policy)
+        eq_(self.command.call_count, 1)
+
+    def test_not_idempotent(self, time_, statsd):
+        self.command.side_effect = KeyError
+        with self.assertRaises(KeyError):
+            self.wrapper.retry(self.command, self.policy, method='POST')
+        eq_(self.command.call_count, 1)
+
+    @mock.patch('lib.utils.random')
+    def test_budget(self, random, time_, statsd):
+        time_.time.side_effect = time.time
+        random.uniform.side_effect = lambda low, high: high
+        self.policy.budget = 0.05
+        self.command.side_effect = KeyError
+        with self.assertRaises(KeyError):
+            self.wrapper.retry(self.command, self.policy)
+        eq_(self.command.call_count, 1)
+
+
+@mock.patch.object(HTTPAdapter, 'send')
+class TestPooledAdapterDeadline(TestCase):
+
+    def setUp(self):
+        self.addCleanup(breaker.reset_breakers)
+        self.addCleanup(logger.set_deadline, None)
+        self.adapter = PooledAdapter('solitude')
+        self.request = mock.Mock(url='http://sol/generic/buyer/',
+                                 method='GET')
+
+    def timeout(self, send):
+        return send.call_args[1]['timeout']
+
+    def test_no_deadline(self, send):
+        send.return_value = mock.Mock(status_code=200)
+        self.adapter.send(self.request, timeout=30)
+        eq_(self.timeout(send), 30)
+
+    def test_clamped(self, send):
+        send.return_value = mock.Mock(status_code=200)
+        logger.set_deadline(5)
+        self.adapter.send(self.request, timeout=30)
+        ok_(0 < self.timeout(send) <= 5)
+
+    def test_shorter_timeout(self, send):
+        send.return_value = mock.Mock(status_code=200)
+        logger.set_deadline(60)
+        self.adapter.send(self.request, timeout=3)
+        eq_(self.timeout(send), 3)
+
+    @raises(DeadlineExceeded)
+    @mock.patch('webpay.base.logger.time')
+    def test_expired(self, time_, send):
+        time_.time.return_value = 100
+        logger.set_deadline(5)
+        time_.time.return_value = 106
+        self.adapter.send(self.request)
+
+    def test_timed_out(self, send):
+        send.side_effect = Timeout
+        logger.set_deadline(5)
+        with self.settings(CIRCUIT_BREAKER_FAILURES=1):
+            with self.assertRaises(DeadlineExceeded):
+                self.adapter.send(self.request)
+            eq_(get_breaker('solitude', self.request.url).state,
+                breaker.CLOSED)
+
+    @mock.patch('lib.breaker.time')
+    def test_timed_out_probe(self, time_, send):
+        with self.settings(CIRCUIT_BREAKER_FAILURES=1,
+                           CIRCUIT_BREAKER_RESET=30):
+            time_.time.return_value = 100
+            send.return_value = mock.Mock(status_code=500)
+            self.adapter.send(self.request)
+            # The probe runs out of deadline.
+            time_.time.return_value = 131
+            send.side_effect = Timeout
+            logger.set_deadline(5)
+            with self.assertRaises(DeadlineExceeded):
+                self.adapter.send(self.request)
+            circuit = get_breaker('solitude', self.request.url)
+            eq_(circuit.state, breaker.OPEN)
+            # Another probe is tried after the reset period.
+            time_.time.return_value = 162
+            send.side_effect = None
+            send.return_value = mock.Mock(status_code=200)
+            logger.set_deadline(None)
+            self.adapter.send(self.request)
+            eq_(circuit.state, breaker.CLOSED)
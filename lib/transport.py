@@ -0,0 +1,255 @@
+"""
+Pooled keep-alive HTTP transport for the upstream API clients.
+
+Each SlumberWrapper gets its own requests session with an adapter that keeps
+connections to the upstream alive between calls and reports how the pool is
+used to statsd under ``upstream.<name>.pool``. Requests go through a circuit
+breaker per resource family, see lib.breaker.
+
+Within a web request upstream calls share the time left before the request
+deadline, see webpay.base.logger.set_deadline.
+
+Every request is timed under ``upstream.<name>.<method>.<path>.<status>``,
+for example ``upstream.solitude.get.generic.buyer.2xx``.
+"""
+import re
+import time
+import urlparse
+
+from django_statsd.clients import statsd
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+
+from lib.breaker import get_breaker
+from webpay.base import dev_messages as msg
+from webpay.base.logger import getLogger, remaining_time
+
+log = getLogger('lib.transport')
+
+# Path segments left out of the statsd keys: API prefixes and ids.
+UNTIMED_SEGMENTS = re.compile(r'^(api|v\d+|\d+|[0-9a-f-]{32,36})$', re.I)
+
+DEFAULT_POOL = {
+    # The number of hosts to keep a connection pool for.
+    'connections': 10,
+    # The number of connections to keep alive per host.
+    'maxsize': 10,
+    # If True, wait for a free connection when all of them are in use
+    # instead of opening a throwaway one.
+    'block': False,
+    # Close connections that have been idle for longer than this many
+    # seconds. Set to None to keep them forever.
+    'idle_timeout': 60,
+}
+
+
+class DeadlineExceeded(msg.DevMessage):
+    """
+    Raised when an upstream call can't be made, or finished, before the
+    deadline of the current request.
+    """
+
+    def __init__(self):
+        super(DeadlineExceeded, self).__init__(msg.INTERNAL_TIMEOUT)
+
+
+class StatsPoolMixin(object):
+    """
+    Counts connection pool hits and misses, times how long a caller waits for
+    a connection and closes connections that have been idle for too long.
+    """
+
+    def __init__(self, host, port=None, stats_name='upstream',
+                 idle_timeout=None, **kw):
+        super(StatsPoolMixin, self).__init__(host, port, **kw)
+        self.stats_prefix = 'upstream.{0}.pool'.format(stats_name)
+        self.idle_timeout = idle_timeout
+        self.in_use = 0
+
+    def _get_conn(self, timeout=None):
+        created = self.num_connections
+        start = time.time()
+        conn = super(StatsPoolMixin, self)._get_conn(timeout=timeout)
+        statsd.timing(self.stats_prefix + '.wait',
+                      (time.time() - start) * 1000)
+        if self.num_connections > created:
+            statsd.incr(self.stats_prefix + '.miss')
+        else:
+            statsd.incr(self.stats_prefix + '.hit')
+        self._evict_idle(conn)
+        self.in_use += 1
+        statsd.gauge(self.stats_prefix + '.in_use', self.in_use)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn:
+            conn.idle_since = time.time()
+        super(StatsPoolMixin, self)._put_conn(conn)
+        self.in_use = max(self.in_use - 1, 0)
+        statsd.gauge(self.stats_prefix + '.in_use', self.in_use)
+
+    def _evict_idle(self, conn):
+        """
+        Close conn, which was just taken from the pool, if it has been idle
+        for too long. Like a dropped connection it reconnects when it is
+        next used. Only the connection taken is looked at so that the pool
+        is never emptied to check the others; those are checked when they
+        are taken in turn.
+        """
+        idle_since = getattr(conn, 'idle_since', None)
+        if (not self.idle_timeout or idle_since is None or
+                time.time() - idle_since <= self.idle_timeout):
+            return
+        conn.close()
+        del conn.idle_since
+        log.info('Closed an idle connection to {0}'.format(self.host))
+        statsd.incr(self.stats_prefix + '.evicted')
+
+
+class StatsHTTPConnectionPool(StatsPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class StatsHTTPSConnectionPool(StatsPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class StatsPoolManager(PoolManager):
+    """
+    A PoolManager that hands out the instrumented connection pools.
+    """
+    pool_classes = {
+        'http': StatsHTTPConnectionPool,
+        'https': StatsHTTPSConnectionPool,
+    }
+
+    def __init__(self, num_pools=10, headers=None, stats_name='upstream',
+                 idle_timeout=None, **connection_pool_kw):
+        super(StatsPoolManager, self).__init__(num_pools=num_pools,
+                                               headers=headers,
+                                               **connection_pool_kw)
+        self.stats_name = stats_name
+        self.idle_timeout = idle_timeout
+
+    def _new_pool(self, scheme, host, port):
+        kwargs = self.connection_pool_kw
+        if scheme == 'http':
+            kwargs = self.connection_pool_kw.copy()
+            for kw in SSL_KEYWORDS:
+                kwargs.pop(kw, None)
+
+        return self.pool_classes[scheme](host, port,
+                                         stats_name=self.stats_name,
+                                         idle_timeout=self.idle_timeout,
+                                         **kwargs)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    A transport adapter that keeps connections alive using StatsPoolManager.
+
+    :param name: the name used for the statsd keys, e.g. solitude.
+    :param idle_timeout: seconds after which an idle connection is closed.
+    """
+    __attrs__ = HTTPAdapter.__attrs__ + ['name', 'idle_timeout']
+
+    def __init__(self, name, idle_timeout=None, **kw):
+        self.name = name
+        self.idle_timeout = idle_timeout
+        super(KeepAliveAdapter, self).__init__(**kw)
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = StatsPoolManager(num_pools=connections,
+                                            maxsize=maxsize, block=block,
+                                            stats_name=self.name,
+                                            idle_timeout=self.idle_timeout)
+
+
+class PooledAdapter(KeepAliveAdapter):
+    """
+    A KeepAliveAdapter for upstream APIs that times every request, stops
+    calling resources whose circuit breaker is open and keeps to the request
+    deadline.
+    """
+
+    def send(self, request, timeout=None, **kw):
+        stat = 'upstream.{0}.{1}.{2}'.format(self.name, request.method.lower(),
+                                             stats_path(request.url))
+        remaining = remaining_time()
+        limited = remaining is not None and (timeout is None or
+                                             remaining < timeout)
+        if limited:
+            if remaining <= 0:
+                log.error('No time left to call {0}'.format(request.url))
+                statsd.incr(stat + '.deadline')
+                raise DeadlineExceeded()
+            timeout = remaining
+
+        breaker = get_breaker(self.name, request.url)
+        breaker.before()
+        start = time.time()
+        try:
+            response = super(PooledAdapter, self).send(request,
+                                                       timeout=timeout, **kw)
+        except Timeout:
+            statsd.timing(stat + '.error', (time.time() - start) * 1000)
+            if limited:
+                # The upstream only ran out of the time this request had left,
+                # that's not a reason to stop calling it.
+                statsd.incr(stat + '.deadline')
+                breaker.release()
+                raise DeadlineExceeded()
+            breaker.failure()
+            raise
+        except Exception:
+            statsd.timing(stat + '.error', (time.time() - start) * 1000)
+            breaker.failure()
+            raise
+        statsd.timing('{0}.{1}xx'.format(stat, response.status_code // 100),
+                      (time.time() - start) * 1000)
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+
+def stats_path(url):
+    """
+    Return the path of an upstream URL the way it is used in statsd keys,
+    so /api/v1/webpay/prices/ is webpay.prices and /generic/buyer/1/ is
+    generic.buyer.
+    """
+    segments = [segment for segment in urlparse.urlparse(url).path.split('/')
+                if segment and not UNTIMED_SEGMENTS.match(segment)]
+    return '.'.join(segments) or 'root'
+
+
+def pooled_session(name, config=None, adapter_class=PooledAdapter):
+    """
+    Return a requests session that uses a PooledAdapter for all requests.
+
+    :param name: the name of the upstream, e.g. solitude.
+    :param config: a dict overriding any of the keys in DEFAULT_POOL.
+    :param adapter_class: the adapter to use instead of PooledAdapter, for
+                          example a KeepAliveAdapter for servers that aren't
+                          one of our upstreams.
+    """
+    conf = DEFAULT_POOL.copy()
+    conf.update(config or {})
+    adapter = adapter_class(name, idle_timeout=conf['idle_timeout'],
+                            pool_connections=conf['connections'],
+                            pool_maxsize=conf['maxsize'],
+                            pool_block=conf['block'])
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -1,29 +1,121 @@
 import json
+import random
+import time
 
 from curling.lib import API
+from django_statsd.clients import statsd
+from requests.exceptions import ConnectionError, Timeout
 from slumber.exceptions import HttpClientError
 
+from lib.transport import pooled_session
 from solitude.exceptions import ResourceModified, ResourceNotModified
 from webpay.base.logger import getLogger, get_transaction_id
 
 log = getLogger('lib.utils')
 
 
+# Methods that can be sent again without changing the result.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Headers that make any request safe to send again, because the upstream
+# rejects it once the resource has changed.
+CONDITIONAL_HEADERS = ('If-Match', 'If-Unmodified-Since')
+
+
 def add_transaction_id(slumber, headers=None, **kwargs):
     headers['Transaction-Id'] = get_transaction_id()
 
 
+class RetryPolicy(object):
+    """
+    Describes how a failed upstream call is tried again.
+
+    :param attempts: the most number of calls, including the first one.
+    :param backoff: the most seconds to wait before the first retry. This is
+                    doubled for each retry and a random part of it is used.
+    :param max_backoff: the most seconds to wait before any retry.
+    :param budget: give up once this many seconds have been spent on the
+                   call, including the waits.
+    :param errors: the exceptions that are retried.
+    """
+
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2, budget=10,
+                 errors=(ConnectionError, Timeout)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.errors = errors
+
+    def can_retry(self, method, headers=None):
+        """
+        Only idempotent or conditional requests are retried; anything else
+        may already have changed something upstream.
+        """
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        return any(h in (headers or {}) for h in CONDITIONAL_HEADERS)
+
+    def delay(self, retry):
+        """
+        Seconds to wait before the given retry, counting from 1.
+        """
+        cap = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        return random.uniform(0, cap)
+
+
 class SlumberWrapper(object):
     """
     A wrapper around the Slumber API.
+
+    :param url: the base URL of the upstream API.
+    :param oauth: a dict with the OAuth key and secret.
+    :param pool: a dict configuring the connection pool, see
+                 lib.transport.DEFAULT_POOL.
     """
+    # Used to namespace the statsd keys for this upstream.
+    name = 'upstream'
 
-    def __init__(self, url, oauth):
-        self.slumber = API(url)
+    def __init__(self, url, oauth, pool=None):
+        self.slumber = API(url, session=pooled_session(self.name, pool))
         self.slumber.activate_oauth(oauth.get('key'), oauth.get('secret'))
         self.slumber._add_callback({'method': add_transaction_id})
         self.api = self.slumber.api.v1
 
+    def retry(self, command, policy, method='GET', headers=None):
+        """
+        Call command, with no arguments, and retry it on failure as
+        described by policy.
+
+        Retries are counted in statsd as ``upstream.<name>.retry`` and calls
+        that fail after all of them as ``upstream.<name>.retry.exhausted``.
+
+        :param command: the callable making the request.
+        :param policy: a RetryPolicy.
+        :param method: the HTTP method of the request.
+        :param headers: the headers sent with the request.
+        """
+        if not policy.can_retry(method, headers):
+            return command()
+
+        start = time.time()
+        stat = 'upstream.{0}.retry'.format(self.name)
+        for attempt in range(1, policy.attempts + 1):
+            try:
+                return command()
+            except policy.errors as err:
+                delay = policy.delay(attempt)
+                if (attempt == policy.attempts or
+                        time.time() - start + delay > policy.budget):
+                    log.error('Giving up on {0} after {1} attempt(s): {2}'
+                              .format(self.name, attempt, err))
+                    statsd.incr(stat + '.exhausted')
+                    raise
+                log.warning('Retrying {0} in {1:.2f}s, attempt {2}: {3}'
+                            .format(self.name, delay, attempt, err))
+                statsd.incr(stat)
+                time.sleep(delay)
+
     def parse_res(self, res):
         if res == '':
             return {}
@@ -30,6 +30,13 @@ MARKETPLACE_URL = SOLITUDE_URL = 'http://example.com'
 
 # If you want test this, do so explicitly in the tests.
 USER_WHITELIST = []
+ISSUER_CACHE_TIMEOUT = ISSUER_CACHE_NEGATIVE_TIMEOUT = 0
+PRICE_TABLE_TIMEOUT = PRODUCT_CACHE_TIMEOUT = 0
+CIRCUIT_BREAKER_FAILURES = 0
+VERIFIED_JWT_CACHE_TIMEOUT = 0
+TRANSACTION_CACHE_TIMEOUT = TRANSACTION_CACHE_PENDING_TIMEOUT = 0
+POSTBACK_HOST_FAILURES = POSTBACK_DELIVERED_TIMEOUT = 0
+POSTBACK_OUTBOX_TIMEOUT = NOTICE_CACHE_TIMEOUT = 0
 UUID_HMAC_KEY = 'this is a test value'
 
 ALLOW_ADMIN_SIMULATIONS = True
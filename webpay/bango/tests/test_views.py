@@ -12,7 +12,10 @@ from slumber.exceptions import HttpClientError
 from test_utils import TestCase
 
 
+from lib.solitude.constants import (STATUS_CANCELLED, STATUS_ENDED,
+                                    STATUS_FAILED)
 from webpay.base.tests import BasicSessionCase
+from webpay.pay.utils import wait_for_status
 
 
 @mock.patch('webpay.bango.views.client.slumber')
@@ -75,6 +78,13 @@ class TestBangoReturn(BasicSessionCase):
                         url='bango.error', expected_status=400)
         assert slumber.bango.notification.post.called
         self.assertTemplateUsed(res, 'error.html')
+        eq_(wait_for_status(self.trans_uuid, STATUS_ENDED, 0), STATUS_FAILED)
+
+    def test_cancel(self, payment_notify, slumber):
+        self.call(overrides={'ResponseCode': 'CANCEL'}, url='bango.error',
+                  expected_status=400)
+        eq_(wait_for_status(self.trans_uuid, STATUS_ENDED, 0),
+            STATUS_CANCELLED)
 
     def test_not_error(self, payment_notify, slumber):
         self.call(overrides={'ResponseCode': 'OK'}, url='bango.error',
@@ -8,13 +8,15 @@ from django.views.decorators.csrf import csrf_exempt
 from django_paranoia.decorators import require_GET, require_POST
 from slumber.exceptions import HttpClientError
 
-from lib.solitude.api import client
+from lib.solitude.api import client, forget_transaction
+from lib.solitude.constants import STATUS_CANCELLED, STATUS_FAILED
 from webpay.bango.auth import basic, NoHeader, WrongHeader
 from webpay.base import dev_messages as msg
 from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
 from webpay.base.utils import system_error
 from webpay.pay import tasks
+from webpay.pay.utils import signal_status
 
 log = getLogger('w.bango')
 RECORDED_OK = 'RECORDED_OK'
@@ -65,6 +67,7 @@ def _record(request):
                   'failed: %s' % (trans_uuid, err))
         return msg.NOTICE_ERROR
 
+    forget_transaction(trans_uuid)
     return RECORDED_OK
 
 
@@ -98,7 +101,7 @@ def success(request):
         return system_error(request, code=result)
 
     # Signature verification was successful; fulfill the payment.
-    tasks.payment_notify.delay(request.GET.get('MerchantTransactionId'))
+    tasks.queue_notice('payment', request.GET.get('MerchantTransactionId'))
 
     if settings.SPA_ENABLE:
         state, fxa_url = fxa_auth_info(request)
@@ -124,6 +127,11 @@ def error(request):
     if result is not RECORDED_OK:
         return system_error(request, code=result)
 
+    # Stop anyone waiting on the status of the transaction.
+    cancelled = request.GET.get('ResponseCode') == 'CANCEL'
+    signal_status(request.GET.get('MerchantTransactionId'),
+                  STATUS_CANCELLED if cancelled else STATUS_FAILED)
+
     if request.GET.get('ResponseCode') == 'CANCEL':
         return system_error(request, code=msg.USER_CANCELLED)
 
@@ -145,6 +153,11 @@ def notification(request):
     An end point for Bango to communicate with using the Event Notification
     API. This does the Basic Auth and then passes the whole thing on to do
     solitude.
+
+    The transaction that the event changes isn't forgotten from the cache:
+    only solitude parses the event and its response doesn't say which
+    transaction it was, so ended transactions are only cached for
+    TRANSACTION_CACHE_TIMEOUT seconds.
     """
     log.info('Bango notification received')
 
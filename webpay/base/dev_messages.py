@@ -69,6 +69,7 @@ TRANS_TIMEOUT = 'TRANS_TIMEOUT'
 UNEXPECTED_ERROR = 'UNEXPECTED_ERROR'
 UNEXPECTED_STATE = 'UNEXPECTED_STATE'
 UNSUPPORTED_PAY = 'UNSUPPORTED_PAY'
+UPSTREAM_UNAVAILABLE = 'UPSTREAM_UNAVAILABLE'
 # This string is used to determine the message on Marketplace;
 # change it at your peril.
 USER_CANCELLED = 'USER_CANCELLED'
@@ -246,6 +247,9 @@ def _build_legend():
         UNSUPPORTED_PAY:
             _('The payment method or price point is not supported for this '
               'region or operator.'),
+        UPSTREAM_UNAVAILABLE:
+            _('A service needed to process the payment is temporarily '
+              'unavailable.'),
         USER_CANCELLED: _('The user cancelled the payment.'),
         # L10n: First argument is the name of a var, 'user_hash'. The second
         # argument is the name of an event, 'onLogin'. The third argument
@@ -1,6 +1,7 @@
 import logging
 import re
 import threading
+import time
 
 _local = threading.local()
 fx = re.compile(' Firefox/(?P<version>[\d.]+)')
@@ -18,6 +19,39 @@ def get_client_id():
     return getattr(_local, 'CLIENT_ID', None)
 
 
+def get_deadline():
+    return getattr(_local, 'DEADLINE', None)
+
+
+def set_deadline(seconds):
+    """
+    Give upstream calls made by this thread the given number of seconds in
+    total, or no limit if seconds is None.
+    """
+    _local.DEADLINE = time.time() + seconds if seconds else None
+
+
+def remaining_time():
+    """
+    Return the seconds left before the deadline, or None if there isn't one.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def get_context():
+    """Return a copy of the request values kept for this thread."""
+    return dict(_local.__dict__)
+
+
+def set_context(context):
+    """Replace the request values kept for this thread, see get_context."""
+    _local.__dict__.clear()
+    _local.__dict__.update(context)
+
+
 def getLogger(name=None):
     logger = logging.getLogger(name)
     return WebpayAdapter(logger)
@@ -0,0 +1,70 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lib.concurrency import run_parallel
+from lib.marketplace.api import client as marketplace
+from webpay.base.utils import spartacus_build_id
+from webpay.pay.utils import lookup_issuer, UnknownIssuer
+
+
+def warm_prices(provider):
+    return marketplace.cache_prices(provider)
+
+
+def warm_issuer(issuer):
+    try:
+        lookup_issuer(issuer)
+    except UnknownIssuer:
+        # Unknown issuers are cached too.
+        pass
+    return 1
+
+
+def warm_build_id():
+    return 1 if spartacus_build_id() else 0
+
+
+class Command(BaseCommand):
+    help = ('Fill the shared caches before this deploy takes traffic. '
+            'Buyers and products are per user and seller and are left to '
+            'fill as they are used.')
+    option_list = BaseCommand.option_list + (
+        make_option('--issuer', action='append', default=[],
+                    help='An in-app JWT issuer to look up. Can be repeated.'),
+    )
+
+    def handle(self, *args, **options):
+        warmers = [('prices:{0}'.format(provider), warm_prices, provider)
+                   for provider in settings.PAYMENT_PROVIDERS]
+        warmers += [('issuer:{0}'.format(issuer), warm_issuer, issuer)
+                    for issuer in options['issuer']]
+        warmers.append(('spartacus_build_id', warm_build_id))
+
+        start = time.time()
+        results = run_parallel(*[self.timed(*warmer) for warmer in warmers])
+        failed = 0
+        for name, keys, took, error in results:
+            if error:
+                failed += 1
+                self.stdout.write('{0}: FAILED after {1:.2f}s: {2}'
+                                  .format(name, took, error))
+            else:
+                self.stdout.write('{0}: {1} key(s) in {2:.2f}s'
+                                  .format(name, keys, took))
+
+        self.stdout.write('Warmed {0} of {1} caches in {2:.2f}s'
+                          .format(len(results) - failed, len(results),
+                                  time.time() - start))
+
+    def timed(self, name, func, *args):
+        def warm():
+            start = time.time()
+            try:
+                keys = func(*args)
+            except Exception, err:
+                return name, 0, time.time() - start, err
+            return name, keys, time.time() - start, None
+        return warm
@@ -10,8 +10,11 @@ from django.utils.translation.trans_real import parse_accept_lang_header
 import tower
 from csp.middleware import CSPMiddleware as BaseCSPMiddleware
 
-from webpay.base.logger import getLogger
-from webpay.base.utils import log_cef
+from lib.breaker import CircuitOpen
+from lib.solitude.api import end_buyer_memo, start_buyer_memo
+from lib.transport import DeadlineExceeded
+from webpay.base.logger import getLogger, set_deadline
+from webpay.base.utils import log_cef, system_error
 
 log = getLogger('w.middleware')
 
@@ -137,6 +140,55 @@ class CEFMiddleware(object):
         log_cef(exception.__class__.__name__, request, severity=8)
 
 
+class BuyerMemoMiddleware(object):
+    """
+    Remembers buyers fetched from solitude for the length of a request so
+    that views, forms and helpers asking for the same buyer share one lookup.
+    """
+
+    def process_request(self, request):
+        start_buyer_memo()
+
+    def process_response(self, request, response):
+        end_buyer_memo()
+        return response
+
+    def process_exception(self, request, exception):
+        end_buyer_memo()
+
+
+class UpstreamErrorMiddleware(object):
+    """
+    Shows a system error straight away when a view tries to use an upstream
+    whose circuit breaker is open or runs out of time waiting for one.
+    """
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, CircuitOpen):
+            log.error('Upstream {0} is unavailable'.format(exception.name))
+            return system_error(request, code=exception.code, status=503)
+        if isinstance(exception, DeadlineExceeded):
+            log.error('Request deadline exceeded')
+            return system_error(request, code=exception.code, status=504)
+
+
+class DeadlineMiddleware(object):
+    """
+    Limits the total time a request spends on upstream calls to
+    REQUEST_DEADLINE seconds.
+    """
+
+    def process_request(self, request):
+        set_deadline(settings.REQUEST_DEADLINE)
+
+    def process_response(self, request, response):
+        set_deadline(None)
+        return response
+
+    def process_exception(self, request, exception):
+        set_deadline(None)
+
+
 class CSPMiddleware(BaseCSPMiddleware):
 
     def process_response(self, request, response):
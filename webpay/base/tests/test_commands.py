@@ -0,0 +1,39 @@
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+import mock
+from nose.tools import eq_, ok_
+
+from webpay.pay.utils import UnknownIssuer
+
+
+@mock.patch('webpay.base.management.commands.warm_caches.lookup_issuer')
+@mock.patch('lib.marketplace.api.client.cache_prices')
+class TestWarmCaches(TestCase):
+
+    def warm(self, *args, **kw):
+        out = StringIO()
+        with self.settings(PAYMENT_PROVIDERS=('bango', 'boku')):
+            call_command('warm_caches', *args, stdout=out, **kw)
+        return out.getvalue()
+
+    def test_warm(self, cache_prices, lookup_issuer):
+        cache_prices.return_value = 5
+        out = self.warm(issuer=['some-issuer'])
+        eq_(sorted(c[0][0] for c in cache_prices.call_args_list),
+            ['bango', 'boku'])
+        lookup_issuer.assert_called_with('some-issuer')
+        ok_('prices:boku: 5 key(s)' in out, out)
+        ok_('Warmed 4 of 4 caches' in out, out)
+
+    def test_unknown_issuer(self, cache_prices, lookup_issuer):
+        lookup_issuer.side_effect = UnknownIssuer
+        ok_('Warmed 4 of 4 caches' in self.warm(issuer=['nope']))
+
+    def test_failure(self, cache_prices, lookup_issuer):
+        cache_prices.side_effect = ValueError('no prices')
+        out = self.warm()
+        ok_('prices:bango: FAILED' in out, out)
+        ok_('Warmed 1 of 3 caches' in out, out)
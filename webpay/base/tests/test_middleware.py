@@ -10,8 +10,15 @@ import fudge
 import mock
 from nose.tools import eq_, ok_
 
-from webpay.base.middleware import (CEFMiddleware, CSPMiddleware,
-                                    LocaleMiddleware, LogJSONerror)
+from lib.breaker import CircuitOpen
+from lib.solitude import api
+from lib.transport import DeadlineExceeded
+from webpay.base import dev_messages as msg
+from webpay.base import logger
+from webpay.base.middleware import (BuyerMemoMiddleware, CEFMiddleware,
+                                    CSPMiddleware, DeadlineMiddleware,
+                                    LocaleMiddleware, LogJSONerror,
+                                    UpstreamErrorMiddleware)
 
 
 class TestLocaleMiddleware(TestCase):
@@ -138,3 +145,76 @@ class TestCSPMiddleware(TestCase):
         response = self.client.get('/')
         csp = response['content-security-policy']
         ok_(stubbed_source in csp)
+
+
+class TestBuyerMemoMiddleware(TestCase):
+
+    def setUp(self):
+        self.middleware = BuyerMemoMiddleware()
+        self.req = RequestFactory().get('/')
+
+    def test_request(self):
+        self.middleware.process_request(self.req)
+        eq_(api._buyer_memo(), {})
+
+    def test_response(self):
+        self.middleware.process_request(self.req)
+        self.middleware.process_response(self.req, http.HttpResponse())
+        eq_(api._buyer_memo(), None)
+
+    def test_exception(self):
+        self.middleware.process_request(self.req)
+        self.middleware.process_exception(self.req, ValueError())
+        eq_(api._buyer_memo(), None)
+
+
+class TestUpstreamErrorMiddleware(TestCase):
+
+    def setUp(self):
+        self.middleware = UpstreamErrorMiddleware()
+        self.req = RequestFactory().get('/', HTTP_ACCEPT='application/json')
+
+    def test_circuit_open(self):
+        res = self.middleware.process_exception(
+            self.req, CircuitOpen('solitude.buyer'))
+        eq_(res.status_code, 503)
+        eq_(json.loads(res.content)['error_code'], msg.UPSTREAM_UNAVAILABLE)
+
+    def test_deadline_exceeded(self):
+        res = self.middleware.process_exception(self.req, DeadlineExceeded())
+        eq_(res.status_code, 504)
+        eq_(json.loads(res.content)['error_code'], msg.INTERNAL_TIMEOUT)
+
+    def test_other_exception(self):
+        eq_(self.middleware.process_exception(self.req, ValueError()), None)
+
+
+class TestDeadlineMiddleware(TestCase):
+
+    def setUp(self):
+        self.middleware = DeadlineMiddleware()
+        self.req = RequestFactory().get('/')
+
+    @mock.patch('webpay.base.logger.time')
+    def test_request(self, time_):
+        time_.time.return_value = 100
+        with self.settings(REQUEST_DEADLINE=5):
+            self.middleware.process_request(self.req)
+        eq_(logger.get_deadline(), 105)
+        eq_(logger.remaining_time(), 5)
+
+    def test_response(self):
+        self.middleware.process_request(self.req)
+        self.middleware.process_response(self.req, http.HttpResponse())
+        eq_(logger.get_deadline(), None)
+        eq_(logger.remaining_time(), None)
+
+    def test_exception(self):
+        self.middleware.process_request(self.req)
+        self.middleware.process_exception(self.req, ValueError())
+        eq_(logger.get_deadline(), None)
+
+    def test_no_deadline(self):
+        with self.settings(REQUEST_DEADLINE=None):
+            self.middleware.process_request(self.req)
+        eq_(logger.get_deadline(), None)
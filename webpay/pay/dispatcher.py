@@ -0,0 +1,73 @@
+"""
+Sends notices to app servers.
+
+Connections to each app server are kept alive between notices and at most
+POSTBACK_CONCURRENCY notices are in flight at once in each process, however
+many threads are sending them.
+"""
+import cookielib
+import functools
+import os
+import threading
+
+from django.conf import settings
+
+from requests.exceptions import RequestException
+
+from lib.concurrency import run_parallel
+from lib.transport import KeepAliveAdapter, pooled_session
+
+
+class Dispatcher(object):
+    """
+    :param name: the name used for the connection pool statsd keys.
+    """
+
+    def __init__(self, name='postback'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._session = None
+        self._slots = None
+        self._pid = None
+
+    def _setup(self):
+        with self._lock:
+            # Sockets and locks shouldn't be shared with a forked (celery)
+            # process.
+            if self._session is None or self._pid != os.getpid():
+                session = pooled_session(self.name, settings.POSTBACK_POOL,
+                                         adapter_class=KeepAliveAdapter)
+                # Don't let one app set cookies that are sent to another.
+                session.cookies.set_policy(
+                    cookielib.DefaultCookiePolicy(allowed_domains=[]))
+                self._session = session
+                self._slots = threading.BoundedSemaphore(
+                    settings.POSTBACK_CONCURRENCY)
+                self._pid = os.getpid()
+            return self._session, self._slots
+
+    def post(self, url, data, timeout=5):
+        """
+        Post data to url and return the response, waiting for a free slot
+        if too many notices are being sent already.
+        """
+        session, slots = self._setup()
+        with slots:
+            return session.post(url, data, timeout=timeout)
+
+    def post_many(self, posts, timeout=5):
+        """
+        Post all of a list of (url, data) at the same time and return a list
+        of (response, exception) in the same order.
+        """
+        def post(url, data):
+            try:
+                return self.post(url, data, timeout=timeout), None
+            except RequestException, exc:
+                return None, exc
+
+        return run_parallel(*[functools.partial(post, url, data)
+                              for url, data in posts])
+
+
+dispatcher = Dispatcher()
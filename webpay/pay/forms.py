@@ -10,6 +10,7 @@ from tower import ugettext_lazy as _
 from webpay.base import dev_messages as msg
 from webpay.base.logger import getLogger
 
+from .jwt_utils import ParsedJWT
 from .utils import lookup_issuer, UnknownIssuer
 
 log = getLogger('w.pay')
@@ -29,6 +30,8 @@ class VerifyForm(ParanoidForm):
     key = settings.KEY
     secret = settings.SECRET
     is_simulation = False
+    # The ParsedJWT of the request, once it has been cleaned.
+    parsed = None
 
     def clean(self):
         cleaned_data = super(VerifyForm, self).clean()
@@ -43,10 +46,11 @@ class VerifyForm(ParanoidForm):
         jwt_data = data.encode('ascii', 'ignore')
         log.debug('incoming JWT data: %r' % jwt_data)
         try:
-            payload = jwt.decode(jwt_data, verify=False)
+            self.parsed = ParsedJWT(jwt_data)
         except jwt.DecodeError, exc:
             log.debug('Error decoding JWT: {0}'.format(exc))
             raise forms.ValidationError(msg.JWT_DECODE_ERR)
+        payload = self.parsed.payload
         log.debug('Received JWT: %r' % payload)
         if not isinstance(payload, dict):
             # It seems that some JWT libs are encoding strings of JSON
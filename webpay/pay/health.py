@@ -0,0 +1,118 @@
+"""
+Delivery health of the app servers that notices are sent to.
+
+The recent error rate and response time of each host are kept in the shared
+cache so that every worker sees them. Hosts that are doing fine get a failed
+notice retried quickly, hosts that aren't are retried every POSTBACK_DELAY
+seconds as before. After POSTBACK_HOST_FAILURES failures in a row a host is
+taken to be down and notices to it aren't sent at all for
+POSTBACK_HOST_DOWN seconds.
+
+The health of a host is read, updated and written back without a lock, so
+when two workers record a notice to the same host at the same time one of
+them is lost. That only makes the averages a little less accurate and can
+take a host down one failure late, which is cheaper than a lock around
+every notice.
+"""
+import random
+import time
+from urlparse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_statsd.clients import statsd
+from requests.exceptions import RequestException
+
+from webpay.base.logger import getLogger
+
+log = getLogger('w.pay.health')
+
+HEALTH_KEY = 'postback_health:%s'
+HEALTH_TIMEOUT = 60 * 60 * 24
+# The weight of the latest notice in the averages.
+ALPHA = 0.3
+# A host that fails more often than this is unhealthy.
+UNHEALTHY_ERROR_RATE = 0.5
+# A host that takes longer than this many seconds to answer, half of the
+# timeout that notices are sent with, is unhealthy.
+UNHEALTHY_LATENCY = 2.5
+
+
+class HostDown(RequestException):
+    """Raised instead of sending a notice to a host that is down."""
+
+
+def host(url):
+    return urlparse(url).netloc.lower()
+
+
+def get_health(url):
+    """
+    Return a dict of the number of failures in a row, the error rate, the
+    latency in seconds and the time the host is down until.
+    """
+    return (cache.get(HEALTH_KEY % host(url)) or
+            {'failures': 0, 'error_rate': 0.0, 'latency': 0.0,
+             'down_until': 0})
+
+
+def record(url, ok, took):
+    """
+    Record a notice sent to url.
+
+    :param ok: True if the notice was accepted.
+    :param took: the seconds it took.
+    """
+    health = get_health(url)
+    health['error_rate'] = (ALPHA * (0 if ok else 1) +
+                            (1 - ALPHA) * health['error_rate'])
+    health['latency'] = ALPHA * took + (1 - ALPHA) * health['latency']
+    if ok:
+        health['failures'] = 0
+        health['down_until'] = 0
+    else:
+        health['failures'] += 1
+        if (settings.POSTBACK_HOST_FAILURES and
+                health['failures'] >= settings.POSTBACK_HOST_FAILURES):
+            if health['down_until'] < time.time():
+                log.warning('Notices to {0} failed {1} times in a row, not '
+                            'sending any for {2} seconds'
+                            .format(host(url), health['failures'],
+                                    settings.POSTBACK_HOST_DOWN))
+                statsd.incr('purchase.send_pay_notice.host_down')
+            health['down_until'] = time.time() + settings.POSTBACK_HOST_DOWN
+    cache.set(HEALTH_KEY % host(url), health, HEALTH_TIMEOUT)
+    return health
+
+
+def is_down(url):
+    if not settings.POSTBACK_HOST_FAILURES:
+        return False
+    return get_health(url)['down_until'] > time.time()
+
+
+def is_healthy(health):
+    return (health['error_rate'] < UNHEALTHY_ERROR_RATE and
+            health['latency'] < UNHEALTHY_LATENCY)
+
+
+def retry_delay(url, retries):
+    """
+    Return the seconds to wait before sending a failed notice to url again.
+
+    :param retries: the number of times the notice has been retried.
+    """
+    health = get_health(url)
+    if is_healthy(health):
+        delay = min(settings.POSTBACK_MIN_DELAY * 2 ** retries,
+                    settings.POSTBACK_DELAY)
+    else:
+        delay = settings.POSTBACK_DELAY
+    # Spread the retries out so that they don't all arrive at once.
+    delay = random.uniform(delay / 2.0, delay)
+    down_for = health['down_until'] - time.time()
+    if down_for > 0:
+        delay = max(delay, down_for +
+                    random.uniform(0, settings.POSTBACK_MIN_DELAY))
+    return delay
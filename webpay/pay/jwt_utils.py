@@ -0,0 +1,68 @@
+import json
+
+import jwt
+from mozpay.exc import InvalidJWT
+from mozpay.verify import verify_audience, verify_claims, verify_keys
+
+
+class ParsedJWT(object):
+    """
+    A JWT that is split and decoded once so that its payload can be checked
+    and its signature verified without decoding it again.
+
+    Raises jwt.DecodeError if the JWT can't be decoded.
+
+    :param token: the encoded JWT as a byte string.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        try:
+            self.signing_input, crypto_segment = token.rsplit('.', 1)
+            header_segment, payload_segment = (self.signing_input
+                                               .split('.', 1))
+        except ValueError:
+            raise jwt.DecodeError('Not enough segments')
+        try:
+            self.header = json.loads(jwt.base64url_decode(header_segment))
+            self.payload = json.loads(jwt.base64url_decode(payload_segment))
+            self.signature = jwt.base64url_decode(crypto_segment)
+        except (ValueError, TypeError):
+            raise jwt.DecodeError('Invalid segment encoding')
+
+    @property
+    def issuer(self):
+        if isinstance(self.payload, dict):
+            return self.payload.get('iss')
+
+    def verify_sig(self, secret):
+        """
+        Check the JWT was signed with secret and return its payload. Raises
+        InvalidJWT if it wasn't.
+        """
+        alg = self.header.get('alg') if isinstance(self.header, dict) else None
+        if alg not in jwt.ALLOWED_ALGOS:
+            raise InvalidJWT('Signature verification failed: algorithm {0} '
+                             'not allowed'.format(alg), issuer=self.issuer)
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        if not jwt.verifying_methods[alg](self.signing_input, secret,
+                                          self.signature):
+            raise InvalidJWT('Signature verification failed',
+                             issuer=self.issuer)
+        return self.payload
+
+    def verify(self, expected_aud, secret, required_keys=()):
+        """
+        Does the same checks as mozpay.verify.verify_jwt on the payload that
+        has already been decoded and returns it.
+        """
+        if not isinstance(self.payload, dict):
+            raise InvalidJWT('Payment JWT is not an object')
+        if not self.issuer:
+            raise InvalidJWT('Payment JWT is missing iss (issuer)')
+        payload = self.verify_sig(secret)
+        verify_claims(payload, issuer=self.issuer)
+        verify_audience(payload, expected_aud, issuer=self.issuer)
+        verify_keys(payload, required_keys, issuer=self.issuer)
+        return payload
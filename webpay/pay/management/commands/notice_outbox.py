@@ -0,0 +1,40 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from webpay.pay import outbox
+from webpay.pay.tasks import drain_outbox
+
+
+def when(timestamp):
+    if not timestamp:
+        return '-'
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Command(BaseCommand):
+    help = ('List the payment and chargeback notices that haven\'t been '
+            'delivered yet, or deliver them.')
+    option_list = BaseCommand.option_list + (
+        make_option('--drain', action='store_true', default=False,
+                    help='Deliver the notices that no task is sending.'),
+        make_option('--batch', type='int', default=None,
+                    help='Notices to send to each app server at once. '
+                         'Default: settings.POSTBACK_OUTBOX_BATCH'),
+    )
+
+    def handle(self, *args, **options):
+        if options['drain']:
+            delivered = drain_outbox(batch_size=options['batch'])
+            self.stdout.write('Delivered {0} notices'.format(delivered))
+            return
+
+        entries = outbox.pending()
+        for entry in entries:
+            self.stdout.write(
+                '{transaction_uuid} {kind} added={added} attempts={attempts} '
+                'last_attempt={last_attempt} url={url} {last_error}'
+                .format(**dict(entry, added=when(entry['added']),
+                               last_attempt=when(entry['last_attempt']))))
+        self.stdout.write('{0} notices pending'.format(len(entries)))
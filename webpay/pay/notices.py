@@ -0,0 +1,97 @@
+"""
+Signed notices for app servers.
+
+A notice is the pay request of the app plus the response of webpay, signed
+with the secret of the app as a JWT. Only its iat and exp change between
+attempts to deliver it, so the rest is serialized and encoded once and
+kept for NOTICE_CACHE_TIMEOUT seconds. Each attempt then only encodes the
+times and signs the notice.
+
+The times are put last in the JSON so that everything before them is the
+same for every attempt. Base64 encodes 3 bytes at a time, so the part of
+the JSON that is a multiple of 3 bytes long is kept encoded and only the
+up to 2 bytes left over are encoded again with the times.
+"""
+import base64
+import hashlib
+import hmac
+import json
+
+from django.conf import settings
+
+from lib.caching import LRU, TieredCache
+from webpay.base.utils import gmtime
+
+PREPARED_KEY = 'prepared_notice:%s:%s'
+prepared_cache = TieredCache('pay.notice', maxsize=500, timeout=60 * 5)
+# Secrets of in-app issuers that aren't in the issuer cache, see
+# tasks.get_secret. They are only kept in process, and only for a minute so
+# that a new secret is picked up soon.
+secret_cache = LRU(maxsize=1000, timeout=60)
+
+# Notices expire an hour after they are issued.
+NOTICE_LIFETIME = 3600
+
+
+def base64url(data):
+    return base64.urlsafe_b64encode(data).replace('=', '')
+
+
+# The same header as jwt.encode(..., algorithm='HS256').
+HEADER = base64url(json.dumps({'typ': 'JWT', 'alg': 'HS256'}))
+
+
+def prepared_key(trans, extra_response=None):
+    """
+    Return the key of the prepared notice of a transaction.
+
+    The amount, currency and type are part of the key so that a transaction
+    that solitude changed isn't sent with what was prepared before.
+    """
+    extra = hashlib.md5(json.dumps([trans.get('type'), trans.get('amount'),
+                                    trans.get('currency'),
+                                    extra_response or {}],
+                                   sort_keys=True)).hexdigest()
+    return PREPARED_KEY % (trans['uuid'], extra)
+
+
+def get_prepared(key):
+    if not settings.NOTICE_CACHE_TIMEOUT:
+        return None
+    return prepared_cache.get(key)
+
+
+def prepare(key, url, issuer_key, notice, cache=True):
+    """
+    Serialize a notice, without its iat and exp, for sign and cache it
+    under key.
+
+    :param url: the URL to post the notice to.
+    :param issuer_key: the issuer whose secret signs the notice.
+    :param cache: False for notices that are never looked up again.
+    """
+    # Leave the closing brace off so the times can be added.
+    head = json.dumps(notice)[:-1]
+    aligned = len(head) - len(head) % 3
+    prepared = {'url': url, 'issuer_key': issuer_key,
+                'encoded': base64url(head[:aligned]), 'rest': head[aligned:]}
+    if cache and settings.NOTICE_CACHE_TIMEOUT:
+        prepared_cache.set(key, prepared, settings.NOTICE_CACHE_TIMEOUT)
+    return prepared
+
+
+def sign(prepared, secret, issued_at=None):
+    """
+    Return the notice that was prepared as a JWT issued at issued_at
+    (default: now) and signed with secret.
+    """
+    if issued_at is None:
+        issued_at = gmtime()
+    times = '{0}, "iat": {1}, "exp": {2}}}'.format(
+        prepared['rest'], issued_at, issued_at + NOTICE_LIFETIME)
+    signing_input = '{0}.{1}{2}'.format(HEADER, prepared['encoded'],
+                                        base64url(times))
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    signature = hmac.new(secret, signing_input, hashlib.sha256).digest()
+    return '{0}.{1}'.format(signing_input, base64url(signature))
@@ -0,0 +1,119 @@
+"""
+Payment and chargeback notices that haven't been delivered yet.
+
+Each notice that is queued is added to the outbox in the shared cache. It
+stays there, with the number of delivery attempts and the last error, until
+it is delivered or given up on. The notify tasks deliver notices as before
+and tasks.drain_outbox delivers whatever is left, for example after the
+workers or an app server were down.
+
+The cache can't list its keys, so each entry also gets a slot numbered from
+a counter. The outbox is read from the oldest slot that still has an entry
+to the newest one.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# A transaction can have a payment and a chargeback notice, so entries are
+# kept by kind and transaction.
+ENTRY_KEY = 'notice_outbox:%s:%s'
+SLOT_KEY = 'notice_outbox_slot:%s'
+HEAD_KEY = 'notice_outbox_head'
+TAIL_KEY = 'notice_outbox_tail'
+# The counters have to outlive every entry; this is as long as memcached
+# keeps anything.
+COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+# Slots read from the cache at once.
+READ_SIZE = 100
+
+
+def add(kind, transaction_uuid, **kw):
+    """
+    Add the notice of a transaction unless it is in the outbox already.
+
+    :param kind: 'payment' or 'chargeback'.
+    :param kw: the keyword arguments of the notify task.
+    """
+    timeout = settings.POSTBACK_OUTBOX_TIMEOUT
+    if not timeout:
+        return
+    key = ENTRY_KEY % (kind, transaction_uuid)
+    entry = {'kind': kind, 'transaction_uuid': transaction_uuid, 'kw': kw,
+             'url': None, 'attempts': 0, 'last_error': '',
+             'added': time.time(), 'last_attempt': None, 'slot': None}
+    if not cache.add(key, entry, timeout):
+        return
+    if cache.add(TAIL_KEY, 0, COUNTER_TIMEOUT):
+        # The counter is new or was lost, start reading from the beginning.
+        cache.set(HEAD_KEY, 1, COUNTER_TIMEOUT)
+    entry['slot'] = cache.incr(TAIL_KEY)
+    cache.set(SLOT_KEY % entry['slot'], (kind, transaction_uuid), timeout)
+    cache.set(key, entry, timeout)
+
+
+def get(kind, transaction_uuid):
+    if not settings.POSTBACK_OUTBOX_TIMEOUT:
+        return None
+    return cache.get(ENTRY_KEY % (kind, transaction_uuid))
+
+
+def attempted(kind, transaction_uuid, url, error):
+    """
+    Record a failed attempt to deliver the notice of a transaction and
+    return its entry, or None if it isn't in the outbox.
+    """
+    entry = get(kind, transaction_uuid)
+    if entry is None:
+        return None
+    entry['attempts'] += 1
+    entry['url'] = url
+    entry['last_error'] = error
+    entry['last_attempt'] = time.time()
+    cache.set(ENTRY_KEY % (kind, transaction_uuid), entry,
+              settings.POSTBACK_OUTBOX_TIMEOUT)
+    return entry
+
+
+def remove(kind, transaction_uuid):
+    if settings.POSTBACK_OUTBOX_TIMEOUT:
+        cache.delete(ENTRY_KEY % (kind, transaction_uuid))
+
+
+def pending(limit=None):
+    """
+    Return the entries in the outbox, oldest first, at most limit of them.
+    """
+    if not settings.POSTBACK_OUTBOX_TIMEOUT:
+        return []
+    tail = cache.get(TAIL_KEY) or 0
+    head = cache.get(HEAD_KEY) or 1
+    entries = []
+    first_live = None
+    for start in range(head, tail + 1, READ_SIZE):
+        if limit is not None and len(entries) >= limit:
+            break
+        slots = range(start, min(start + READ_SIZE, tail + 1))
+        notices = cache.get_many([SLOT_KEY % slot for slot in slots])
+        found = cache.get_many([ENTRY_KEY % notice
+                                for notice in notices.values()])
+        for slot in slots:
+            notice = notices.get(SLOT_KEY % slot)
+            entry = found.get(ENTRY_KEY % notice) if notice else None
+            # An entry that was removed and added again is only read from
+            # its new slot.
+            if entry is None or entry['slot'] not in (slot, None):
+                continue
+            if first_live is None:
+                first_live = slot
+            # Entries that are still being added are read next time.
+            if entry['slot'] == slot:
+                entries.append(entry)
+                if limit is not None and len(entries) >= limit:
+                    break
+    # Don't read the slots of delivered notices again.
+    new_head = tail + 1 if first_live is None else first_live
+    if new_head != head:
+        cache.set(HEAD_KEY, new_head, COUNTER_TIMEOUT)
+    return entries
@@ -1,30 +1,51 @@
 import json
 import logging
 import sys
+import time
 import urlparse
 import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
+from celery.exceptions import RetryTaskError
 from celeryutils import task
-import jwt
+from django_statsd.clients import statsd
+from lib.concurrency import run_parallel
 from lib.marketplace.api import client as mkt_client, UnknownPricePoint
 from lib.solitude import constants
-from lib.solitude.api import client, ProviderHelper
+from lib.solitude.api import client, forget_transaction, ProviderHelper
 from multidb.pinning import use_master
+from requests.exceptions import RequestException
 
 from webpay.base import dev_messages
-from webpay.base.utils import gmtime, uri_to_pk
+from webpay.base.utils import uri_to_pk
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from .constants import NOT_SIMULATED, SIMULATED_POSTBACK, SIMULATED_CHARGEBACK
-from .utils import send_pay_notice, trans_id
+from . import health, notices, outbox
+from .dispatcher import dispatcher
+from .utils import (cached_issuer, check_notice_response, format_exception,
+                    notify_failures, send_pay_notice, signal_status, trans_id)
 
 log = logging.getLogger('w.pay.tasks')
 notify_kw = dict(default_retry_delay=15,  # seconds
                  max_tries=5)
 
+SPECULATIVE_KEY = 'speculative_pay:%s'
+# A buyer who hasn't got to configure_transaction by now probably won't.
+SPECULATIVE_TIMEOUT = 60 * 5
+
+# The state of a transaction's payment or chargeback notice: QUEUED or
+# DELIVERED.
+NOTICE_KEY = 'notice:%s:%s'
+QUEUED = 'queued'
+DELIVERED = 'delivered'
+# The id of the task that is sending a notice. It is only ever added, so that
+# a single task gets it.
+CLAIM_KEY = 'notice_claim:%s:%s'
+
 
 class TransactionOutOfSync(Exception):
     """The transaction's state is unexpected."""
@@ -142,9 +163,18 @@ def get_secret(issuer_key):
     """Resolve the secret for this JWT."""
     if is_marketplace(issuer_key):
         return settings.SECRET
-    else:
-        return (client.slumber.generic.product
-                      .get_object_or_404(public_id=issuer_key))['secret']
+
+    issuer = cached_issuer(issuer_key)
+    if issuer:
+        return issuer['secret']
+    secret = (settings.NOTICE_CACHE_TIMEOUT and
+              notices.secret_cache.get(issuer_key))
+    if not secret:
+        secret = (client.slumber.generic.product
+                        .get_object_or_404(public_id=issuer_key))['secret']
+        if settings.NOTICE_CACHE_TIMEOUT:
+            notices.secret_cache.set(issuer_key, secret)
+    return secret
 
 
 def get_provider_seller_uuid(issuer_key, product_data, provider_names):
@@ -196,6 +226,105 @@ def is_marketplace(issuer_key):
     return issuer_key == settings.KEY
 
 
+def resolve_product(issuer_key, pay_request, provider_names):
+    """
+    Find the seller, prices and icon for a pay request.
+
+    Returns a dict of the provider name, provider_seller_uuid,
+    generic_seller_uuid, prices and icon_url. The dict can be cached and given
+    back to start_pay, see speculate_pay.
+    """
+    product_data = urlparse.parse_qs(
+        pay_request['request'].get('productData', ''))
+
+    def get_seller_and_prices():
+        (provider_helper,
+         provider_seller_uuid,
+         generic_seller_uuid) = get_provider_seller_uuid(issuer_key,
+                                                         product_data,
+                                                         provider_names)
+        # Ask the marketplace for a valid price point.
+        # Note: the get_price_country API might be more helpful.
+        prices = mkt_client.get_price(
+            pay_request['request']['pricePoint'],
+            provider=provider_helper.provider.name)
+        log.debug('pricePoint=%s prices=%s' % (
+            pay_request['request']['pricePoint'], prices['prices']))
+        return (provider_helper, provider_seller_uuid,
+                generic_seller_uuid, prices)
+
+    def get_icon():
+        try:
+            return (get_icon_url(pay_request['request'])
+                    if settings.USE_PRODUCT_ICONS else None)
+        except:
+            log.exception('Calling get_icon_url')
+            return None
+
+    # The icon doesn't depend on the seller or price so fetch them at
+    # the same time.
+    seller_and_prices, icon_url = run_parallel(get_seller_and_prices,
+                                               get_icon)
+    (provider_helper, provider_seller_uuid,
+     generic_seller_uuid, prices) = seller_and_prices
+    return {'provider': provider_helper.name,
+            'provider_seller_uuid': provider_seller_uuid,
+            'generic_seller_uuid': generic_seller_uuid,
+            'prices': prices,
+            'icon_url': icon_url}
+
+
+def speculated(transaction_uuid, provider_names):
+    """
+    Return what speculate_pay resolved for the transaction, or None if it
+    didn't or it was for different providers.
+    """
+    if not settings.SPECULATIVE_CONFIGURE:
+        return None
+    key = SPECULATIVE_KEY % transaction_uuid
+    speculation = cache.get(key)
+    if speculation is None:
+        statsd.incr('purchase.speculative.miss')
+        return None
+    # Whatever happens it won't be used again.
+    cache.delete(key)
+    if speculation['providers'] != list(provider_names):
+        log.info('Speculative configuration of {0} was for {1}, not {2}'
+                 .format(transaction_uuid, speculation['providers'],
+                         provider_names))
+        statsd.incr('purchase.speculative.mismatch')
+        return None
+    log.info('Using speculative configuration of {0}'
+             .format(transaction_uuid))
+    statsd.incr('purchase.speculative.hit')
+    return speculation['resolved']
+
+
+@task
+def speculate_pay(transaction_uuid, issuer_key, pay_request, **kw):
+    """
+    Resolve the seller, prices and icon of a transaction before the client
+    has said which network it is on, so that start_pay only has to talk to
+    the payment provider.
+
+    The default providers are used. If the client turns out to be on a
+    network that changes the providers then start_pay resolves everything
+    itself.
+    """
+    provider_names = [p.name for p in ProviderHelper.supported_providers()]
+    try:
+        resolved = resolve_product(issuer_key, pay_request, provider_names)
+    except Exception, exc:
+        # start_pay will try again and deal with it.
+        log.warning('Speculative configuration of {t} failed: '
+                    '{exc.__class__.__name__}: {exc}'
+                    .format(t=transaction_uuid, exc=exc))
+        return
+    cache.set(SPECULATIVE_KEY % transaction_uuid,
+              {'providers': provider_names, 'resolved': resolved},
+              SPECULATIVE_TIMEOUT)
+
+
 @task
 @use_master
 @transaction.commit_on_success
@@ -228,34 +357,24 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
     network = notes.get('network', {})
     product_data = urlparse.parse_qs(pay['request'].get('productData', ''))
     try:
-        (provider_helper,
-         provider_seller_uuid,
-         generic_seller_uuid) = get_provider_seller_uuid(key,
-                                                         product_data,
-                                                         provider_names)
         try:
             application_size = int(product_data['application_size'][0])
         except (KeyError, ValueError):
             application_size = None
 
-        # Ask the marketplace for a valid price point.
-        # Note: the get_price_country API might be more helpful.
-        prices = mkt_client.get_price(pay['request']['pricePoint'],
-                                      provider=provider_helper.provider.name)
-        log.debug('pricePoint=%s prices=%s' % (pay['request']['pricePoint'],
-                                               prices['prices']))
-        try:
-            icon_url = (get_icon_url(pay['request'])
-                        if settings.USE_PRODUCT_ICONS else None)
-        except:
-            log.exception('Calling get_icon_url')
-            icon_url = None
+        resolved = speculated(transaction_uuid, provider_names)
+        if resolved is None:
+            resolved = resolve_product(key, pay, provider_names)
+        provider_helper = ProviderHelper(resolved['provider'])
+        prices = resolved['prices']
+        icon_url = resolved['icon_url']
         log.info('icon URL for %s: %s' % (transaction_uuid, icon_url))
 
-        bill_id, pay_url, seller_id = provider_helper.start_transaction(
+        (bill_id, pay_url,
+         seller_id, trans) = provider_helper.start_transaction(
             transaction_uuid=transaction_uuid,
-            generic_seller_uuid=generic_seller_uuid,
-            provider_seller_uuid=provider_seller_uuid,
+            generic_seller_uuid=resolved['generic_seller_uuid'],
+            provider_seller_uuid=resolved['provider_seller_uuid'],
             product_id=pay['request']['id'],
             product_name=pay['request']['name'],
             prices=prices['prices'],
@@ -266,18 +385,25 @@ def start_pay(transaction_uuid, notes, user_uuid, provider_names, **kw):
             mcc=network.get('mcc'),
             mnc=network.get('mnc')
         )
-        trans_pk = client.slumber.generic.transaction.get_object(
-            uuid=transaction_uuid)['resource_pk']
+        if trans:
+            trans_pk = trans['resource_pk']
+        else:
+            trans_pk = client.slumber.generic.transaction.get_object(
+                uuid=transaction_uuid)['resource_pk']
         client.slumber.generic.transaction(trans_pk).patch({
             'notes': json.dumps(notes),
             'uid_pay': bill_id,
             'pay_url': pay_url,
             'status': constants.STATUS_PENDING
         })
+        forget_transaction(transaction_uuid)
+        signal_status(transaction_uuid, constants.STATUS_PENDING)
     except Exception, exc:
         log.exception('while configuring payment for transaction {t}: '
                       '{exc.__class__.__name__}: {exc}'
                       .format(t=transaction_uuid, exc=exc))
+        # The transaction won't start, so stop anyone waiting for it to.
+        signal_status(transaction_uuid, constants.STATUS_FAILED)
         etype, val, tb = sys.exc_info()
         raise exc, None, tb
 
@@ -295,8 +421,13 @@ def payment_notify(transaction_uuid, **kw):
     :param response.price: object that contains the amount and currency the
       customer actually paid in.
     """
-    transaction = client.get_transaction(transaction_uuid)
-    _notify(payment_notify, transaction)
+    def send():
+        transaction = client.get_transaction(transaction_uuid, fresh=True)
+        # Wake up anyone waiting on transaction_status.
+        signal_status(transaction_uuid, transaction['status'])
+        return _notify(payment_notify, transaction, kind='payment')
+
+    _notify_once(payment_notify, 'payment', transaction_uuid, send)
 
 
 @task(**notify_kw)
@@ -311,9 +442,244 @@ def chargeback_notify(transaction_uuid, **kw):
     trans_id: pk of Transaction
     reason: either 'reversal' or 'refund'
     """
-    transaction = client.get_transaction(transaction_uuid)
-    _notify(chargeback_notify, transaction,
-            extra_response={'reason': kw.get('reason', '')})
+    def send():
+        transaction = client.get_transaction(transaction_uuid, fresh=True)
+        signal_status(transaction_uuid, transaction['status'])
+        return _notify(chargeback_notify, transaction,
+                       extra_response={'reason': kw.get('reason', '')},
+                       kind='chargeback')
+
+    _notify_once(chargeback_notify, 'chargeback', transaction_uuid, send)
+
+
+def _notice_timeout():
+    """
+    Seconds that a queued notice can take to be delivered, retries and all.
+    Retries while the app server is down aren't counted, so the claim of a
+    notice is extended each time it is retried, see _extend_claim.
+    """
+    return (settings.POSTBACK_DELAY * (settings.POSTBACK_ATTEMPTS + 1) +
+            settings.POSTBACK_HOST_DOWN)
+
+
+def queue_notice(kind, transaction_uuid, **kw):
+    """
+    Queue the payment or chargeback notice of a transaction unless it is
+    queued, being sent or was delivered already.
+
+    :param kind: 'payment' or 'chargeback'.
+
+    Returns True if the notice was queued.
+    """
+    notifier_task = {'payment': payment_notify,
+                     'chargeback': chargeback_notify}[kind]
+    key = NOTICE_KEY % (kind, transaction_uuid)
+    if (settings.POSTBACK_DELIVERED_TIMEOUT and
+            not cache.add(key, QUEUED, _notice_timeout())):
+        log.info('{0} notice for transaction {1} is already {2}, not queuing '
+                 'it again'.format(kind, transaction_uuid, cache.get(key)))
+        statsd.incr('purchase.notice.duplicate')
+        return False
+    # If the task can't be queued, drain_outbox will still send the notice.
+    outbox.add(kind, transaction_uuid, **kw)
+    try:
+        notifier_task.delay(transaction_uuid, **kw)
+    except:
+        cache.delete(key)
+        raise
+    return True
+
+
+def _claim_notice(kind, transaction_uuid, task_id):
+    """
+    Claim the notice of a transaction for the task with task_id. Returns
+    False if it was delivered already or another task is sending it.
+    """
+    if not settings.POSTBACK_DELIVERED_TIMEOUT:
+        return True
+
+    claim_key = CLAIM_KEY % (kind, transaction_uuid)
+    if (not cache.add(claim_key, task_id, _notice_timeout()) and
+            cache.get(claim_key) != task_id):
+        done = 'being sent'
+    # A task that delivered the notice marks it so before it lets go of its
+    # claim, so this is only looked at once the notice is ours.
+    elif cache.get(NOTICE_KEY % (kind, transaction_uuid)) == DELIVERED:
+        cache.delete(claim_key)
+        done = 'delivered'
+    else:
+        return True
+    log.info('{0} notice for transaction {1} is already {2}, not sending it '
+             'again'.format(kind, transaction_uuid, done))
+    statsd.incr('purchase.notice.duplicate')
+    return False
+
+
+def _extend_claim(kind, transaction_uuid, task_id):
+    """
+    Keep the notice claimed by task_id, and queued, for another
+    _notice_timeout() seconds.
+    """
+    if not settings.POSTBACK_DELIVERED_TIMEOUT:
+        return
+    claim_key = CLAIM_KEY % (kind, transaction_uuid)
+    if cache.get(claim_key) != task_id:
+        return
+    cache.set(claim_key, task_id, _notice_timeout())
+    cache.set(NOTICE_KEY % (kind, transaction_uuid), QUEUED,
+              _notice_timeout())
+
+
+def _release_notice(kind, transaction_uuid, delivered):
+    if not settings.POSTBACK_DELIVERED_TIMEOUT:
+        return
+    key = NOTICE_KEY % (kind, transaction_uuid)
+    if delivered:
+        cache.set(key, DELIVERED, settings.POSTBACK_DELIVERED_TIMEOUT)
+    else:
+        # Let a new notice be queued.
+        cache.delete(key)
+    cache.delete(CLAIM_KEY % (kind, transaction_uuid))
+
+
+def _notify_once(notifier_task, kind, transaction_uuid, send):
+    """
+    Call send() to deliver a notice unless it was delivered already or
+    another task is sending it. send() returns True if the notice was
+    delivered.
+    """
+    task_id = notifier_task.request.id or 'local:%s' % uuid.uuid4()
+    if not _claim_notice(kind, transaction_uuid, task_id):
+        return False
+
+    try:
+        delivered = send()
+    except RetryTaskError:
+        # The notice stays ours until the retry runs.
+        _extend_claim(kind, transaction_uuid, task_id)
+        raise
+    except:
+        _release_notice(kind, transaction_uuid, False)
+        raise
+    _release_notice(kind, transaction_uuid, delivered)
+    return delivered
+
+
+@task
+def drain_outbox(batch_size=None):
+    """
+    Deliver the notices in the outbox that no task is sending, at most
+    batch_size (default: POSTBACK_OUTBOX_BATCH) at a time to each app server
+    and POSTBACK_OUTBOX_LIMIT in all.
+
+    Notices that fail POSTBACK_ATTEMPTS times are given up on and reported
+    to the marketplace together.
+    """
+    batch_size = batch_size or settings.POSTBACK_OUTBOX_BATCH
+    task_id = 'drain:%s' % uuid.uuid4()
+    to_send, given_up = [], []
+    for entry in outbox.pending(limit=settings.POSTBACK_OUTBOX_LIMIT):
+        if entry['attempts'] >= settings.POSTBACK_ATTEMPTS:
+            # Given up on before but the marketplace couldn't be told, so
+            # only tell it, unless a task is still at it.
+            if not cache.get(CLAIM_KEY % (entry['kind'],
+                                          entry['transaction_uuid'])):
+                given_up.append(entry)
+        elif not (entry['url'] and health.is_down(entry['url'])):
+            to_send.append(entry)
+
+    # Notices are claimed and signed a batch at a time, just before they are
+    # sent, so that a drain that dies doesn't keep many of them claimed.
+    delivered = 0
+    for start in range(0, len(to_send), batch_size):
+        by_host = _prepare_batch(to_send[start:start + batch_size], task_id)
+        for host, notices in by_host.items():
+            if health.is_down(notices[0][1]):
+                log.info('Not draining {0} notices to {1} while it is down'
+                         .format(len(notices), host))
+                for entry, url, signed_notice in notices:
+                    _release_notice(entry['kind'], entry['transaction_uuid'],
+                                    False)
+                continue
+            sent, failed = _deliver_batch(notices)
+            delivered += sent
+            given_up.extend(failed)
+
+    # Notices that the marketplace wasn't told about stay in the outbox and
+    # are given up on again next time.
+    if given_up:
+        reported = notify_failures([(entry['url'], entry['transaction_uuid'])
+                                    for entry in given_up])
+        for entry in given_up:
+            if (entry['url'], entry['transaction_uuid']) in reported:
+                outbox.remove(entry['kind'], entry['transaction_uuid'])
+    log.info('Drained {0} notices from the outbox, gave up on {1}'
+             .format(delivered, len(given_up)))
+    return delivered
+
+
+def _prepare_batch(entries, task_id):
+    """
+    Claim and sign the notices of outbox entries for task_id.
+
+    Returns a dict of app server to a list of (entry, url, signed notice).
+    """
+    by_host = {}
+    for entry in entries:
+        kind, transaction_uuid = entry['kind'], entry['transaction_uuid']
+        if not _claim_notice(kind, transaction_uuid, task_id):
+            continue
+        try:
+            transaction = client.get_transaction(transaction_uuid,
+                                                 fresh=True)
+            extra_response = None
+            if kind == 'chargeback':
+                extra_response = {'reason': entry['kw'].get('reason', '')}
+            url, signed_notice = _sign_notice(transaction, extra_response)
+        except Exception:
+            log.exception('Could not prepare {0} notice for transaction {1}'
+                          .format(kind, transaction_uuid))
+            _release_notice(kind, transaction_uuid, False)
+            continue
+        by_host.setdefault(health.host(url), []).append(
+            (entry, url, signed_notice))
+    return by_host
+
+
+def _deliver_batch(batch):
+    """
+    Post a batch of (entry, url, signed notice) to one app server.
+
+    Returns the number delivered and a list of the outbox entries of the
+    notices given up on.
+    """
+    start = time.time()
+    results = dispatcher.post_many([(url, {'notice': signed_notice})
+                                    for entry, url, signed_notice in batch])
+    took = time.time() - start
+    delivered, given_up = 0, []
+    for (entry, url, signed_notice), (res, exc) in zip(batch, results):
+        kind, transaction_uuid = entry['kind'], entry['transaction_uuid']
+        if exc is None:
+            try:
+                check_notice_response(res, url, transaction_uuid)
+            except (RequestException, ValueError), exc:
+                pass
+        health.record(url, exc is None, took)
+        if exc is None:
+            statsd.incr('purchase.outbox.delivered')
+            outbox.remove(kind, transaction_uuid)
+            _release_notice(kind, transaction_uuid, True)
+            delivered += 1
+            continue
+
+        statsd.incr('purchase.outbox.failed')
+        entry = outbox.attempted(kind, transaction_uuid, url,
+                                 format_exception(exc))
+        _release_notice(kind, transaction_uuid, False)
+        if entry and entry['attempts'] >= settings.POSTBACK_ATTEMPTS:
+            given_up.append(entry)
+    return delivered, given_up
 
 
 def _fake_amount(price_point):
@@ -366,8 +732,10 @@ def simulate_notify(issuer_key, pay_request, trans_uuid=None, **kw):
         raise NotImplementedError('Not sure how to simulate %s' % sim)
 
     log.info('Sending simulate notice %s to %s' % (sim, issuer_key))
+    # The uuid is new on every attempt, so the notice isn't cached.
     _notify(simulate_notify, trans, extra_response=extra_response,
-            simulated=sim_flag, task_args=[issuer_key, pay_request])
+            simulated=sim_flag, task_args=[issuer_key, pay_request],
+            cache=False)
 
 
 @task(**notify_kw)
@@ -392,7 +760,7 @@ def free_notify(notes, solitude_buyer_uuid, **kw):
     }
     extra_response = {'solitude_buyer_uuid': solitude_buyer_uuid}
     log.info("Sending free notice: trans['uuid']={u}".format(u=trans['uuid']))
-    _notify(free_notify, trans, extra_response=extra_response)
+    _notify(free_notify, trans, extra_response=extra_response, cache=False)
 
 
 def get_icon_url(request):
@@ -433,36 +801,57 @@ def get_icon_url(request):
 
 
 def _notify(notifier_task, trans, extra_response=None, simulated=NOT_SIMULATED,
-            task_args=None):
+            task_args=None, kind=None, cache=True):
     """
     Post JWT notice to an app server about a payment.
+
+    :param kind: 'payment' or 'chargeback' for notices in the outbox.
+    :param cache: False to not keep the prepared notice for retries, for
+        transactions that aren't in solitude.
     """
     # TODO(Kumar) yell if transaction is not completed?
-    typ, url = _prepare_notice(trans)
-    response = {'transactionID': trans['uuid']}
-    notes = trans['notes']
+    url, signed_notice = _sign_notice(trans, extra_response, cache=cache)
     if not task_args:
         task_args = [trans['uuid']]
+    success, last_error = send_pay_notice(url, trans['type'], signed_notice,
+                                          trans['uuid'], notifier_task,
+                                          task_args, simulated=simulated,
+                                          kind=kind)
+    return success
+
 
-    if extra_response:
-        response.update(extra_response)
-
-    response['price'] = {'amount': trans['amount'],
-                         'currency': trans['currency']}
-    issued_at = gmtime()
-    notice = {'iss': settings.NOTIFY_ISSUER,
-              'aud': notes['issuer_key'],
-              'typ': typ,
-              'iat': issued_at,
-              'exp': issued_at + 3600,  # Expires in 1 hour
-              'request': notes['pay_request']['request'],
-              'response': response}
-    log.info('preparing notice %s' % notice)
-
-    signed_notice = jwt.encode(notice, get_secret(notes['issuer_key']),
-                               algorithm='HS256')
-    send_pay_notice(url, trans['type'], signed_notice, trans['uuid'],
-                    notifier_task, task_args, simulated=simulated)
+def _sign_notice(trans, extra_response=None, cache=True):
+    """
+    Return the URL to post the notice of a transaction to and the signed
+    notice.
+
+    The notice is prepared once for each amount, currency and type of the
+    transaction, and kept for retries unless cache is False.
+    """
+    key = notices.prepared_key(trans, extra_response)
+    prepared = notices.get_prepared(key) if cache else None
+    if prepared is None:
+        typ, url = _prepare_notice(trans)
+        response = {'transactionID': trans['uuid']}
+        notes = trans['notes']
+
+        if extra_response:
+            response.update(extra_response)
+
+        response['price'] = {'amount': trans['amount'],
+                             'currency': trans['currency']}
+        # iat and exp are added when it is signed.
+        notice = {'iss': settings.NOTIFY_ISSUER,
+                  'aud': notes['issuer_key'],
+                  'typ': typ,
+                  'request': notes['pay_request']['request'],
+                  'response': response}
+        log.info('preparing notice %s' % notice)
+        prepared = notices.prepare(key, url, notes['issuer_key'], notice,
+                                   cache=cache)
+
+    return prepared['url'], notices.sign(
+        prepared, get_secret(prepared['issuer_key']))
 
 
 def _prepare_notice(trans):
@@ -0,0 +1,95 @@
+import httplib
+import threading
+import urllib2
+from StringIO import StringIO
+
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_
+from requests.exceptions import ConnectionError
+
+from lib.transport import KeepAliveAdapter, PooledAdapter
+from webpay.base.tests import TestCase
+from webpay.pay.dispatcher import Dispatcher
+
+
+class TestDispatcher(TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher()
+
+    def test_session(self):
+        session, slots = self.dispatcher._setup()
+        adapter = session.adapters['https://']
+        ok_(isinstance(adapter, KeepAliveAdapter))
+        ok_(not isinstance(adapter, PooledAdapter))
+        eq_(adapter.name, 'postback')
+        eq_(self.dispatcher._setup()[0], session)
+
+    @mock.patch('webpay.pay.dispatcher.os')
+    def test_new_session_after_fork(self, os_):
+        os_.getpid.return_value = 1
+        session = self.dispatcher._setup()[0]
+        os_.getpid.return_value = 2
+        ok_(self.dispatcher._setup()[0] is not session)
+
+    def test_no_cookies(self):
+        session = self.dispatcher._setup()[0]
+        response = mock.Mock()
+        response.info.return_value = httplib.HTTPMessage(
+            StringIO('Set-Cookie: sessionid=app-a\r\n\r\n'))
+        session.cookies.extract_cookies(
+            response, urllib2.Request('http://app-a.com/postback'))
+        eq_(len(session.cookies), 0)
+
+    @mock.patch('webpay.pay.dispatcher.pooled_session')
+    def test_post(self, pooled_session):
+        post = pooled_session.return_value.post
+        eq_(self.dispatcher.post('http://app/postback', {'notice': 'x'}),
+            post.return_value)
+        post.assert_called_with('http://app/postback', {'notice': 'x'},
+                                timeout=5)
+
+    @override_settings(POSTBACK_CONCURRENCY=2)
+    @mock.patch('webpay.pay.dispatcher.pooled_session')
+    def test_concurrency(self, pooled_session):
+        lock = threading.Lock()
+        sending = [0]
+        most = [0]
+        release = threading.Event()
+
+        def post(url, data, timeout):
+            with lock:
+                sending[0] += 1
+                most[0] = max(most[0], sending[0])
+            release.wait(1)
+            with lock:
+                sending[0] -= 1
+
+        pooled_session.return_value.post.side_effect = post
+        threads = [threading.Thread(target=self.dispatcher.post,
+                                    args=('http://app/', {}))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        ok_(most[0] <= 2, most[0])
+        eq_(pooled_session.return_value.post.call_count, 5)
+
+    @mock.patch('webpay.pay.dispatcher.pooled_session')
+    def test_post_many(self, pooled_session):
+        error = ConnectionError('nope')
+
+        def post(url, data, timeout):
+            if url == 'http://down/':
+                raise error
+            return url
+
+        pooled_session.return_value.post.side_effect = post
+        eq_(self.dispatcher.post_many([('http://a/', {}),
+                                       ('http://down/', {}),
+                                       ('http://b/', {})]),
+            [('http://a/', None), (None, error), ('http://b/', None)])
@@ -0,0 +1,101 @@
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_
+
+from webpay.base.tests import TestCase
+from webpay.pay import health
+
+URL = 'https://App.com/postback'
+
+
+@override_settings(POSTBACK_HOST_FAILURES=3, POSTBACK_HOST_DOWN=60,
+                   POSTBACK_MIN_DELAY=10, POSTBACK_DELAY=300)
+class TestHealth(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def fail(self, times):
+        for i in range(times):
+            health.record(URL, False, 0.1)
+
+    def test_host(self):
+        eq_(health.host(URL), 'app.com')
+
+    def test_unknown(self):
+        eq_(health.get_health(URL)['failures'], 0)
+        ok_(not health.is_down(URL))
+
+    def test_record(self):
+        health.record(URL, True, 1)
+        health.record('https://app.com/chargeback', False, 2)
+        state = health.get_health(URL)
+        eq_(state['failures'], 1)
+        eq_(round(state['error_rate'], 2), 0.3)
+        eq_(round(state['latency'], 2), 0.81)
+
+    def test_down(self):
+        self.fail(2)
+        ok_(not health.is_down(URL))
+        self.fail(1)
+        ok_(health.is_down(URL))
+        ok_(not health.is_down('https://other.com/postback'))
+
+    def test_up_again(self):
+        self.fail(3)
+        health.record(URL, True, 0.1)
+        ok_(not health.is_down(URL))
+        eq_(health.get_health(URL)['failures'], 0)
+
+    @mock.patch('webpay.pay.health.time')
+    def test_down_expires(self, time_):
+        time_.time.return_value = 1000
+        self.fail(3)
+        time_.time.return_value = 1061
+        ok_(not health.is_down(URL))
+
+    def test_never_down(self):
+        with self.settings(POSTBACK_HOST_FAILURES=0):
+            self.fail(10)
+            ok_(not health.is_down(URL))
+        self.fail(3)
+        with self.settings(POSTBACK_HOST_FAILURES=0):
+            ok_(not health.is_down(URL))
+
+    @mock.patch('webpay.pay.health.random.uniform')
+    def test_retry_delay_healthy(self, uniform):
+        uniform.side_effect = lambda low, high: high
+        eq_(health.retry_delay(URL, 0), 10)
+        eq_(health.retry_delay(URL, 2), 40)
+        eq_(health.retry_delay(URL, 10), 300)
+
+    @mock.patch('webpay.pay.health.random.uniform')
+    def test_retry_delay_unhealthy(self, uniform):
+        uniform.side_effect = lambda low, high: high
+        health.record(URL, False, 0.1)
+        health.record(URL, False, 0.1)
+        eq_(health.retry_delay(URL, 0), 300)
+
+    @mock.patch('webpay.pay.health.random.uniform')
+    def test_retry_delay_slow(self, uniform):
+        uniform.side_effect = lambda low, high: high
+        health.record(URL, True, 10)
+        eq_(health.retry_delay(URL, 0), 300)
+
+    @mock.patch('webpay.pay.health.time')
+    @mock.patch('webpay.pay.health.random.uniform')
+    def test_retry_delay_down(self, uniform, time_):
+        uniform.side_effect = lambda low, high: low
+        time_.time.return_value = 1000
+        health.record(URL, True, 0.1)
+        with self.settings(POSTBACK_HOST_FAILURES=1, POSTBACK_DELAY=20,
+                           POSTBACK_HOST_DOWN=600):
+            health.record(URL, False, 0.1)
+            eq_(health.retry_delay(URL, 0), 600)
+
+    def test_retry_delay_jitter(self):
+        delays = set(health.retry_delay(URL, 3) for i in range(10))
+        ok_(len(delays) > 1)
+        ok_(all(40 <= delay <= 80 for delay in delays))
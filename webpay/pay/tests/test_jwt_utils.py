@@ -0,0 +1,79 @@
+import json
+
+from django.conf import settings
+from django.test import TestCase
+
+import jwt
+import mock
+from mozpay.exc import InvalidJWT, RequestExpired
+from nose.tools import eq_, raises
+
+from webpay.base.utils import gmtime
+from webpay.pay.jwt_utils import ParsedJWT
+
+
+class TestParsedJWT(TestCase):
+
+    def setUp(self):
+        now = gmtime()
+        self.payload = {'iss': 'some-issuer', 'aud': settings.DOMAIN,
+                        'iat': now, 'exp': now + 3600,
+                        'request': {'pricePoint': 1}}
+
+    def parse(self, secret='secret', **kw):
+        self.payload.update(kw)
+        return ParsedJWT(jwt.encode(self.payload, secret))
+
+    def test_parse(self):
+        parsed = self.parse()
+        eq_(parsed.payload, self.payload)
+        eq_(parsed.header['alg'], 'HS256')
+        eq_(parsed.issuer, 'some-issuer')
+
+    @raises(jwt.DecodeError)
+    def test_segments(self):
+        ParsedJWT('not-a-jwt')
+
+    @raises(jwt.DecodeError)
+    def test_encoding(self):
+        ParsedJWT('not.a.jwt')
+
+    def test_verify(self):
+        payload = self.parse().verify(settings.DOMAIN, 'secret',
+                                      required_keys=['request.pricePoint'])
+        eq_(payload['request'], self.payload['request'])
+
+    def test_decoded_once(self):
+        token = jwt.encode(self.payload, 'secret')
+        with mock.patch('webpay.pay.jwt_utils.json.loads',
+                        wraps=json.loads) as loads:
+            ParsedJWT(token).verify(settings.DOMAIN, 'secret')
+        # Once for the header and once for the payload.
+        eq_(loads.call_count, 2)
+
+    @raises(InvalidJWT)
+    def test_bad_sig(self):
+        self.parse().verify_sig('other secret')
+
+    @raises(InvalidJWT)
+    def test_none_alg(self):
+        parsed = self.parse()
+        parsed.header['alg'] = 'none'
+        parsed.verify_sig('secret')
+
+    @raises(InvalidJWT)
+    def test_missing_issuer(self):
+        self.parse(iss='').verify(settings.DOMAIN, 'secret')
+
+    @raises(InvalidJWT)
+    def test_wrong_aud(self):
+        self.parse().verify('somewhere.else', 'secret')
+
+    @raises(InvalidJWT)
+    def test_missing_keys(self):
+        self.parse().verify(settings.DOMAIN, 'secret',
+                            required_keys=['request.name'])
+
+    @raises(RequestExpired)
+    def test_expired(self):
+        self.parse(exp=gmtime() - 10).verify(settings.DOMAIN, 'secret')
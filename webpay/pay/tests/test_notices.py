@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.test.utils import override_settings
+
+import jwt
+import mock
+from nose.tools import eq_, ok_
+
+from lib.solitude import constants
+from webpay.base.tests import TestCase
+from webpay.pay import notices, tasks
+
+
+class TestSign(TestCase):
+
+    def notice(self, name='Sword'):
+        return {'iss': 'webpay', 'aud': 'app', 'typ': 'postback',
+                'request': {'name': name, 'locales': {u'fr': u'Épée'}},
+                'response': {'transactionID': 'tx:1'}}
+
+    def sign(self, notice, secret='secret'):
+        prepared = notices.prepare('key', 'http://app/', 'app', notice)
+        return notices.sign(prepared, secret, issued_at=1000)
+
+    def test_sign(self):
+        # Whatever the length, so the encoded part is aligned every way.
+        for name in ('Sword', 'Swords', 'Swordss'):
+            data = jwt.decode(self.sign(self.notice(name)), 'secret',
+                              verify=True)
+            eq_(data, dict(self.notice(name), iat=1000,
+                           exp=1000 + notices.NOTICE_LIFETIME))
+
+    def test_same_as_jwt(self):
+        signed = self.sign(self.notice())
+        eq_(signed.split('.')[0],
+            jwt.encode({}, 'secret', algorithm='HS256').split('.')[0])
+        eq_(jwt.decode(signed, verify=False),
+            jwt.decode(jwt.encode(dict(self.notice(), iat=1000, exp=4600),
+                                  'secret', algorithm='HS256'),
+                       verify=False))
+
+    def test_unicode_secret(self):
+        jwt.decode(self.sign(self.notice(), secret=u'sécret'),
+                   u'sécret'.encode('utf-8'), verify=True)
+
+    def test_now(self):
+        prepared = notices.prepare('key', 'http://app/', 'app', self.notice())
+        data = jwt.decode(notices.sign(prepared, 'secret'), verify=False)
+        ok_(data['iat'] > 1000)
+
+    def test_not_cached(self):
+        notices.prepare('key', 'http://app/', 'app', self.notice())
+        eq_(notices.get_prepared('key'), None)
+
+    def test_not_kept(self):
+        with self.settings(NOTICE_CACHE_TIMEOUT=60):
+            notices.prepare('key', 'http://app/', 'app', self.notice(),
+                            cache=False)
+            eq_(notices.get_prepared('key'), None)
+
+    def test_key(self):
+        trans = {'uuid': 'tx:1', 'amount': 1, 'currency': 'USD'}
+        eq_(notices.prepared_key(trans), notices.prepared_key(trans, {}))
+        ok_(notices.prepared_key(trans, {'reason': 'refund'}) !=
+            notices.prepared_key(trans, {'reason': 'reversal'}))
+        ok_(notices.prepared_key(trans) !=
+            notices.prepared_key(dict(trans, amount=2)))
+
+
+@override_settings(NOTICE_CACHE_TIMEOUT=60)
+class TestSignNotice(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        notices.prepared_cache.local.clear()
+        notices.secret_cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(notices.prepared_cache.local.clear)
+        self.addCleanup(notices.secret_cache.clear)
+        self.trans = {
+            'uuid': 'tx:1', 'amount': 1, 'currency': 'USD',
+            'type': constants.TYPE_PAYMENT,
+            'notes': {'issuer_key': 'app',
+                      'pay_request': {'request': {
+                          'postbackURL': 'http://app/postback',
+                          'chargebackURL': 'http://app/chargeback'}}}}
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_retry(self, slumber):
+        slumber.generic.product.get_object_or_404.return_value = {
+            'secret': 'secret'}
+        url, first = tasks._sign_notice(self.trans)
+        # The notes aren't looked at again.
+        del self.trans['notes']
+        url, second = tasks._sign_notice(self.trans)
+        eq_(url, 'http://app/postback')
+        eq_(jwt.decode(first, 'secret')['request'],
+            jwt.decode(second, 'secret')['request'])
+        eq_(slumber.generic.product.get_object_or_404.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_amount_changed(self, slumber):
+        slumber.generic.product.get_object_or_404.return_value = {
+            'secret': 'secret'}
+        tasks._sign_notice(self.trans)
+        self.trans['amount'] = 2
+        url, signed = tasks._sign_notice(self.trans)
+        eq_(jwt.decode(signed, 'secret')['response']['price']['amount'], 2)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_not_kept(self, slumber):
+        slumber.generic.product.get_object_or_404.return_value = {
+            'secret': 'secret'}
+        tasks._sign_notice(self.trans, cache=False)
+        eq_(notices.get_prepared(notices.prepared_key(self.trans)), None)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_chargeback(self, slumber):
+        slumber.generic.product.get_object_or_404.return_value = {
+            'secret': 'secret'}
+        tasks._sign_notice(self.trans)
+        self.trans['type'] = constants.TYPE_REFUND
+        url, signed = tasks._sign_notice(self.trans, {'reason': 'refund'})
+        eq_(url, 'http://app/chargeback')
+        eq_(jwt.decode(signed, 'secret')['response']['reason'], 'refund')
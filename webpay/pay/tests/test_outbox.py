@@ -0,0 +1,346 @@
+from StringIO import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test.utils import override_settings
+
+import mock
+from nose.tools import eq_, ok_
+from requests.exceptions import ConnectionError
+
+from webpay.base.tests import TestCase
+from webpay.pay import outbox, tasks
+from webpay.pay.utils import send_pay_notice
+
+
+@override_settings(POSTBACK_OUTBOX_TIMEOUT=60)
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def pending(self):
+        return [entry['transaction_uuid'] for entry in outbox.pending()]
+
+
+class TestOutbox(OutboxTest):
+
+    def test_add(self):
+        outbox.add('chargeback', 'tx:1', reason='refund')
+        entry = outbox.get('chargeback', 'tx:1')
+        eq_(entry['kind'], 'chargeback')
+        eq_(entry['kw'], {'reason': 'refund'})
+        eq_(entry['attempts'], 0)
+
+    def test_add_twice(self):
+        outbox.add('payment', 'tx:1')
+        outbox.attempted('payment', 'tx:1', 'http://app/postback',
+                         'Timeout: nope')
+        outbox.add('payment', 'tx:1')
+        eq_(outbox.get('payment', 'tx:1')['attempts'], 1)
+        eq_(self.pending(), ['tx:1'])
+
+    def test_attempted(self):
+        outbox.add('payment', 'tx:1')
+        entry = outbox.attempted('payment', 'tx:1', 'http://app/postback',
+                                 'Timeout: nope')
+        eq_(entry['attempts'], 1)
+        eq_(outbox.get('payment', 'tx:1')['last_error'], 'Timeout: nope')
+        eq_(outbox.get('payment', 'tx:1')['url'], 'http://app/postback')
+
+    def test_attempted_unknown(self):
+        eq_(outbox.attempted('payment', 'tx:1', 'http://app/postback', ''),
+            None)
+
+    def test_kinds(self):
+        outbox.add('payment', 'tx:1')
+        outbox.add('chargeback', 'tx:1', reason='refund')
+        outbox.attempted('chargeback', 'tx:1', 'http://app/chargeback',
+                         'Timeout: nope')
+        eq_(outbox.get('payment', 'tx:1')['attempts'], 0)
+        outbox.remove('payment', 'tx:1')
+        eq_([entry['kind'] for entry in outbox.pending()], ['chargeback'])
+
+    def test_pending(self):
+        for n in range(5):
+            outbox.add('payment', 'tx:%s' % n)
+        outbox.remove('payment', 'tx:0')
+        outbox.remove('payment', 'tx:3')
+        eq_(self.pending(), ['tx:1', 'tx:2', 'tx:4'])
+        # The slot of the first delivered notice isn't read again.
+        eq_(cache.get(outbox.HEAD_KEY), 2)
+
+    def test_pending_readded(self):
+        outbox.add('payment', 'tx:1')
+        outbox.remove('payment', 'tx:1')
+        outbox.add('payment', 'tx:2')
+        outbox.add('payment', 'tx:1')
+        eq_(self.pending(), ['tx:2', 'tx:1'])
+
+    def test_pending_limit(self):
+        for n in range(5):
+            outbox.add('payment', 'tx:%s' % n)
+        eq_([e['transaction_uuid'] for e in outbox.pending(limit=2)],
+            ['tx:0', 'tx:1'])
+        eq_(len(self.pending()), 5)
+
+    def test_pending_many(self):
+        with mock.patch.object(outbox, 'READ_SIZE', 2):
+            for n in range(5):
+                outbox.add('payment', 'tx:%s' % n)
+            eq_(len(self.pending()), 5)
+
+    def test_empty(self):
+        outbox.add('payment', 'tx:1')
+        outbox.remove('payment', 'tx:1')
+        eq_(self.pending(), [])
+        eq_(cache.get(outbox.HEAD_KEY), 2)
+
+    def test_tail_lost(self):
+        outbox.add('payment', 'tx:1')
+        outbox.remove('payment', 'tx:1')
+        self.pending()
+        cache.delete(outbox.TAIL_KEY)
+        outbox.add('payment', 'tx:2')
+        eq_(self.pending(), ['tx:2'])
+
+    def test_disabled(self):
+        with self.settings(POSTBACK_OUTBOX_TIMEOUT=0):
+            outbox.add('payment', 'tx:1')
+            eq_(outbox.get('payment', 'tx:1'), None)
+            eq_(self.pending(), [])
+
+
+class TestQueueNotice(OutboxTest):
+
+    @mock.patch('webpay.pay.tasks.payment_notify')
+    def test_added(self, payment_notify):
+        payment_notify.delay.side_effect = IOError
+        with self.assertRaises(IOError):
+            tasks.queue_notice('payment', 'tx:1')
+        # The notice can still be drained.
+        eq_(self.pending(), ['tx:1'])
+
+
+def response(text):
+    res = mock.Mock()
+    res.text = text
+    return res
+
+
+@mock.patch('webpay.pay.utils.dispatcher.post')
+class TestSendPayNotice(OutboxTest):
+
+    def send(self, **kwargs):
+        self.task = mock.Mock()
+        self.task.request.retries = 0
+        self.task.request.kwargs = kwargs
+        return send_pay_notice('http://app/postback', 1, 'signed', 'tx:1',
+                               self.task, ['tx:1'], kind='payment')
+
+    def test_delivered(self, post):
+        outbox.add('payment', 'tx:1')
+        post.return_value = response('tx:1')
+        self.send()
+        eq_(outbox.get('payment', 'tx:1'), None)
+
+    def test_attempted(self, post):
+        outbox.add('payment', 'tx:1')
+        post.side_effect = ConnectionError('nope')
+        self.send()
+        eq_(outbox.get('payment', 'tx:1')['attempts'], 1)
+
+    @override_settings(POSTBACK_ATTEMPTS=5)
+    def test_host_down_retries(self, post):
+        # Earlier retries were skipped while the host was down, so they
+        # aren't counted.
+        post.side_effect = ConnectionError('nope')
+        self.send(host_down=2)
+        kw = self.task.retry.call_args[1]
+        eq_(kw['kwargs'], {'host_down': 2})
+        eq_(kw['max_retries'], 7)
+
+    def give_up(self):
+        task = mock.Mock()
+        task.request.retries = 5
+        task.request.kwargs = {}
+        task.retry.side_effect = ConnectionError('nope')
+        send_pay_notice('http://app/postback', 1, 'signed', 'tx:1', task,
+                        ['tx:1'], kind='payment')
+
+    @mock.patch('webpay.pay.utils.notify_failure')
+    def test_given_up(self, notify_failure, post):
+        outbox.add('payment', 'tx:1')
+        post.side_effect = ConnectionError('nope')
+        self.give_up()
+        eq_(outbox.get('payment', 'tx:1'), None)
+        ok_(notify_failure.called)
+
+    @mock.patch('webpay.pay.utils.notify_failure')
+    def test_given_up_not_reported(self, notify_failure, post):
+        outbox.add('payment', 'tx:1')
+        post.side_effect = ConnectionError('nope')
+        notify_failure.side_effect = ConnectionError('nope')
+        with self.assertRaises(ConnectionError):
+            self.give_up()
+        ok_(outbox.get('payment', 'tx:1'))
+
+
+@override_settings(POSTBACK_DELIVERED_TIMEOUT=60, POSTBACK_ATTEMPTS=2)
+@mock.patch('webpay.pay.tasks.notify_failures')
+@mock.patch('webpay.pay.tasks.dispatcher.post_many')
+@mock.patch('webpay.pay.tasks._sign_notice')
+@mock.patch('webpay.pay.tasks.client.get_transaction')
+class TestDrain(OutboxTest):
+
+    def setup(self, get_transaction, sign_notice, urls):
+        self.urls = urls
+        for uuid in urls:
+            outbox.add('payment', uuid)
+        get_transaction.side_effect = lambda uuid, fresh: {'uuid': uuid}
+        sign_notice.side_effect = (lambda trans, extra:
+                                   (urls[trans['uuid']], trans['uuid']))
+
+    def test_drain(self, get_transaction, sign_notice, post_many,
+                   notify_failures):
+        self.setup(get_transaction, sign_notice,
+                   {'tx:1': 'http://a/', 'tx:2': 'http://b/',
+                    'tx:3': 'http://a/'})
+        post_many.side_effect = self.echo
+        eq_(tasks.drain_outbox(batch_size=5), 3)
+        eq_(self.pending(), [])
+        # One batch per app server.
+        eq_(sorted(len(c[0][0]) for c in post_many.call_args_list), [1, 2])
+        eq_(cache.get(tasks.NOTICE_KEY % ('payment', 'tx:2')),
+            tasks.DELIVERED)
+        ok_(not notify_failures.called)
+
+    def echo(self, posts):
+        # The notices are signed as their transaction uuid, so answer with
+        # that.
+        return [(response(data['notice']), None) for url, data in posts]
+
+    def test_batches(self, get_transaction, sign_notice, post_many,
+                     notify_failures):
+        self.setup(get_transaction, sign_notice,
+                   dict(('tx:%s' % n, 'http://a/') for n in range(5)))
+        post_many.side_effect = self.echo
+        eq_(tasks.drain_outbox(batch_size=2), 5)
+        eq_([len(c[0][0]) for c in post_many.call_args_list], [2, 2, 1])
+
+    def test_failed(self, get_transaction, sign_notice, post_many,
+                    notify_failures):
+        self.setup(get_transaction, sign_notice, {'tx:1': 'http://a/'})
+        post_many.return_value = [(None, ConnectionError('nope'))]
+        notify_failures.side_effect = lambda failures: failures
+        eq_(tasks.drain_outbox(), 0)
+        entry = outbox.get('payment', 'tx:1')
+        eq_(entry['attempts'], 1)
+        eq_(entry['last_error'], 'ConnectionError: nope')
+        eq_(cache.get(tasks.NOTICE_KEY % ('payment', 'tx:1')), None)
+
+        tasks.drain_outbox()
+        eq_(self.pending(), [])
+        notify_failures.assert_called_with([('http://a/', 'tx:1')])
+
+    def test_not_reported(self, get_transaction, sign_notice, post_many,
+                          notify_failures):
+        self.setup(get_transaction, sign_notice, {'tx:1': 'http://a/'})
+        post_many.return_value = [(None, ConnectionError('nope'))]
+        notify_failures.return_value = []
+        tasks.drain_outbox()
+        tasks.drain_outbox()
+        eq_(notify_failures.call_count, 1)
+        eq_(self.pending(), ['tx:1'])
+        # It is given up on again next time, without sending it again.
+        tasks.drain_outbox()
+        eq_(post_many.call_count, 2)
+        notify_failures.assert_called_with([('http://a/', 'tx:1')])
+        eq_(notify_failures.call_count, 2)
+
+    def test_limit(self, get_transaction, sign_notice, post_many,
+                   notify_failures):
+        self.setup(get_transaction, sign_notice,
+                   dict(('tx:%s' % n, 'http://a/') for n in range(5)))
+        post_many.side_effect = self.echo
+        with self.settings(POSTBACK_OUTBOX_LIMIT=3):
+            eq_(tasks.drain_outbox(), 3)
+        eq_(len(self.pending()), 2)
+
+    def test_claimed_per_batch(self, get_transaction, sign_notice,
+                               post_many, notify_failures):
+        self.setup(get_transaction, sign_notice,
+                   {'tx:1': 'http://a/', 'tx:2': 'http://a/'})
+        claimed = []
+
+        def post(posts):
+            claimed.append([bool(cache.get(tasks.CLAIM_KEY % ('payment', u)))
+                            for u in ['tx:1', 'tx:2']])
+            return self.echo(posts)
+
+        post_many.side_effect = post
+        eq_(tasks.drain_outbox(batch_size=1), 2)
+        # Only the notice being sent is claimed.
+        eq_([sum(c) for c in claimed], [1, 1])
+
+    def test_wrong_response(self, get_transaction, sign_notice, post_many,
+                            notify_failures):
+        self.setup(get_transaction, sign_notice, {'tx:1': 'http://a/'})
+        post_many.return_value = [(response('<html>'), None)]
+        eq_(tasks.drain_outbox(), 0)
+        entry = outbox.get('payment', 'tx:1')
+        ok_(entry['last_error'].startswith('ValueError'))
+
+    def test_being_sent(self, get_transaction, sign_notice, post_many,
+                        notify_failures):
+        self.setup(get_transaction, sign_notice, {'tx:1': 'http://a/'})
+        cache.set(tasks.CLAIM_KEY % ('payment', 'tx:1'), 'some-task')
+        eq_(tasks.drain_outbox(), 0)
+        ok_(not get_transaction.called)
+        ok_(not post_many.called)
+
+    def test_host_down(self, get_transaction, sign_notice, post_many,
+                       notify_failures):
+        self.setup(get_transaction, sign_notice, {'tx:1': 'http://a/'})
+        with mock.patch('webpay.pay.tasks.health.is_down') as is_down:
+            is_down.return_value = True
+            eq_(tasks.drain_outbox(), 0)
+        ok_(not post_many.called)
+        eq_(self.pending(), ['tx:1'])
+        eq_(cache.get(tasks.NOTICE_KEY % ('payment', 'tx:1')), None)
+
+    def test_chargeback(self, get_transaction, sign_notice, post_many,
+                        notify_failures):
+        self.setup(get_transaction, sign_notice, {})
+        outbox.add('chargeback', 'tx:1', reason='refund')
+        sign_notice.side_effect = None
+        sign_notice.return_value = ('http://a/', 'tx:1')
+        post_many.side_effect = self.echo
+        tasks.drain_outbox()
+        eq_(sign_notice.call_args[0][1], {'reason': 'refund'})
+
+
+@override_settings(POSTBACK_OUTBOX_TIMEOUT=60)
+class TestCommand(OutboxTest):
+
+    def call(self, **kw):
+        out = StringIO()
+        call_command('notice_outbox', stdout=out, **kw)
+        return out.getvalue()
+
+    def test_list(self):
+        outbox.add('payment', 'tx:1')
+        outbox.attempted('payment', 'tx:1', 'http://app/postback',
+                         'Timeout: nope')
+        out = self.call()
+        ok_('tx:1 payment' in out, out)
+        ok_('attempts=1' in out, out)
+        ok_('Timeout: nope' in out, out)
+        ok_('1 notices pending' in out, out)
+
+    @mock.patch('webpay.pay.management.commands.notice_outbox.drain_outbox')
+    def test_drain(self, drain_outbox):
+        drain_outbox.return_value = 3
+        ok_('Delivered 3 notices' in self.call(drain=True, batch=5))
+        drain_outbox.assert_called_with(batch_size=5)
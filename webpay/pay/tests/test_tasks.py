@@ -3,9 +3,12 @@ import urllib2
 from urllib import urlencode
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import RequestFactory
 
+from celery.exceptions import RetryTaskError
+
 import fudge
 from fudge.inspector import arg
 import jwt
@@ -26,7 +29,9 @@ from webpay.base.tests import TestCase
 from webpay.base.utils import gmtime
 from webpay.constants import TYP_CHARGEBACK, TYP_POSTBACK
 from webpay.pay import tasks
+from webpay.pay.health import HostDown
 from webpay.pay.samples import JWTtester
+from webpay.pay.utils import wait_for_status
 
 from .test_views import sample
 
@@ -74,7 +79,7 @@ class TestNotifyApp(NotifyTest):
         with self.settings(INAPP_KEY_PATHS={None: sample}, DEBUG=True):
             tasks.payment_notify('some:uuid')
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_pay(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -97,7 +102,7 @@ class TestNotifyApp(NotifyTest):
                                  .expects('raise_for_status'))
         self.notify()
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_refund_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -120,7 +125,7 @@ class TestNotifyApp(NotifyTest):
                                  .expects('raise_for_status'))
         self.do_chargeback('refund')
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_notify_reversal_chargeback(self, fake_req, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -138,7 +143,7 @@ class TestNotifyApp(NotifyTest):
                                  .expects('raise_for_status'))
         self.do_chargeback('reversal')
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_notify_marketplace(self, marketplace, solitude, requests):
@@ -147,7 +152,7 @@ class TestNotifyApp(NotifyTest):
         self.notify()
         assert marketplace.webpay.failure.called
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_notify_timeout(self, marketplace, solitude, requests):
@@ -157,7 +162,27 @@ class TestNotifyApp(NotifyTest):
 
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_host_down(self, post, retry, slumber):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.set_secret_mock(slumber, 'f')
+        post.side_effect = RequestException('500 error')
+        with self.settings(POSTBACK_HOST_FAILURES=1):
+            self.notify()
+            eq_(post.call_count, 1)
+            self.notify()
+        eq_(post.call_count, 1)
+        eq_(retry.call_count, 2)
+        eq_(retry.call_args[1]['exc'].__class__, HostDown)
+        # Skipping the notice doesn't use up an attempt.
+        eq_(retry.call_args[1]['kwargs'], {'host_down': 1})
+        eq_(retry.call_args[1]['max_retries'],
+            settings.POSTBACK_ATTEMPTS + 1)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -165,7 +190,7 @@ class TestNotifyApp(NotifyTest):
         assert post.called, 'notification was sent'
         assert retry.called, 'task should be retried after error'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_any_error(self, fake_req, marketplace, solitude):
@@ -173,7 +198,7 @@ class TestNotifyApp(NotifyTest):
         fake_req.expects('post').raises(RequestException('some http error'))
         self.notify()
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     @mock.patch('lib.marketplace.api.client.api')
     def test_bad_status(self, fake_req, marketplace, solitude):
@@ -186,7 +211,7 @@ class TestNotifyApp(NotifyTest):
         self.notify()
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
     def test_notify_retries(self, retry, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -195,7 +220,7 @@ class TestNotifyApp(NotifyTest):
         assert retry.called, 'task should be retried after error'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
     def test_notify_wrong(self, retry, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -204,7 +229,7 @@ class TestNotifyApp(NotifyTest):
         assert retry.called, 'task should be retried after error'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.payment_notify.retry')
     def test_trim_notices(self, retry, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -214,7 +239,7 @@ class TestNotifyApp(NotifyTest):
         assert not retry.called, 'task should not be retried on success'
 
     @mock.patch('lib.solitude.api.client.slumber')
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.utils.notify_failure')
     def test_failure_notifies(self, notify, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -222,7 +247,7 @@ class TestNotifyApp(NotifyTest):
         self.notify()
         assert notify.called, 'failure notification sent'
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     @mock.patch('lib.solitude.api.client.slumber')
     def test_signed_app_response(self, fake_req, slumber):
         app_payment = self.payload()
@@ -261,6 +286,175 @@ class TestNotifyApp(NotifyTest):
         self.notify()
 
 
+class TestNotifyOnce(TestNotifyApp):
+    # The tests of TestNotifyApp run again with delivered notices remembered.
+
+    def setUp(self):
+        super(TestNotifyOnce, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        p = self.settings(POSTBACK_DELIVERED_TIMEOUT=60)
+        p.enable()
+        self.addCleanup(p.disable)
+        self.key = tasks.NOTICE_KEY % ('payment', self.trans_uuid)
+        self.claim_key = tasks.CLAIM_KEY % ('payment', self.trans_uuid)
+
+    def ok(self, post):
+        post.return_value.text = self.trans_uuid
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_delivered_once(self, post, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.ok(post)
+        self.notify()
+        eq_(cache.get(self.key), tasks.DELIVERED)
+        self.notify()
+        eq_(post.call_count, 1)
+        # The second task didn't even look up the secret.
+        eq_(slumber.generic.product.get_object_or_404.call_count, 1)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_chargeback_after_payment(self, post, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.ok(post)
+        self.notify()
+        self.do_chargeback('refund')
+        eq_(post.call_count, 2)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_chargeback_signals(self, post, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.ok(post)
+        self.do_chargeback('refund')
+        eq_(wait_for_status(self.trans_uuid, constants.STATUS_ENDED, 0),
+            constants.STATUS_COMPLETED)
+
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_in_flight(self, post):
+        cache.set(self.key, tasks.QUEUED)
+        cache.set(self.claim_key, 'another-task')
+        self.notify()
+        ok_(not post.called)
+        eq_(cache.get(self.claim_key), 'another-task')
+
+    def test_claim_race(self):
+        cache.set(self.key, tasks.QUEUED)
+        # Both tasks saw the notice queued, only one of them gets it.
+        with mock.patch.object(cache, 'get') as get:
+            get.return_value = tasks.QUEUED
+            ok_(tasks._claim_notice('payment', self.trans_uuid, 'task-1'))
+            ok_(not tasks._claim_notice('payment', self.trans_uuid,
+                                        'task-2'))
+        eq_(cache.get(self.claim_key), 'task-1')
+        # Retries of the task that has it still have it.
+        ok_(tasks._claim_notice('payment', self.trans_uuid, 'task-1'))
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_queued(self, post, slumber):
+        self.set_secret_mock(slumber, 'f')
+        self.ok(post)
+        cache.set(self.key, tasks.QUEUED)
+        self.notify()
+        eq_(post.call_count, 1)
+        eq_(cache.get(self.key), tasks.DELIVERED)
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_retry_keeps_claim(self, post, retry, slumber):
+        self.set_secret_mock(slumber, 'f')
+        post.side_effect = RequestException('500 error')
+        retry.side_effect = RetryTaskError()
+        with self.assertRaises(RetryTaskError):
+            self.notify()
+        ok_(cache.get(self.claim_key))
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.tasks.payment_notify.retry')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    @mock.patch('webpay.pay.tasks.uuid.uuid4')
+    def test_retry_extends_claim(self, uuid4, post, retry, slumber):
+        # Retries run with the id of the task.
+        uuid4.return_value = 'task'
+        self.set_secret_mock(slumber, 'f')
+        post.side_effect = RequestException('500 error')
+        retry.side_effect = RetryTaskError()
+        # However many retries are skipped while the host is down, the claim
+        # is kept for another _notice_timeout() after each of them.
+        with self.settings(POSTBACK_HOST_FAILURES=1):
+            for attempt in range(3):
+                with mock.patch.object(cache, 'set',
+                                       wraps=cache.set) as cache_set:
+                    with self.assertRaises(RetryTaskError):
+                        self.notify()
+                cache_set.assert_any_call(self.claim_key, 'local:task',
+                                          tasks._notice_timeout())
+                cache_set.assert_any_call(self.key, tasks.QUEUED,
+                                          tasks._notice_timeout())
+        eq_(post.call_count, 1)
+        eq_(retry.call_args[1]['kwargs'], {'host_down': 1})
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    @mock.patch('webpay.pay.utils.notify_failure')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
+    def test_failure_releases(self, post, notify_failure, slumber):
+        self.set_secret_mock(slumber, 'f')
+        post.side_effect = RequestException('500 error')
+        self.notify()
+        eq_(cache.get(self.key), None)
+        eq_(cache.get(self.claim_key), None)
+
+    @mock.patch('lib.solitude.api.client.get_transaction')
+    def test_error_releases(self, get_transaction):
+        get_transaction.side_effect = ObjectDoesNotExist
+        with self.assertRaises(ObjectDoesNotExist):
+            tasks.payment_notify(self.trans_uuid)
+        eq_(cache.get(self.key), None)
+
+
+class TestQueueNotice(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        p = mock.patch('webpay.pay.tasks.payment_notify')
+        self.payment_notify = p.start()
+        self.addCleanup(p.stop)
+
+    @mock.patch.object(settings, 'POSTBACK_DELIVERED_TIMEOUT', 60)
+    def test_queue_once(self):
+        ok_(tasks.queue_notice('payment', 'some:uuid'))
+        ok_(not tasks.queue_notice('payment', 'some:uuid'))
+        self.payment_notify.delay.assert_called_once_with('some:uuid')
+        eq_(cache.get(tasks.NOTICE_KEY % ('payment', 'some:uuid')),
+            tasks.QUEUED)
+
+    @mock.patch.object(settings, 'POSTBACK_DELIVERED_TIMEOUT', 60)
+    @mock.patch('webpay.pay.tasks.chargeback_notify')
+    def test_kinds(self, chargeback_notify):
+        tasks.queue_notice('payment', 'some:uuid')
+        tasks.queue_notice('chargeback', 'some:uuid', reason='refund')
+        self.payment_notify.delay.assert_called_once_with('some:uuid')
+        chargeback_notify.delay.assert_called_once_with('some:uuid',
+                                                        reason='refund')
+
+    @mock.patch.object(settings, 'POSTBACK_DELIVERED_TIMEOUT', 60)
+    def test_queue_failed(self):
+        self.payment_notify.delay.side_effect = IOError
+        with self.assertRaises(IOError):
+            tasks.queue_notice('payment', 'some:uuid')
+        eq_(cache.get(tasks.NOTICE_KEY % ('payment', 'some:uuid')), None)
+
+    def test_disabled(self):
+        tasks.queue_notice('payment', 'some:uuid')
+        tasks.queue_notice('payment', 'some:uuid')
+        eq_(self.payment_notify.delay.call_count, 2)
+
+
 @mock.patch('lib.solitude.api.client.slumber')
 class TestFreeInAppNotifications(NotifyTest):
 
@@ -276,7 +470,7 @@ class TestFreeInAppNotifications(NotifyTest):
             }
         tasks.free_notify(notes, solitude_buyer_uuid)
 
-    @mock.patch('webpay.pay.utils.requests')
+    @mock.patch('webpay.pay.utils.dispatcher')
     @mock.patch('webpay.pay.tasks.free_notify.retry')
     def test_notify_retries(self, retry, requests, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -295,7 +489,7 @@ class TestSimulatedNotifications(NotifyTest):
         tasks.simulate_notify('issuer-key', payload,
                               trans_uuid=self.trans_uuid)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_postback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         payload = self.payload(typ=TYP_POSTBACK,
@@ -316,7 +510,7 @@ class TestSimulatedNotifications(NotifyTest):
                                  .expects('raise_for_status'))
         self.notify(payload)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_chargeback(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         req = {'simulate': {'result': 'chargeback'}}
@@ -338,7 +532,7 @@ class TestSimulatedNotifications(NotifyTest):
                                  .expects('raise_for_status'))
         self.notify(payload)
 
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_chargeback_reason(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         reason = 'something'
@@ -362,7 +556,7 @@ class TestSimulatedNotifications(NotifyTest):
         self.notify(payload)
 
     @mock.patch('webpay.pay.tasks.simulate_notify.retry')
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     def test_retry_http_error(self, post, retry, slumber):
         self.set_secret_mock(slumber, 'f')
         post.side_effect = RequestException('500 error')
@@ -374,10 +568,10 @@ class TestSimulatedNotifications(NotifyTest):
 
         assert post.called, 'notification was sent'
         assert retry.called, 'task should be retried after error'
-        retry.assert_called_with(args=['issuer-key', payload],
+        retry.assert_called_with(args=['issuer-key', payload], kwargs={},
                                  max_retries=ANY, eta=ANY, exc=ANY)
 
-    @mock.patch('webpay.pay.utils.requests.post')
+    @mock.patch('webpay.pay.utils.dispatcher.post')
     @mock.patch('webpay.pay.utils.notify_failure')
     def test_no_notifications_on_simulate(self, notify_failure, post, slumber):
         self.set_secret_mock(slumber, 'f')
@@ -389,7 +583,7 @@ class TestSimulatedNotifications(NotifyTest):
         assert not notify_failure.called, 'Notification should not be sent'
 
     @raises(IndexError)
-    @fudge.patch('webpay.pay.utils.requests')
+    @fudge.patch('webpay.pay.utils.dispatcher')
     def test_no_tier(self, slumber, fake_req):
         self.set_secret_mock(slumber, 'f')
         payload = self.payload(typ=TYP_POSTBACK,
@@ -404,6 +598,8 @@ class TestSimulatedNotifications(NotifyTest):
 class BaseStartPay(test_utils.TestCase):
 
     def setUp(self):
+        # Prices are memoized.
+        cache.clear()
         self.issue = 'some-public-id'
         self.user_uuid = 'some-user-uuid'
         self.transaction_uuid = 'webpay:some-id'
@@ -605,6 +801,77 @@ class TestStartPay(BaseStartPay):
         self.start()
         self.solitude.generic.transaction.assert_called_with(5)
 
+    @mock.patch('lib.solitude.api.ProviderHelper.start_transaction')
+    def test_transaction_returned(self, start_transaction):
+        start_transaction.return_value = ('bill', 'http://pay/', 1,
+                                          {'resource_pk': 7})
+        self.start()
+        assert not self.solitude.generic.transaction.get_object.called
+        self.solitude.generic.transaction.assert_called_with(7)
+
+    def test_signals_pending(self):
+        self.start()
+        eq_(wait_for_status(self.transaction_uuid,
+                            (constants.STATUS_PENDING,), 0),
+            constants.STATUS_PENDING)
+
+    def test_signals_failed(self):
+        self.solitude.generic.transaction.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.start()
+        eq_(wait_for_status(self.transaction_uuid, constants.STATUS_ENDED, 0),
+            constants.STATUS_FAILED)
+
+    def speculate(self):
+        prices = mock.Mock()
+        prices.get_object.return_value = self.prices
+        self.mkt.webpay.prices.return_value = prices
+        with mock.patch('webpay.pay.tasks.get_icon_url') as get_icon_url:
+            get_icon_url.return_value = 'http://mkt-cdn/media/icon.png'
+            tasks.speculate_pay(self.transaction_uuid, self.issue,
+                                self.notes['pay_request'])
+
+    @mock.patch.object(settings, 'SPECULATIVE_CONFIGURE', True)
+    def test_speculative_configuration_used(self):
+        self.speculate()
+        self.set_billing_id(self.solitude, 123)
+        with mock.patch('webpay.pay.tasks.resolve_product') as resolve:
+            self.start()
+        ok_(not resolve.called)
+        eq_(self.solitude.bango.billing.post.call_args[0][0]['prices'],
+            self.prices['prices'])
+        # It is only used once.
+        ok_(not cache.get(tasks.SPECULATIVE_KEY % self.transaction_uuid))
+
+    @mock.patch.object(settings, 'SPECULATIVE_CONFIGURE', True)
+    def test_speculative_configuration_other_providers(self):
+        self.speculate()
+        mcc, mnc = api.BokuProvider.network_data.keys()[0]
+        self.notes['network'] = {'mcc': mcc, 'mnc': mnc}
+        self.providers = api.ProviderHelper.supported_providers(
+            mcc=mcc, mnc=mnc)
+        with mock.patch('webpay.pay.tasks.resolve_product') as resolve:
+            resolve.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                self.start()
+        resolve.assert_called_with(self.issue, self.notes['pay_request'],
+                                   ['boku', 'bango'])
+
+    @mock.patch.object(settings, 'SPECULATIVE_CONFIGURE', True)
+    def test_speculative_configuration_failed(self):
+        self.solitude.generic.product.get_object_or_404.side_effect = (
+            ObjectDoesNotExist)
+        self.speculate()
+        ok_(not cache.get(tasks.SPECULATIVE_KEY % self.transaction_uuid))
+
+    def test_speculative_configuration_disabled(self):
+        self.speculate()
+        with mock.patch('webpay.pay.tasks.resolve_product') as resolve:
+            resolve.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                self.start()
+        ok_(resolve.called)
+
     def test_price_used(self):
         prices = mock.Mock()
         prices.get.return_value = self.prices
@@ -1,9 +1,22 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.test import RequestFactory
 from django.test.utils import override_settings
 
-from nose.tools import raises
+import mock
+from nose.tools import eq_, ok_, raises
+from requests.exceptions import ConnectionError
 
+from lib.solitude.constants import ACCESS_PURCHASE
 from webpay.base.tests import TestCase
-from webpay.pay.utils import verify_urls
+from webpay.base.utils import gmtime
+from webpay.pay.tasks import get_secret
+from webpay.pay.utils import (cache_verified, cached_verified,
+                              invalidate_issuer, issuer_cache, long_poll_wait,
+                              ISSUER_REFRESH_KEY, lookup_issuer,
+                              notify_failures, refresh_issuer, signal_status,
+                              UnknownIssuer, verify_urls, wait_for_status)
 
 
 @override_settings(ALLOWED_CALLBACK_SCHEMES=['http', 'https'])
@@ -24,3 +37,231 @@ class TestVerifyURLs(TestCase):
     def test_https_only(self):
         with self.settings(ALLOWED_CALLBACK_SCHEMES=['https']):
             verify_urls('http://foo.com')
+
+
+@override_settings(ISSUER_CACHE_TIMEOUT=60, ISSUER_CACHE_NEGATIVE_TIMEOUT=60)
+@mock.patch('lib.solitude.api.client.get_active_product')
+class TestLookupIssuer(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        issuer_cache.local.clear()
+        self.product = {'secret': 's', 'access': ACCESS_PURCHASE,
+                        'seller_uuids': {'bango': 'b'}, 'public_id': 'iss'}
+
+    def test_marketplace(self, get_active_product):
+        eq_(lookup_issuer(settings.KEY), (settings.SECRET, None))
+        assert not get_active_product.called
+
+    def test_cached(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        secret, product = lookup_issuer('iss')
+        eq_(secret, 's')
+        eq_(product, {'secret': 's', 'access': ACCESS_PURCHASE,
+                      'seller_uuids': {'bango': 'b'}})
+        eq_(get_active_product.call_count, 1)
+
+    def test_unknown_cached(self, get_active_product):
+        get_active_product.side_effect = ObjectDoesNotExist
+        for x in range(2):
+            with self.assertRaises(UnknownIssuer):
+                lookup_issuer('iss')
+        eq_(get_active_product.call_count, 1)
+
+    def test_invalidate(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        invalidate_issuer('iss')
+        lookup_issuer('iss')
+        eq_(get_active_product.call_count, 2)
+
+    def test_disabled(self, get_active_product):
+        get_active_product.return_value = self.product
+        with self.settings(ISSUER_CACHE_TIMEOUT=0):
+            lookup_issuer('iss')
+            lookup_issuer('iss')
+        eq_(get_active_product.call_count, 2)
+
+    def test_refresh_new_secret(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        get_active_product.return_value = dict(self.product, secret='new')
+        eq_(refresh_issuer('iss', 's'), 'new')
+        eq_(lookup_issuer('iss')[0], 'new')
+        eq_(get_active_product.call_count, 2)
+
+    def test_refresh_same_secret(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        eq_(refresh_issuer('iss', 's'), None)
+        # What was cached is still used.
+        lookup_issuer('iss')
+        eq_(get_active_product.call_count, 2)
+
+    def test_refresh_limited(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        for x in range(5):
+            refresh_issuer('iss', 's')
+        eq_(get_active_product.call_count, 2)
+        cache.delete(ISSUER_REFRESH_KEY % 'iss')
+        refresh_issuer('iss', 's')
+        eq_(get_active_product.call_count, 3)
+
+    def test_refresh_not_cached(self, get_active_product):
+        eq_(refresh_issuer('iss', 's'), None)
+        eq_(refresh_issuer(settings.KEY, 's'), None)
+        ok_(not get_active_product.called)
+
+    def test_refresh_gone(self, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        get_active_product.side_effect = ObjectDoesNotExist
+        eq_(refresh_issuer('iss', 's'), None)
+        with self.assertRaises(UnknownIssuer):
+            lookup_issuer('iss')
+
+    @mock.patch('lib.solitude.api.client.slumber')
+    def test_get_secret(self, slumber, get_active_product):
+        get_active_product.return_value = self.product
+        lookup_issuer('iss')
+        eq_(get_secret('iss'), 's')
+        assert not slumber.generic.product.get_object_or_404.called
+
+
+@override_settings(VERIFIED_JWT_CACHE_TIMEOUT=3600)
+class TestVerifiedCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        now = gmtime()
+        self.pay_req = {'iat': now, 'exp': now + 600}
+
+    def test_cached(self):
+        cache_verified('a.b.c', self.pay_req, {'verified': True})
+        eq_(cached_verified('a.b.c'), {'verified': True})
+        eq_(cached_verified('d.e.f'), None)
+
+    @mock.patch('webpay.pay.utils.cache')
+    def test_timeout_exp(self, cache_):
+        cache_verified('a.b.c', self.pay_req, {})
+        ok_(595 < cache_.set.call_args[0][2] <= 600)
+
+    @mock.patch('webpay.pay.utils.cache')
+    def test_timeout_iat(self, cache_):
+        self.pay_req['iat'] -= 3500
+        cache_verified('a.b.c', self.pay_req, {})
+        ok_(95 < cache_.set.call_args[0][2] <= 100)
+
+    def test_expired(self):
+        self.pay_req['exp'] = gmtime() - 1
+        cache_verified('a.b.c', self.pay_req, {})
+        eq_(cached_verified('a.b.c'), None)
+
+    def test_disabled(self):
+        with self.settings(VERIFIED_JWT_CACHE_TIMEOUT=0):
+            cache_verified('a.b.c', self.pay_req, {})
+            eq_(cached_verified('a.b.c'), None)
+
+
+class TestWaitForStatus(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_signalled(self):
+        signal_status('trans', 0)
+        eq_(wait_for_status('trans', (0,), 1), 0)
+
+    @mock.patch('webpay.pay.utils.time')
+    def test_signalled_while_waiting(self, time_):
+        time_.time.return_value = 0
+        time_.sleep.side_effect = lambda seconds: signal_status('trans', 1)
+        eq_(wait_for_status('trans', (1,), 10), 1)
+        eq_(time_.sleep.call_count, 1)
+
+    @mock.patch('webpay.pay.utils.time')
+    def test_timeout(self, time_):
+        time_.time.side_effect = [0, 0, 0.25, 0.5]
+        signal_status('trans', 0)
+        eq_(wait_for_status('trans', (1, 4), 0.5), None)
+        eq_(time_.sleep.call_count, 2)
+
+
+@override_settings(LONG_POLL_TIMEOUT=10)
+class TestLongPollWait(TestCase):
+
+    def wait(self, **params):
+        return long_poll_wait(RequestFactory().get('/', params))
+
+    def test_no_wait(self):
+        eq_(self.wait(), 0)
+
+    def test_wait(self):
+        eq_(self.wait(wait='5'), 5)
+
+    def test_invalid(self):
+        eq_(self.wait(wait='soon'), 0)
+
+    def test_limited(self):
+        eq_(self.wait(wait='60'), 10)
+
+    @mock.patch('webpay.pay.utils.remaining_time')
+    def test_deadline(self, remaining_time):
+        remaining_time.return_value = 6
+        eq_(self.wait(wait='60'), 3)
+        remaining_time.return_value = -1
+        eq_(self.wait(wait='60'), 0)
+
+    def test_disabled(self):
+        with self.settings(LONG_POLL_TIMEOUT=0):
+            eq_(self.wait(wait='5'), 0)
+
+
+class TestNotifyFailures(TestCase):
+
+    def failures(self, api, failing=()):
+        """
+        Give each transaction its own failure resource in the marketplace
+        and return their patch methods by transaction.
+        """
+        patches = {}
+
+        def failure(trans_id):
+            patches[trans_id] = mock.Mock()
+            if trans_id in failing:
+                patches[trans_id].side_effect = ConnectionError
+            return mock.Mock(patch=patches[trans_id])
+
+        api.webpay.failure.side_effect = failure
+        return patches
+
+    def reported(self, api):
+        """Report two failures and return what was sent for each."""
+        patches = self.failures(api)
+        notify_failures([('http://a/', 'tx:1'), ('http://b/', 'tx:2')])
+        # The failures can be reported in any order.
+        return dict((trans_id, [c[0][0] for c in patch.call_args_list])
+                    for trans_id, patch in patches.items())
+
+    def expected(self):
+        return {'tx:1': [{'attempts': settings.POSTBACK_ATTEMPTS,
+                          'url': 'http://a/'}],
+                'tx:2': [{'attempts': settings.POSTBACK_ATTEMPTS,
+                          'url': 'http://b/'}]}
+
+    @mock.patch('webpay.pay.utils.client.api')
+    def test_notify(self, api):
+        eq_(self.reported(api), self.expected())
+
+    @override_settings(PARALLEL_UPSTREAM_CALLS=True)
+    @mock.patch('webpay.pay.utils.client.api')
+    def test_notify_parallel(self, api):
+        eq_(self.reported(api), self.expected())
+
+    @mock.patch('webpay.pay.utils.client.api')
+    def test_report_failed(self, api):
+        self.failures(api, failing=['tx:1'])
+        eq_(notify_failures([('http://a/', 'tx:1'), ('http://b/', 'tx:2')]),
+            [('http://b/', 'tx:2')])
@@ -4,8 +4,11 @@ import time
 from datetime import datetime
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
+from django.test import RequestFactory
+from django.test.utils import override_settings
 
 import mock
 from nose import SkipTest
@@ -19,8 +22,9 @@ from lib.solitude import constants
 
 from webpay.base import dev_messages as msg
 from webpay.base.tests import BasicSessionCase
-from webpay.pay import get_wait_url
+from webpay.pay import get_wait_url, views
 from webpay.pay.samples import JWTtester
+from webpay.pay.utils import issuer_cache, lookup_issuer
 
 from . import Base, sample
 
@@ -143,6 +147,27 @@ class TestVerify(Base):
         payload = self.request(iss=self.key, app_secret=self.secret + '.nope')
         eq_(self.get(payload).status_code, 400)
 
+    @override_settings(ISSUER_CACHE_TIMEOUT=60)
+    @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
+    def test_inapp_new_secret(self, get_active_product):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        issuer_cache.local.clear()
+        self.addCleanup(issuer_cache.local.clear)
+        get_active_product.return_value = {'secret': 'old',
+                                           'access': constants.ACCESS_PURCHASE}
+        lookup_issuer(self.key)
+        self.set_secret(get_active_product)
+        request = RequestFactory().get('/')
+        payload = self.request(iss=self.key, app_secret=self.secret)
+        with mock.patch('lib.marketplace.api.MarketplaceAPI.get_price'):
+            verified = views._verify_pay_req(request, {'req': payload})
+        eq_(verified['issuer_key'], self.key)
+        # Bad JWTs don't look the issuer up every time.
+        bad = self.request(iss=self.key, app_secret=self.secret + '.nope')
+        eq_(self.get(bad).status_code, 400)
+        eq_(get_active_product.call_count, 2)
+
     @mock.patch('lib.solitude.api.SolitudeAPI.get_active_product')
     def test_inapp_wrong_key(self, get_active_product):
         get_active_product.side_effect = ObjectDoesNotExist
@@ -245,7 +270,7 @@ class TestVerify(Base):
         payload = self.request(payload=payjwt)
         eq_(self.get(payload).status_code, 400)
 
-    @mock.patch('webpay.pay.views.verify_jwt')
+    @mock.patch('webpay.pay.jwt_utils.ParsedJWT.verify')
     def test_request_expired(self, verify):
         verify.side_effect = RequestExpired({})
         payload = self.request(app_secret=self.secret)
@@ -280,6 +305,53 @@ class TestVerify(Base):
         eq_(res.status_code, 200)
         eq_(self.client.session['is_simulation'], True)
 
+    @mock.patch.object(settings, 'VERIFIED_JWT_CACHE_TIMEOUT', 60)
+    def test_reload_cached(self):
+        cache.clear()
+        payjwt = self.payload()
+        payjwt['request']['simulate'] = {'result': 'postback'}
+        payload = self.request(payload=payjwt)
+        eq_(self.get(payload).status_code, 200)
+        with mock.patch('webpay.pay.views.VerifyForm') as form:
+            res = self.get(payload)
+        eq_(res.status_code, 200)
+        ok_(not form.called)
+        eq_(self.client.session['notes']['pay_request']['request']['name'],
+            payjwt['request']['name'])
+
+    @mock.patch.object(settings, 'VERIFIED_JWT_CACHE_TIMEOUT', 60)
+    @mock.patch.object(settings, 'ALLOW_ANDROID_PAYMENTS', False)
+    def test_reload_cached_disabled(self):
+        cache.clear()
+        payjwt = self.payload()
+        payjwt['request']['simulate'] = {'result': 'postback'}
+        payload = self.request(payload=payjwt)
+        eq_(self.get(payload).status_code, 200)
+        ua = 'Mozilla/5.0 (Android; Mobile; rv:31.0) Gecko/31.0 Firefox/31.0'
+        res = self.get(payload, HTTP_USER_AGENT=ua)
+        self.assertContains(res, msg.PAY_DISABLED, status_code=503)
+
+    @mock.patch.object(settings, 'SPECULATIVE_CONFIGURE', True)
+    @mock.patch('webpay.pay.tasks.speculate_pay.delay')
+    def test_speculative_configure(self, speculate_pay):
+        payjwt = self.payload()
+        request = RequestFactory().get('/')
+        request.session = {}
+        eq_(views.process_pay_req(
+            request, data={'req': self.request(payload=payjwt)}), None)
+        speculate_pay.assert_called_with(request.session['trans_id'],
+                                         settings.KEY, mock.ANY)
+        eq_(speculate_pay.call_args[0][2]['request']['id'],
+            payjwt['request']['id'])
+
+    @mock.patch.object(settings, 'SPECULATIVE_CONFIGURE', True)
+    @mock.patch('webpay.pay.tasks.speculate_pay.delay')
+    def test_no_speculative_configure_for_simulations(self, speculate_pay):
+        payjwt = self.payload()
+        payjwt['request']['simulate'] = {'result': 'postback'}
+        eq_(self.get(self.request(payload=payjwt)).status_code, 200)
+        ok_(not speculate_pay.called)
+
     def test_unknown_simulation(self):
         payjwt = self.payload()
         payjwt['request']['simulate'] = {'result': '<script>alert()</script>'}
@@ -527,6 +599,24 @@ class TestWaitToStart(Base):
         eq_(data['url'], None)
         eq_(data['status'], constants.STATUS_RECEIVED)
 
+    @mock.patch('webpay.pay.views.wait_for_status')
+    def test_start_long_poll(self, wait_for_status):
+        self.fake_transaction(status=constants.STATUS_PENDING)
+        with self.settings(LONG_POLL_TIMEOUT=10):
+            res = self.client.get(self.start, {'wait': 5})
+        eq_(json.loads(res.content)['status'], constants.STATUS_PENDING)
+        wait_for_status.assert_called_with(
+            'some:trans',
+            (constants.STATUS_PENDING,) + constants.STATUS_ENDED, 5)
+
+    @mock.patch('webpay.pay.views.wait_for_status')
+    def test_start_no_long_poll(self, wait_for_status):
+        self.fake_transaction(status=constants.STATUS_PENDING)
+        with self.settings(LONG_POLL_TIMEOUT=0):
+            res = self.client.get(self.start, {'wait': 5})
+        eq_(res.status_code, 200)
+        ok_(not wait_for_status.called)
+
     def wait_ended_transaction(self, status):
         with self.settings(VERBOSE_LOGGING=True):
             self.fake_transaction(status=status)
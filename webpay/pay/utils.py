@@ -1,32 +1,64 @@
 from datetime import datetime, timedelta
+import functools
+import hashlib
 import logging
+import time
 from urllib2 import HTTPError
 from urlparse import urlparse
 import uuid
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 
 from celery.exceptions import RetryTaskError
 from django_statsd.clients import statsd
-import requests
 from requests.exceptions import ConnectionError, RequestException
 
+from lib.caching import TieredCache
+from lib.concurrency import run_parallel
 from lib.marketplace.api import client
 from lib.solitude.api import client as solitude
+from webpay.base.logger import remaining_time
+from webpay.base.utils import gmtime
 
+from . import health, outbox
 from .constants import NOT_SIMULATED
+from .dispatcher import dispatcher
 
 log = logging.getLogger('w.pay.utils')
 
+ISSUER_KEY = 'issuer:%s'
+# Known and unknown JWT issuers, see lookup_issuer. Entries are kept in
+# process for at most a minute so invalidation reaches other processes.
+issuer_cache = TieredCache('pay.issuer', maxsize=1000, timeout=60)
+
+ISSUER_REFRESH_KEY = 'issuer_refresh:%s'
+# An issuer is looked up again because a JWT didn't verify with its cached
+# secret at most this often, so bad JWTs can't keep the cache empty.
+ISSUER_REFRESH_INTERVAL = 60
+
+VERIFIED_KEY = 'verified_jwt:%s'
+
+TRANS_STATUS_KEY = 'trans_status:%s'
+# Long enough to cover a buyer going through the payment provider.
+TRANS_STATUS_TIMEOUT = 60 * 30
+# How often a long poll looks for a new status.
+LONG_POLL_INTERVAL = 0.25
+# The share of the time left before the request deadline that a long poll
+# can wait for, so that the worker has plenty left to ask solitude for the
+# transaction and answer well before it is timed out.
+LONG_POLL_SHARE = 0.5
+
 
 def format_exception(exception):
     return u'%s: %s' % (exception.__class__.__name__, exception)
 
 
 def send_pay_notice(url, notice_type, signed_notice, trans_id,
-                    notifier_task, task_args, simulated=NOT_SIMULATED):
+                    notifier_task, task_args, simulated=NOT_SIMULATED,
+                    kind=None):
     """
     Send app a notification about a payment or chargeback.
 
@@ -47,6 +79,8 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
         A list of args to send to the task when retrying after failures.
     **simulated**
         Type of payment simulation. The default is none.
+    **kind**
+        'payment' or 'chargeback' for notices that are in the outbox.
 
     A tuple of (url, success, last_error) is returned.
 
@@ -60,31 +94,37 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
     log.info('about to notify %s of notice type %s' % (url, notice_type))
     exception = None
     success = False
+    start = time.time()
     try:
+        if health.is_down(url):
+            statsd.incr('purchase.send_pay_notice.skipped')
+            raise health.HostDown('Not sending notices to {0} while it is '
+                                  'down'.format(health.host(url)))
         with statsd.timer('purchase.send_pay_notice'):
-            res = requests.post(url, {'notice': signed_notice}, timeout=5)
-        res.raise_for_status()  # raise exception for non-200s
-        res_content = res.text.strip()
-
-        # Raise an exception if the content didn't match.
-        if res_content != str(trans_id):
-            response_hint = res_content[:len(trans_id) * 2]
-            log.error('URL {u} did not respond with transaction {t} '
-                      'for notification; response: {r}'
-                      .format(u=url, t=trans_id, r=repr(response_hint)))
-            raise ValueError('Incorrect notification response '
-                             'from: {0}'.format(url))
+            res = dispatcher.post(url, {'notice': signed_notice}, timeout=5)
+        check_notice_response(res, url, trans_id)
 
     except (ConnectionError, HTTPError,
             RequestException, ValueError), exception:
         log.error('Notice for transaction %s raised exception in URL %s'
                   % (trans_id, url), exc_info=True)
+        if not isinstance(exception, health.HostDown):
+            health.record(url, False, time.time() - start)
+        outbox.attempted(kind, trans_id, url, format_exception(exception))
+        retries = getattr(notifier_task.request, 'retries', None) or 0
+        # Notices that weren't sent because the host was down don't count
+        # towards POSTBACK_ATTEMPTS, the task keeps track of them itself.
+        kwargs = dict(getattr(notifier_task.request, 'kwargs', None) or {})
+        if isinstance(exception, health.HostDown):
+            kwargs['host_down'] = kwargs.get('host_down', 0) + 1
         try:
             notifier_task.retry(
                 args=task_args,
+                kwargs=kwargs,
                 eta=(datetime.now() +
-                     timedelta(seconds=settings.POSTBACK_DELAY)),
-                max_retries=settings.POSTBACK_ATTEMPTS,
+                     timedelta(seconds=health.retry_delay(url, retries))),
+                max_retries=(settings.POSTBACK_ATTEMPTS +
+                             kwargs.get('host_down', 0)),
                 exc=exception)
 
         # Retry actually raises an exception, so let that through.
@@ -100,10 +140,15 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
                 # TODO(Kumar): Fix the API for this in bug 847537
                 log.info('Not notifying anyone about simulated failure '
                          'for %r' % trans_id)
+            # Only now, so that drain_outbox gives up on it again if the
+            # marketplace couldn't be told.
+            outbox.remove(kind, trans_id)
             return False, format_exception(final_exception)
 
     else:
         success = True
+        health.record(url, True, time.time() - start)
+        outbox.remove(kind, trans_id)
         log.debug('URL %s responded OK for transaction %s '
                   'notification' % (url, trans_id))
 
@@ -115,6 +160,24 @@ def send_pay_notice(url, notice_type, signed_notice, trans_id,
     return success, last_error
 
 
+def check_notice_response(res, url, trans_id):
+    """
+    Raise an exception unless the app server responded to a notice with
+    the transaction ID.
+    """
+    res.raise_for_status()  # raise exception for non-200s
+    res_content = res.text.strip()
+
+    # Raise an exception if the content didn't match.
+    if res_content != str(trans_id):
+        response_hint = res_content[:len(trans_id) * 2]
+        log.error('URL {u} did not respond with transaction {t} '
+                  'for notification; response: {r}'
+                  .format(u=url, t=trans_id, r=repr(response_hint)))
+        raise ValueError('Incorrect notification response '
+                         'from: {0}'.format(url))
+
+
 def notify_failure(url, trans_id):
     statsd.incr('purchase.send_pay_notice.failure')
     client.api.webpay.failure(trans_id).patch({
@@ -123,6 +186,33 @@ def notify_failure(url, trans_id):
     log.exception('Retries failed to %s: %s:' % (url, trans_id))
 
 
+def notify_failures(failures):
+    """
+    Tell the marketplace about a list of (url, trans_id) of notices that
+    couldn't be delivered. Returns the ones that it was told about.
+    """
+    statsd.incr('purchase.send_pay_notice.failure', len(failures))
+
+    def report(url, trans_id):
+        try:
+            client.api.webpay.failure(trans_id).patch({
+                'attempts': settings.POSTBACK_ATTEMPTS,
+                'url': url})
+        except Exception, err:
+            log.error('Failed to report failed notice to {0}: {1}: {2}'
+                      .format(url, trans_id, format_exception(err)))
+            return None
+        return url, trans_id
+
+    # The marketplace takes one failure at a time, so send them all at once.
+    reported = run_parallel(*[functools.partial(report, url, trans_id)
+                              for url, trans_id in failures])
+    log.error('Retries failed for {0} notices: {1}'
+              .format(len(failures), ', '.join('%s: %s' % failure
+                                               for failure in failures)))
+    return [failure for failure in reported if failure]
+
+
 def verify_urls(*urls, **kw):
     is_simulation = kw.pop('is_simulation', False)
     check_postbacks = kw.pop('check_postbacks', True)
@@ -151,29 +241,186 @@ def clear_messages(request):
     list(messages.get_messages(request))
 
 
+def signal_status(transaction_uuid, status):
+    """
+    Tell requests in wait_for_status that the transaction now has the given
+    status.
+    """
+    cache.set(TRANS_STATUS_KEY % transaction_uuid, status,
+              TRANS_STATUS_TIMEOUT)
+
+
+def wait_for_status(transaction_uuid, statuses, timeout):
+    """
+    Wait up to timeout seconds for signal_status to be called with one of
+    statuses and return it, or None if it wasn't.
+
+    Only the cache is checked while waiting, so the caller should still get
+    the transaction from solitude afterwards in case the signal was missed.
+    """
+    key = TRANS_STATUS_KEY % transaction_uuid
+    end = time.time() + timeout
+    while True:
+        status = cache.get(key)
+        if status in statuses:
+            statsd.incr('purchase.long_poll.signalled')
+            return status
+        left = end - time.time()
+        if left <= 0:
+            statsd.incr('purchase.long_poll.timeout')
+            return None
+        time.sleep(min(LONG_POLL_INTERVAL, left))
+
+
+def long_poll_wait(request):
+    """
+    Return the seconds a status request asked to wait for with ?wait=,
+    limited by LONG_POLL_TIMEOUT and by LONG_POLL_SHARE of the time left
+    before the request deadline.
+    """
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+    wait = min(wait, settings.LONG_POLL_TIMEOUT)
+    left = remaining_time()
+    if left is not None:
+        wait = min(wait, left * LONG_POLL_SHARE)
+    return max(wait, 0)
+
+
 class UnknownIssuer(Exception):
     """The JWT issuer is unknown."""
 
 
+def cached_issuer(issuer):
+    """
+    Return the cached secret, access and seller_uuids of an issuer, False if
+    the issuer is known not to exist or None if it isn't cached.
+    """
+    if not settings.ISSUER_CACHE_TIMEOUT:
+        return None
+    return issuer_cache.get(ISSUER_KEY % issuer)
+
+
+def invalidate_issuer(issuer):
+    """
+    Forget what we know about an issuer, for example when its secret
+    doesn't match a JWT any more.
+    """
+    issuer_cache.delete(ISSUER_KEY % issuer)
+
+
+def refresh_issuer(issuer, secret):
+    """
+    Look an issuer up again because a JWT didn't verify with its cached
+    secret, which might be out of date.
+
+    Each issuer is looked up at most once every ISSUER_REFRESH_INTERVAL
+    seconds and the cache is only changed if the secret did. Returns the
+    new secret or None if there isn't one.
+    """
+    if issuer == settings.KEY or not cached_issuer(issuer):
+        # Nothing is cached that could be out of date.
+        return None
+    if not cache.add(ISSUER_REFRESH_KEY % issuer, True,
+                     ISSUER_REFRESH_INTERVAL):
+        log.info('issuer {0} was looked up again recently'.format(issuer))
+        return None
+
+    try:
+        product = solitude.get_active_product(issuer)
+    except ObjectDoesNotExist:
+        # It will be cached as unknown when it is next looked up.
+        invalidate_issuer(issuer)
+        return None
+    if product['secret'] == secret:
+        return None
+
+    log.info('issuer {0} has a new secret'.format(issuer))
+    issuer_cache.set(ISSUER_KEY % issuer, _issuer_entry(product),
+                     settings.ISSUER_CACHE_TIMEOUT)
+    return product['secret']
+
+
+def _issuer_entry(product):
+    return {
+        'secret': product['secret'],
+        'access': product.get('access'),
+        'seller_uuids': product.get('seller_uuids', {}),
+    }
+
+
 def lookup_issuer(issuer):
     """
     Lookup a JWT issuer and return the secret and associated product object.
 
+    In-app issuers are cached, see ISSUER_CACHE_TIMEOUT and
+    ISSUER_CACHE_NEGATIVE_TIMEOUT. The product is a dict of its secret,
+    access and seller_uuids.
+
     Returns a tuple of (issuer_secret, product_object)
     """
     if issuer == settings.KEY:
         # This is a Marketplace app purchase because it matches the settings.
-        active_product = None
-        secret = settings.SECRET
-    else:
+        return settings.SECRET, None
+
+    active_product = cached_issuer(issuer)
+    if active_product is False:
+        log.info('issuer {0} is cached as unknown'.format(issuer))
+        raise UnknownIssuer('issuer {0} does not exist'.format(issuer))
+
+    if active_product is None:
         try:
             # Assuming that the issuer is also going to be the public_id.
-            active_product = solitude.get_active_product(issuer)
+            product = solitude.get_active_product(issuer)
         except ObjectDoesNotExist, err:
             log.info('get_active_product({0}) '
                      'raised {1.__class__.__name__}: {1}'.format(issuer, err))
+            if settings.ISSUER_CACHE_NEGATIVE_TIMEOUT:
+                issuer_cache.set(ISSUER_KEY % issuer, False,
+                                 settings.ISSUER_CACHE_NEGATIVE_TIMEOUT)
             raise UnknownIssuer('{0.__class__.__name__}: {0}'.format(err))
 
-        secret = active_product['secret']
+        active_product = _issuer_entry(product)
+        if settings.ISSUER_CACHE_TIMEOUT:
+            issuer_cache.set(ISSUER_KEY % issuer, active_product,
+                             settings.ISSUER_CACHE_TIMEOUT)
+
+    return active_product['secret'], active_product
+
+
+def _verified_key(raw_jwt):
+    return VERIFIED_KEY % hashlib.sha256(raw_jwt.encode('utf-8')).hexdigest()
+
 
-    return secret, active_product
+def cached_verified(raw_jwt):
+    """
+    Return what was cached by cache_verified for this JWT, or None.
+    """
+    if not settings.VERIFIED_JWT_CACHE_TIMEOUT or not raw_jwt:
+        return None
+    verified = cache.get(_verified_key(raw_jwt))
+    statsd.incr('purchase.verified_jwt.{0}'
+                .format('miss' if verified is None else 'hit'))
+    return verified
+
+
+def cache_verified(raw_jwt, pay_req, verified):
+    """
+    Cache the result of verifying a pay request JWT until the JWT would no
+    longer pass verification, or VERIFIED_JWT_CACHE_TIMEOUT if that is
+    sooner.
+
+    :param raw_jwt: the JWT as it was received.
+    :param pay_req: the verified payload of the JWT.
+    :param verified: what should be returned by cached_verified.
+    """
+    if not settings.VERIFIED_JWT_CACHE_TIMEOUT:
+        return
+    # mozpay rejects a JWT once it has expired or was issued over an hour ago.
+    expires = min(float(pay_req['exp']), float(pay_req['iat']) + 3600)
+    timeout = min(int(expires - gmtime()),
+                  settings.VERIFIED_JWT_CACHE_TIMEOUT)
+    if timeout > 0:
+        cache.set(_verified_key(raw_jwt), verified, timeout)
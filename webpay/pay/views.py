@@ -11,7 +11,6 @@ from django.views.decorators.http import require_GET, require_POST
 
 from django_statsd.clients import statsd
 from mozpay.exc import InvalidJWT, RequestExpired
-from mozpay.verify import verify_jwt
 from session_csrf import anonymous_csrf_exempt
 from tower import ugettext as _
 
@@ -25,18 +24,65 @@ from webpay.pin.forms import VerifyPinForm
 
 from lib.marketplace.api import client as marketplace, UnknownPricePoint
 from lib.solitude import constants
-from lib.solitude.api import client as solitude, ProviderHelper
+from lib.solitude.api import (client as solitude, forget_transaction,
+                              ProviderHelper)
 from lib.solitude.exceptions import ResourceModified
 
 from . import tasks
 from .forms import SuperSimulateForm, VerifyForm, NetCodeForm
-from .utils import clear_messages, trans_id, verify_urls
+from .utils import (cache_verified, cached_verified, clear_messages,
+                    long_poll_wait, refresh_issuer, trans_id, verify_urls,
+                    wait_for_status)
 
 log = getLogger('w.pay')
 
 
 def process_pay_req(request, data=None):
     data = request.GET if data is None else data
+    # A reload of the same JWT doesn't need to be verified again.
+    verified = cached_verified(data.get('req'))
+    if verified is None:
+        verified = _verify_pay_req(request, data)
+        if isinstance(verified, http.HttpResponse):
+            return verified
+    else:
+        log.info('Using the cached verification of the JWT')
+        disabled = _payments_disabled(request, verified['is_simulation'])
+        if disabled:
+            return disabled
+
+    # All validation passed, save state to the session.
+    request.session['is_simulation'] = verified['is_simulation']
+    # This is an ephemeral session value, do not rely on it.
+    # It gets saved to the solitude transaction so you can access it there.
+    # Otherwise it is used for simulations and fake payments.
+    notes = request.session.get('notes', {})
+    notes['pay_request'] = verified['pay_request']
+    notes['issuer_key'] = verified['issuer_key']
+    request.session['notes'] = notes
+    tx = trans_id()
+    log.info('Generated new transaction ID: {tx}'.format(tx=tx))
+    request.session['trans_id'] = tx
+
+    if settings.SPECULATIVE_CONFIGURE and not verified['is_simulation']:
+        # Get a head start on configure_transaction.
+        tasks.speculate_pay.delay(tx, notes['issuer_key'],
+                                  notes['pay_request'])
+
+
+def _payments_disabled(request, is_simulation):
+    if (disabled_by_user_agent(request.META.get('HTTP_USER_AGENT', None)) or
+            (settings.ONLY_SIMULATIONS and not is_simulation)):
+        return custom_error(request,
+                            _('Payments are temporarily disabled.'),
+                            code=msg.PAY_DISABLED, status=503)
+
+
+def _verify_pay_req(request, data):
+    """
+    Verify the pay request JWT in data and return a dict of the trimmed
+    pay_request, issuer_key and is_simulation, or an error response.
+    """
     form = VerifyForm(data)
     if not form.is_valid():
         codes = []
@@ -48,31 +94,38 @@ def process_pay_req(request, data=None):
         codes = ', '.join(codes)
         return app_error(request, code=codes)
 
-    if (disabled_by_user_agent(request.META.get('HTTP_USER_AGENT', None)) or
-            (settings.ONLY_SIMULATIONS and not form.is_simulation)):
-        return custom_error(request,
-                            _('Payments are temporarily disabled.'),
-                            code=msg.PAY_DISABLED, status=503)
+    disabled = _payments_disabled(request, form.is_simulation)
+    if disabled:
+        return disabled
 
-    exc = er = None
-    try:
-        pay_req = verify_jwt(
-            form.cleaned_data['req'],
+    def verify(secret):
+        return form.parsed.verify(
             settings.DOMAIN,  # JWT audience.
-            form.secret,
+            secret,
             required_keys=('request.id',
                            'request.pricePoint',  # A price tier we'll lookup.
                            'request.name',
                            'request.description',
                            'request.postbackURL',
                            'request.chargebackURL'))
+
+    exc = er = None
+    try:
+        try:
+            pay_req = verify(form.secret)
+        except InvalidJWT:
+            # The cached secret might be out of date.
+            secret = refresh_issuer(form.key, form.secret)
+            if not secret:
+                raise
+            pay_req = verify(secret)
     except RequestExpired, exc:
         er = msg.EXPIRED_JWT
     except InvalidJWT, exc:
         er = msg.INVALID_JWT
 
     if exc:
-        log.exception('calling verify_jwt')
+        log.exception('verifying JWT')
         return app_error(request, code=er)
 
     icon_urls = []
@@ -98,19 +151,11 @@ def process_pay_req(request, data=None):
         return app_error(request, code=msg.BAD_PRICE_POINT)
 
     _trim_pay_request(pay_req)
-
-    # All validation passed, save state to the session.
-    request.session['is_simulation'] = form.is_simulation
-    # This is an ephemeral session value, do not rely on it.
-    # It gets saved to the solitude transaction so you can access it there.
-    # Otherwise it is used for simulations and fake payments.
-    notes = request.session.get('notes', {})
-    notes['pay_request'] = pay_req
-    notes['issuer_key'] = form.key
-    request.session['notes'] = notes
-    tx = trans_id()
-    log.info('Generated new transaction ID: {tx}'.format(tx=tx))
-    request.session['trans_id'] = tx
+    verified = {'pay_request': pay_req,
+                'issuer_key': form.key,
+                'is_simulation': form.is_simulation}
+    cache_verified(data['req'], pay_req, verified)
+    return verified
 
 
 @require_POST
@@ -399,6 +444,9 @@ def wait_to_start(request):
 def trans_start_url(request):
     """
     JSON handler to get the Bango payment URL to start a transaction.
+
+    With ?wait=<seconds> the request is held until the transaction is ready
+    to start, or the seconds are up, before answering.
     """
     trans = None
     trans_id = request.session.get('trans_id')
@@ -407,6 +455,10 @@ def trans_start_url(request):
     if not trans_id:
         log.error('trans_start_url(): no transaction ID in session')
         return http.HttpResponseBadRequest()
+    wait = long_poll_wait(request)
+    if wait:
+        wait_for_status(trans_id, (constants.STATUS_PENDING,) +
+                        constants.STATUS_ENDED, wait)
     try:
         statsd.incr('purchase.payment_time.retry')
         with statsd.timer('purchase.payment_time.get_transaction'):
@@ -446,10 +498,11 @@ def _callback_url(request, is_success):
         querystring = http.QueryDict(signed_notice)
         if 'ext_transaction_id' in querystring:
             ext_transaction_id = querystring['ext_transaction_id']
+            forget_transaction(ext_transaction_id)
             if is_success:
-                tasks.payment_notify.delay(ext_transaction_id)
+                tasks.queue_notice('payment', ext_transaction_id)
             else:
-                tasks.chargeback_notify.delay(ext_transaction_id)
+                tasks.queue_notice('chargeback', ext_transaction_id)
             return http.HttpResponse(status=204)
         else:
             statsd.incr('purchase.payment_{0}_callback.incomplete'
@@ -11,9 +11,10 @@ from slumber.exceptions import HttpClientError
 
 from lib.solitude.constants import (
     PROVIDER_BANGO, PROVIDERS_INVERTED, STATUS_CANCELLED, STATUS_COMPLETED,
-    STATUS_FAILED, STATUS_PENDING)
+    STATUS_ENDED, STATUS_FAILED, STATUS_PENDING)
 from webpay.base import dev_messages as msg
 from webpay.base.tests import BasicSessionCase
+from webpay.pay.utils import wait_for_status
 
 
 class ProviderTestCase(BasicSessionCase):
@@ -95,6 +96,7 @@ class TestProviderSuccess(ProviderTestCase):
         assert not self.payment_notify.delay.called, (
             'did not expect a notification on error')
         self.assertTemplateUsed(res, 'error.html')
+        eq_(wait_for_status(self.trans_id, STATUS_ENDED, 0), STATUS_FAILED)
 
     def test_invalid_notice_on_success(self):
         post = self.slumber.provider.reference.notices.post
@@ -195,6 +197,20 @@ class TestTransactionStatus(ProviderTestCase):
         self.slumber.generic.transaction.get_object.assert_called_with(
             uuid=self.trans_id)
 
+    @mock.patch('webpay.provider.views.wait_for_status')
+    def test_long_poll(self, wait_for_status):
+        self.slumber.generic.transaction.get_object.return_value = {
+            'uuid': self.trans_id,
+            'notes': '{}',
+            'provider': PROVIDER_BANGO,
+            'status': STATUS_COMPLETED}
+        with self.settings(LONG_POLL_TIMEOUT=5):
+            res = self.client.get(reverse('provider.transaction_status',
+                                          args=[self.trans_id]),
+                                  {'wait': 20})
+        eq_(json.loads(res.content)['status'], STATUS_COMPLETED)
+        wait_for_status.assert_called_with(self.trans_id, STATUS_ENDED, 5)
+
     def test_not_found(self):
         get = self.slumber.generic.transaction.get_object
         get.side_effect = ObjectDoesNotExist
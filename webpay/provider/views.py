@@ -8,13 +8,15 @@ from django.shortcuts import render
 from django_paranoia.decorators import require_GET
 
 from lib.solitude.api import client, ProviderHelper
-from lib.solitude.constants import PROVIDERS_INVERTED, STATUS_COMPLETED
+from lib.solitude.constants import (PROVIDERS_INVERTED, STATUS_COMPLETED,
+                                    STATUS_ENDED, STATUS_FAILED)
 from webpay.base import dev_messages as msg
 from webpay.base.decorators import json_view
 from webpay.base.helpers import fxa_auth_info
 from webpay.base.logger import getLogger
 from webpay.base.utils import log_cef, system_error
 from webpay.pay import tasks
+from webpay.pay.utils import long_poll_wait, signal_status, wait_for_status
 
 log = getLogger('w.provider')
 NoticeClasses = {}
@@ -62,6 +64,9 @@ def transaction_status(request, transaction_uuid):
 
     This returns a NULL URL for compatibility with another view that
     redirects to begin payment.
+
+    With ?wait=<seconds> the request is held until the transaction has ended,
+    or the seconds are up, before answering.
     """
     if request.session.get('trans_id') != transaction_uuid:
         log.info('Cannot get transaction status for {t}; session: {s}'
@@ -71,6 +76,9 @@ def transaction_status(request, transaction_uuid):
         log_cef(info, request, severity=7)
         return HttpResponseForbidden()
 
+    wait = long_poll_wait(request)
+    if wait:
+        wait_for_status(transaction_uuid, STATUS_ENDED, wait)
     try:
         trans = client.get_transaction(transaction_uuid)
         return {'status': trans['status'], 'url': None,
@@ -93,7 +101,7 @@ def success(request, provider_name):
     except msg.DevMessage as m:
         return system_error(request, code=m.code)
 
-    tasks.payment_notify.delay(transaction_id)
+    tasks.queue_notice('payment', transaction_id)
 
     if settings.SPA_ENABLE:
         state, fxa_url = fxa_auth_info(request)
@@ -113,10 +121,13 @@ def error(request, provider_name):
             'only the reference provider is implemented so far')
 
     try:
-        provider.prepare_notice(request)
+        transaction_id = provider.prepare_notice(request)
     except msg.DevMessage as m:
         return system_error(request, code=m.code)
 
+    # Stop anyone waiting on the status of the transaction.
+    signal_status(transaction_id, STATUS_FAILED)
+
     # TODO: handle user cancellation, bug 957774.
 
     log.error('Fatal payment error for {provider}: {code}; query string: {qs}'
@@ -142,6 +153,6 @@ def notification(request, provider_name):
     log.info('Processing notification for transaction {t}; status={s}'
              .format(t=transaction_uuid, s=trans['status']))
     if trans['status'] == STATUS_COMPLETED:
-        tasks.payment_notify.delay(transaction_uuid)
+        tasks.queue_notice('payment', transaction_uuid)
 
     return HttpResponse('OK')
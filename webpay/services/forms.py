@@ -5,9 +5,9 @@ import jwt
 from django_paranoia.forms import ParanoidForm
 
 from mozpay.exc import InvalidJWT
-from mozpay.verify import verify_jwt
 from webpay.base.logger import getLogger
-from webpay.pay.utils import lookup_issuer, UnknownIssuer
+from webpay.pay.jwt_utils import ParsedJWT
+from webpay.pay.utils import lookup_issuer, refresh_issuer, UnknownIssuer
 
 log = getLogger('w.services')
 
@@ -18,24 +18,29 @@ class SigCheckForm(ParanoidForm):
     def clean_sig_check_jwt(self):
         enc_jwt = self.cleaned_data['sig_check_jwt'].encode('ascii', 'ignore')
         try:
-            jwt_data = jwt.decode(enc_jwt, verify=False)
+            parsed = ParsedJWT(enc_jwt)
         except jwt.DecodeError, exc:
             log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
                      .format(exc))
             raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
 
         try:
-            secret, active_product = lookup_issuer(jwt_data.get('iss', ''))
+            secret, active_product = lookup_issuer(parsed.issuer or '')
         except UnknownIssuer, exc:
             log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
                      .format(exc))
             raise forms.ValidationError('INVALID_JWT_OR_UNKNOWN_ISSUER')
 
         try:
-            clean_jwt = verify_jwt(enc_jwt,
-                                   settings.DOMAIN,  # JWT audience.
-                                   secret,
-                                   required_keys=[])
+            try:
+                clean_jwt = parsed.verify(settings.DOMAIN,  # JWT audience.
+                                          secret)
+            except InvalidJWT:
+                # The cached secret might be out of date.
+                secret = refresh_issuer(parsed.issuer or '', secret)
+                if not secret:
+                    raise
+                clean_jwt = parsed.verify(settings.DOMAIN, secret)
         except InvalidJWT, exc:
             log.info('caught sig_check exc: {0.__class__.__name__}: {0}'
                      .format(exc))
@@ -10,6 +10,7 @@ import mock
 from curling.lib import HttpClientError
 from nose.tools import eq_, raises
 
+from lib.breaker import CircuitOpen
 from lib.marketplace.api import client as marketplace
 from lib.solitude.api import client as solitude
 from webpay.base.dev_messages import BAD_ICON_KEY
@@ -52,6 +53,24 @@ class TestMonitor(TestCase):
         res = self.client.get(self.url)
         eq_(res.status_code, 200)
 
+    def test_circuit_open(self, sol, mkt):
+        sol.services.request.get.side_effect = CircuitOpen('solitude.services')
+        mkt.account.permissions.mine.get.return_value = {'permissions':
+                                                         {'webpay': True}}
+        res = self.client.get(self.url)
+        eq_(res.status_code, 500)
+        eq_(json.loads(res.content)['solitude'], 'Circuit breaker open')
+
+    @mock.patch('webpay.services.views.breaker_states')
+    def test_breaker_states(self, breaker_states, sol, mkt):
+        breaker_states.return_value = {'solitude.buyer': 'open'}
+        sol.services.request.get.return_value = {'authenticated': 'webpay'}
+        mkt.account.permissions.mine.get.return_value = {'permissions':
+                                                         {'webpay': True}}
+        res = self.client.get(self.url)
+        eq_(json.loads(res.content)['circuit_breakers'],
+            {'solitude.buyer': 'open'})
+
 
 class TestSigCheck(TestCase):
 
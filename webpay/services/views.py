@@ -8,6 +8,7 @@ from django.utils import translation
 from curling.lib import HttpClientError, HttpServerError
 from rest_framework import viewsets
 
+from lib.breaker import breaker_states, CircuitOpen
 from lib.marketplace.api import client as marketplace
 from lib.solitude.api import client as solitude
 from webpay.base.decorators import json_view
@@ -34,6 +35,9 @@ def monitor(request):
                     err.response.status_code,
                     err.response.content or 'empty')
                if err.response else 'Server error: no response')
+    except CircuitOpen:
+        all_good = False
+        msg = 'Circuit breaker open'
     else:
         if not perms['permissions'].get('webpay', False):
             all_good = False
@@ -49,12 +53,18 @@ def monitor(request):
         all_good = False
         msg = ('Server error: status %s, content: %s' %
                (err.response.status_code, err.response.content or 'empty'))
+    except CircuitOpen:
+        all_good = False
+        msg = 'Circuit breaker open'
     else:
         if not users['authenticated'] == 'webpay':
             all_good = False
             msg = 'Not the webpay user, got: %s' % users['authenticated']
 
     content['solitude'] = msg
+
+    # The circuit breakers of this process, for information only.
+    content['circuit_breakers'] = breaker_states()
     return http.HttpResponse(content=json.dumps(content),
                              content_type='application/json',
                              status=200 if all_good else 500)
@@ -130,6 +130,12 @@ LOGIN_URL = 'pay.lobby'
 LOGIN_REDIRECT_URL = 'pay.lobby'
 LOGIN_REDIRECT_URL_FAILURE = 'pay.lobby'
 
+# The most seconds a transaction status request with ?wait= is held open
+# waiting for the status to change. Each held request keeps a web worker
+# busy, so this is 0 (answer straight away) unless a deployment has the
+# workers to spare; 5 is a good value then.
+LONG_POLL_TIMEOUT = 0
+
 MEDIA_URL = '/mozpay/media/'
 
 MIDDLEWARE_CLASSES = (
@@ -143,11 +149,14 @@ MIDDLEWARE_CLASSES = (
     'session_csrf.CsrfMiddleware',  # Must be after auth middleware.
     'django.contrib.messages.middleware.MessageMiddleware',
     'commonware.middleware.FrameOptionsHeader',
+    'webpay.base.middleware.UpstreamErrorMiddleware',
     'webpay.base.middleware.LogJSONerror',
     'webpay.base.middleware.CEFMiddleware',
     'django_paranoia.middleware.Middleware',
     'django_paranoia.sessions.ParanoidSessionMiddleware',
     'webpay.base.logger.LoggerMiddleware',
+    'webpay.base.middleware.DeadlineMiddleware',
+    'webpay.base.middleware.BuyerMemoMiddleware',
 )
 
 ROOT_URLCONF = 'webpay.urls'
@@ -241,6 +250,14 @@ CACHEBUST_IMGS = True
 # new PREFIX in the CACHE setttings. Overridden on all prod servers.
 CACHE_PREFIX = 'webpay'
 
+# Stop calling an upstream resource family (e.g. solitude.buyer) after this
+# many failures in a row. Set to 0 to disable the circuit breakers.
+CIRCUIT_BREAKER_FAILURES = 5
+
+# Seconds to wait before letting a probe call through to an upstream resource
+# family whose circuit breaker is open.
+CIRCUIT_BREAKER_RESET = 30
+
 # When True, compress session cookie data with zlib to improve network
 # performance and avoid maxing out HTTP header length.
 COMPRESS_ENCRYPTED_COOKIE = True
@@ -312,6 +329,13 @@ ENGAGE_ROBOTS = False
 # The issuer of the special marketplace app purchase JWTs.
 ISSUER = DOMAIN
 
+# How long in seconds to cache the secret, access and seller uuids of an
+# in-app JWT issuer. Set this to 0 to look issuers up on every request.
+ISSUER_CACHE_TIMEOUT = 60 * 5
+
+# How long in seconds to remember that an in-app JWT issuer doesn't exist.
+ISSUER_CACHE_NEGATIVE_TIMEOUT = 30
+
 HAS_SYSLOG = not DEBUG
 
 # Temporary, this should be going into solitude.
@@ -367,6 +391,19 @@ MARKETPLACE_OAUTH = {
     'secret': 'some-secret-eh?'
 }
 
+# Keep-alive connection pool for the marketplace client. Any keys missing
+# here fall back to lib.transport.DEFAULT_POOL.
+MARKETPLACE_POOL = {
+    # The number of hosts to keep a connection pool for.
+    'connections': 4,
+    # The number of connections to keep alive per host.
+    'maxsize': 10,
+    # Wait for a free connection instead of opening an extra one.
+    'block': False,
+    # Close connections idle for longer than this many seconds.
+    'idle_timeout': 60,
+}
+
 # Configure our test runner for some nice test output.
 NOSE_PLUGINS = [
     'nosenicedots.NiceDots',
@@ -385,6 +422,12 @@ NOSE_ARGS = [
 # The issuer of all notifications (i.e. the webpay server).
 NOTIFY_ISSUER = DOMAIN
 
+# Seconds to keep the serialized part of a payment or chargeback notice that
+# doesn't change between attempts to deliver it. The secrets of the apps
+# that sign them are kept in process for up to a minute. Set to 0 to build
+# every notice from scratch.
+NOTICE_CACHE_TIMEOUT = 60 * 60
+
 # New Relic is configured here.
 NEWRELIC_INI = None
 
@@ -392,6 +435,13 @@ NEWRELIC_INI = None
 # result in an error.
 ONLY_SIMULATIONS = False
 
+# Make upstream calls that don't depend on each other, such as the lookups
+# done when a payment is started, at the same time in a thread pool.
+PARALLEL_UPSTREAM_CALLS = True
+
+# The number of threads in that pool, per process.
+PARALLEL_POOL_SIZE = 10
+
 # The pay URL is the starting page of the payment screen.
 # It will receive one substitution: the uid_pay value. For example, this is the
 # Billing Configuration ID in Bangoland.
@@ -428,8 +478,47 @@ PIN_UNLOCK_LENGTH = 0
 # Number of retries on a payment postback.
 POSTBACK_ATTEMPTS = 5
 
-# Amount of seconds between each payment postback attempt.
+# Amount of seconds between each payment postback attempt. App servers that
+# have been answering start at POSTBACK_MIN_DELAY and back off from there.
 POSTBACK_DELAY = 300
+POSTBACK_MIN_DELAY = 15
+
+# After this many failed notices in a row an app server is taken to be down
+# and no notices are sent to it for POSTBACK_HOST_DOWN seconds. Set to 0 to
+# always send them.
+POSTBACK_HOST_FAILURES = 5
+POSTBACK_HOST_DOWN = 60 * 5
+
+# The most postbacks and chargebacks each process sends at once.
+POSTBACK_CONCURRENCY = 10
+
+# Keep-alive connection pool for sending notices to app servers. Any keys
+# missing here fall back to lib.transport.DEFAULT_POOL.
+POSTBACK_POOL = {
+    # The number of app servers to keep a connection pool for.
+    'connections': 50,
+    # The number of connections to keep alive per app server.
+    'maxsize': 2,
+    # Wait for a free connection instead of opening an extra one.
+    'block': False,
+    # Close connections idle for longer than this many seconds.
+    'idle_timeout': 30,
+}
+
+# Seconds to remember that a transaction's payment or chargeback notice was
+# delivered, so that the same notice queued again isn't sent again. Set to 0
+# to send every notice that is queued.
+POSTBACK_DELIVERED_TIMEOUT = 60 * 60 * 24 * 7
+
+# Seconds to keep a notice that hasn't been delivered in the outbox, where
+# `manage.py notice_outbox --drain` delivers it POSTBACK_OUTBOX_BATCH at a
+# time to each app server. The crontab in bin/crontab runs it every 5
+# minutes. Set to 0 to not keep an outbox.
+POSTBACK_OUTBOX_TIMEOUT = 60 * 60 * 24 * 7
+POSTBACK_OUTBOX_BATCH = 20
+# The most notices that one drain of the outbox looks at, the rest are left
+# for the next one.
+POSTBACK_OUTBOX_LIMIT = 200
 
 # In production, all locales must be whitelisted for use, regardless of the
 # existence of po files.
@@ -477,6 +566,15 @@ PROD_LANGUAGES = (
     'zh-TW',
 )
 
+# Seconds after which the in-process table of price tiers is reloaded in the
+# background, see lib.marketplace.prices. Set to 0 to always ask the
+# marketplace for prices.
+PRICE_TABLE_TIMEOUT = 60 * 5
+
+# How long in seconds to cache the generic and provider products resolved
+# for a seller's external_id when a payment starts. Set to 0 to disable.
+PRODUCT_CACHE_TIMEOUT = 60 * 60
+
 # Maximum length of a product description. This is used to truncate long
 # descriptions so that they do not break things like session cookies.
 PRODUCT_DESCRIPTION_LENGTH = 255
@@ -486,6 +584,11 @@ PRODUCT_ICON_SIZE = 64
 
 PROJECT_MODULE = 'webpay'
 
+# The most seconds a web request can spend waiting on solitude and the
+# marketplace in total. Each upstream call gets what is left of this as its
+# timeout. Set to None for no limit.
+REQUEST_DEADLINE = 20
+
 # Maximum value for "short" fields in a product JWT. These are fields (like
 # 'name') that have an implied short length. Values that exceed the maximum
 # will trigger form errors.
@@ -511,6 +614,29 @@ SOLITUDE_URL = os.environ.get('SOLITUDE_URL', 'http://localhost:2602')
 # The OAuth tokens for solitude.
 SOLITUDE_OAUTH = {'key': 'webpay', 'secret': 'please change this'}
 
+# The in-process cache kept in front of memcached for solitude buyers: the
+# most buyer keys kept per process and the most seconds they are kept for.
+SOLITUDE_LOCAL_CACHE = {'maxsize': 2000, 'timeout': 60}
+
+# Keep-alive connection pool for the solitude client. Any keys missing
+# here fall back to lib.transport.DEFAULT_POOL.
+SOLITUDE_POOL = {
+    # The number of hosts to keep a connection pool for.
+    'connections': 4,
+    # The number of connections to keep alive per host.
+    'maxsize': 20,
+    # Wait for a free connection instead of opening an extra one.
+    'block': False,
+    # Close connections idle for longer than this many seconds.
+    'idle_timeout': 60,
+}
+
+# When True the seller, prices and icon of a purchase are looked up as soon as
+# the JWT is verified instead of waiting for the client to send its network
+# to configure_transaction. The lookup is thrown away if the network needs
+# other payment providers.
+SPECULATIVE_CONFIGURE = False
+
 SPARTACUS_BUILD_ID_KEY = 'spartacus-build-id'
 SPARTACUS_STATIC = os.environ.get('SPARTACUS_STATIC', 'http://localhost:2604')
 
@@ -555,6 +681,13 @@ TEMPLATE_CONTEXT_PROCESSORS = list(TEMPLATE_CONTEXT_PROCESSORS) + [
     'webpay.base.context_processors.defaults',
 ]
 
+# Seconds to cache a transaction from solitude once it has ended, and while
+# it hasn't. Set either to 0 to not cache them. Bango event notifications can
+# change an ended transaction without webpay knowing which one, so this is
+# how long such a change can go unseen.
+TRANSACTION_CACHE_TIMEOUT = 60 * 5
+TRANSACTION_CACHE_PENDING_TIMEOUT = 2
+
 # When True, use the marketplace API to get product icons.
 USE_PRODUCT_ICONS = True
 
@@ -565,6 +698,11 @@ UUID_HMAC_KEY = ''
 # Warning that this server is really only for testing.
 USAGE_WARNING = False
 
+# The most seconds a verified pay request JWT is cached for, so that reloads
+# of the same JWT skip verification. Entries never outlive the JWT itself.
+# Set to 0 to disable.
+VERIFIED_JWT_CACHE_TIMEOUT = 60 * 60
+
 # If empty, all users will be allowed through.
 # If not empty, each string will be compiled as a regular expression
 # and the email from persona checked using match, not search. If any of the